@@ -0,0 +1,146 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines an index of the borders between the areas of a
+setting.
+
+The index of each setting is built once and kept for the life of the process.
+Areas are given consecutive positions, and the borders of each area, for
+armies and for fleets, are stored as integer bitsets.
+"""
+
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+from condottieri_scenarios.models import Area
+
+## area flags
+SEA = 'is_sea'
+COAST = 'is_coast'
+MIXED = 'mixed'
+FORTIFIED = 'is_fortified'
+PORT = 'has_port'
+CITY = 'has_city'
+FLAGS = (SEA, COAST, MIXED, FORTIFIED, PORT, CITY)
+
+_indexes = {}
+_lock = threading.Lock()
+
+def bits(mask):
+	""" Returns the positions of the bits set in ``mask`` """
+	result = []
+	i = 0
+	while mask:
+		if mask & 1:
+			result.append(i)
+		mask >>= 1
+		i += 1
+	return result
+
+class AdjacencyIndex(object):
+	""" Immutable adjacency graph of the areas in a Setting """
+
+	def __init__(self, setting_id):
+		self.setting_id = setting_id
+		areas = list(Area.objects.filter(setting__id=setting_id).order_by('id').prefetch_related('borders'))
+		self.ids = tuple([a.id for a in areas])
+		self.position = dict([(a.id, i) for i, a in enumerate(areas)])
+		army = [0] * len(areas)
+		fleet = [0] * len(areas)
+		flags = dict([(f, 0) for f in FLAGS])
+		for i, a in enumerate(areas):
+			for b in a.borders.all():
+				j = self.position.get(b.id)
+				if j is None:
+					continue
+				army[i] |= 1 << j
+				if a.is_adjacent(b, fleet=True):
+					fleet[i] |= 1 << j
+			for f in FLAGS:
+				if getattr(a, f):
+					flags[f] |= 1 << i
+		self.army = tuple(army)
+		self.fleet = tuple(fleet)
+		self.flags = flags
+		## borders decoded as sets of area ids
+		self.army_borders = tuple([frozenset([self.ids[j] for j in bits(m)]) for m in army])
+		self.fleet_borders = tuple([frozenset([self.ids[j] for j in bits(m)]) for m in fleet])
+
+	def __contains__(self, area_id):
+		return area_id in self.position
+
+	def is_adjacent(self, area_id, other_id, fleet=False):
+		""" Same as ``Area.is_adjacent`` """
+		i = self.position[area_id]
+		j = self.position[other_id]
+		if fleet:
+			return bool((self.fleet[i] >> j) & 1)
+		return bool((self.army[i] >> j) & 1)
+
+	def borders(self, area_id, fleet=False):
+		""" Returns a frozenset with the ids of the areas bordering the area """
+		i = self.position[area_id]
+		if fleet:
+			return self.fleet_borders[i]
+		return self.army_borders[i]
+
+	def has_flag(self, area_id, flag):
+		return bool((self.flags[flag] >> self.position[area_id]) & 1)
+
+	def mask(self, area_ids):
+		""" Returns a bitset with the given areas """
+		mask = 0
+		for area_id in area_ids:
+			mask |= 1 << self.position[area_id]
+		return mask
+
+	def area_ids(self, mask):
+		""" Returns the ids of the areas in a bitset """
+		return [self.ids[i] for i in bits(mask)]
+
+	def neighbours(self, area_ids, fleet=False):
+		""" Returns a set with the ids of the areas bordering any of the
+		given areas """
+		borders = self.fleet if fleet else self.army
+		mask = 0
+		for area_id in area_ids:
+			mask |= borders[self.position[area_id]]
+		return set(self.area_ids(mask))
+
+def get_index(setting_id):
+	""" Returns the AdjacencyIndex of a setting, building it if needed """
+	index = _indexes.get(setting_id)
+	if index is None:
+		with _lock:
+			index = _indexes.get(setting_id)
+			if index is None:
+				logger.info("Building adjacency index for setting %s" % setting_id)
+				index = AdjacencyIndex(setting_id)
+				_indexes[setting_id] = index
+	return index
+
+def for_area(area):
+	""" Returns the AdjacencyIndex of the setting of a board Area """
+	return get_index(area.setting_id)
+
+def clear_cache():
+	""" Forgets all the indexes, e.g. after editing the borders of a setting """
+	with _lock:
+		_indexes.clear()
@@ -0,0 +1,735 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines an in-memory adjudicator for the orders of a game.
+
+The ``Adjudicator`` loads the units, orders and rebellions of a game once,
+runs the same steps as ``Game.process_orders`` on plain Python structures,
+using the adjacency index of the setting, and writes the results back with a
+few bulk statements.
+"""
+
+from collections import defaultdict
+
+from django.core.exceptions import MultipleObjectsReturned
+from django.db.models import Case, When, Value, IntegerField, CharField, BooleanField
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import models as machiavelli
+import machiavelli.signals as signals
+import machiavelli.convoys as convoys
+import machiavelli.retreats as retreats
+import machiavelli.instrumentation as instrumentation
+
+## fields of Unit that may change while the orders are processed
+UNIT_FIELDS = (
+	('type', CharField()),
+	('area', IntegerField()),
+	('must_retreat', CharField()),
+	('besieging', BooleanField()),
+)
+
+def bulk_update(queryset, objects, fields):
+	""" Saves ``fields`` of all the ``objects`` with a single UPDATE statement.
+	``fields`` is a sequence of (name, output_field) tuples. """
+	if len(objects) == 0:
+		return 0
+	values = {}
+	for name, output_field in fields:
+		attname = queryset.model._meta.get_field(name).attname
+		whens = [When(pk=o.pk, then=Value(getattr(o, attname))) for o in objects]
+		values[name] = Case(*whens, output_field=output_field)
+	return queryset.filter(pk__in=[o.pk for o in objects]).update(**values)
+
+class Adjudicator(object):
+	""" Resolves the orders of a game in memory.
+
+	The methods that resolve each step return the same text as their
+	counterparts in ``Game``, and send the same signals. Nothing is written
+	to the database until ``flush()`` is called.
+	"""
+
+	def __init__(self, game):
+		self.game = game
+		self.finances = game.configuration.finances
+		## pending writes
+		self.deleted_orders = set()
+		self.deleted_units = []
+		self.changed_units = set()
+		self.standoffs = set()
+		self.repressed = set()
+		self.deleted_rebellions = set()
+		self.load()
+
+	def load(self):
+		""" Loads all the objects needed to process the orders """
+		game = self.game
+		self.players = {}
+		for p in machiavelli.Player.objects.filter(game=game).select_related('contender__country'):
+			p.game = game
+			self.players[p.id] = p
+		self.adjacency = game.get_adjacency()
+		self.convoys = None
+		self.areas = {}
+		for ga in machiavelli.GameArea.objects.filter(game=game).select_related('board_area').order_by('id'):
+			ga.game = game
+			self.areas[ga.id] = ga
+		## units, indexed by id and by area
+		self.units = {}
+		self.located = defaultdict(set)
+		for u in machiavelli.Unit.objects.filter(player__game=game).order_by('id'):
+			u.player = self.players[u.player_id]
+			u.area = self.areas[u.area_id]
+			self.units[u.id] = u
+			self.located[u.area_id].add(u.id)
+		## orders, indexed by unit
+		self.orders = {}
+		for o in machiavelli.Order.objects.filter(unit__player__game=game).order_by('id'):
+			if o.unit_id in self.orders:
+				raise MultipleObjectsReturned
+			o.unit = self.units[o.unit_id]
+			if o.destination_id:
+				o.destination = self.areas[o.destination_id]
+			if o.subunit_id:
+				o.subunit = self.units[o.subunit_id]
+			if o.subdestination_id:
+				o.subdestination = self.areas[o.subdestination_id]
+			self.orders[o.unit_id] = o
+		## rebellions, indexed by area
+		self.rebellions = {}
+		for r in machiavelli.Rebellion.objects.filter(area__game=game):
+			r.area = self.areas[r.area_id]
+			r.player = self.players[r.player_id]
+			self.rebellions[r.area_id] = r
+		## the strength of the units is calculated as in the views
+		self.strengths = machiavelli.StrengthMap(game, orders=self.orders.values(),
+			rebellions=self.rebellions.values())
+
+	##------------------------
+	## queries
+	##------------------------
+
+	def all_units(self):
+		return [self.units[i] for i in sorted(self.units.keys())]
+
+	def all_orders(self):
+		return sorted(self.orders.values(), key=lambda o: o.id)
+
+	def get_order(self, unit):
+		return self.orders.get(unit.id)
+
+	def units_in(self, area, types=('A', 'F', 'G')):
+		units = [self.units[i] for i in self.located[area.id]]
+		units = [u for u in units if u.type in types]
+		units.sort(key=lambda u: u.id)
+		return units
+
+	def get_one(self, units):
+		""" Mimics ``QuerySet.get()``: returns the only unit in the list, None
+		if the list is empty or raises MultipleObjectsReturned """
+		if len(units) == 0:
+			return None
+		if len(units) > 1:
+			raise MultipleObjectsReturned
+		return units[0]
+
+	def province_is_empty(self, area):
+		return len(self.units_in(area, types=('A', 'F'))) == 0
+
+	def is_adjacent(self, area, other, fleet=False):
+		return self.adjacency.is_adjacent(area.id, other.id, fleet)
+
+	def has_rebellion(self, area, player, same=True):
+		reb = self.rebellions.get(area.id)
+		if reb is None:
+			return False
+		if same and reb.player_id == player.id:
+			return reb
+		if not same and reb.player_id != player.id:
+			return reb
+		return False
+
+	def get_attacked_area(self, unit):
+		""" Returns the area attacked by the unit, or None """
+		order = self.get_order(unit)
+		if order:
+			if order.code == '-':
+				return order.destination
+			elif order.code == '=':
+				return unit.area
+		return None
+
+	def get_strength(self, unit):
+		""" Same as ``UnitManager.get_with_strength`` """
+		return self.strengths.get_strength(unit)
+
+	def list_with_strength(self):
+		""" Same as ``UnitManager.list_with_strength`` """
+		units = self.all_units()
+		for u in units:
+			u.strength = self.get_strength(u)
+		units.sort(key=lambda u: u.strength, reverse=True)
+		return units
+
+	def get_convoy_resolver(self):
+		if self.convoys is None:
+			rows = []
+			for o in self.orders.values():
+				if o.code == 'C' and o.subdestination_id:
+					rows.append((o.id, o.unit.area.board_area_id, o.subunit_id,
+						o.subunit.area.board_area_id, o.subdestination_id,
+						o.subdestination.board_area_id))
+			self.convoys = convoys.ConvoyResolver(self.adjacency, rows)
+		return self.convoys
+
+	def find_convoy_line(self, order):
+		""" Same as ``Order.find_convoy_line`` """
+		return self.get_convoy_resolver().has_line(order.unit_id, order.destination_id)
+
+	def get_rivals(self, order):
+		""" Same as ``Order.get_rivals`` """
+		unit = order.unit
+		rivals = []
+		for r in self.all_units():
+			if r.id == unit.id:
+				continue
+			r_order = self.get_order(r)
+			if order.code == '-':
+				if r_order and r_order.destination_id == order.destination_id:
+					rivals.append(r)
+				elif r.type == 'G' and r.area_id == order.destination_id and \
+					r_order and r_order.code == '=':
+					rivals.append(r)
+			elif order.code == '=':
+				if r_order and r_order.destination_id == unit.area_id:
+					rivals.append(r)
+		return rivals
+
+	def get_defender(self, order):
+		""" Same as ``Order.get_defender``, but returns None instead of an
+		empty queryset """
+		unit = order.unit
+		candidates = []
+		if order.code == '-':
+			for d in self.units_in(order.destination):
+				d_order = self.get_order(d)
+				if d_order and d_order.destination_id == unit.area_id:
+					candidates.append(d)
+				elif d.type in ('A', 'F') and \
+					(d_order is None or d_order.code in ('B', 'H', 'S', 'C')):
+					candidates.append(d)
+		elif order.code == '=':
+			for d in self.units_in(unit.area, types=('A', 'F')):
+				d_order = self.get_order(d)
+				if d_order is None or d_order.code in ('B', 'H', 'S', 'C', '='):
+					candidates.append(d)
+		return self.get_one(candidates)
+
+	def plan_retreats(self):
+		""" Returns ``retreats.plan_retreats`` with the current state """
+		areas = {}
+		for ga in self.areas.values():
+			areas[ga.id] = (ga.board_area_id, ga.board_area.code, ga.standoff)
+		units = [(u.id, u.type, u.area_id, u.must_retreat) for u in self.all_units()]
+		rebellions = set([r.area_id for r in self.rebellions.values() if r.garrisoned])
+		return retreats.plan_retreats(self.adjacency, areas, units, rebellions)
+
+	##------------------------
+	## changes
+	##------------------------
+
+	def delete_order(self, unit):
+		order = self.orders.pop(unit.id, None)
+		self.strengths.remove_order(unit.id)
+		if order:
+			self.deleted_orders.add(order.id)
+			if order.code == 'C' and self.convoys:
+				self.convoys.remove_order(order.id)
+		return True
+
+	def delete_unit(self, unit):
+		""" Same as ``Unit.delete``. The orders given to and affecting the unit
+		will be deleted by the database cascade. """
+		signals.unit_disbanded.send(sender=unit)
+		del self.units[unit.id]
+		self.located[unit.area_id].discard(unit.id)
+		self.changed_units.discard(unit.id)
+		self.deleted_units.append(unit)
+		order = self.orders.pop(unit.id, None)
+		self.strengths.remove_order(unit.id)
+		if order and order.code == 'C' and self.convoys:
+			self.convoys.remove_order(order.id)
+		for o in list(self.orders.values()):
+			if o.subunit_id == unit.id:
+				del self.orders[o.unit_id]
+				self.strengths.remove_order(o.unit_id)
+
+	def mark_as_standoff(self, area):
+		signals.standoff_happened.send(sender=area)
+		area.standoff = True
+		self.standoffs.add(area.id)
+
+	def move(self, unit, area):
+		self.located[unit.area_id].discard(unit.id)
+		unit.area = area
+		self.located[area.id].add(unit.id)
+
+	def invade_area(self, unit, area):
+		signals.unit_moved.send(sender=unit, destination=area)
+		self.move(unit, area)
+		unit.must_retreat = ''
+		self.changed_units.add(unit.id)
+		self.check_rebellion(unit)
+
+	def convert(self, unit, new_type):
+		signals.unit_converted.send(sender=unit, before=unit.type, after=new_type)
+		unit.type = new_type
+		unit.must_retreat = ''
+		self.changed_units.add(unit.id)
+		if new_type != 'G':
+			self.check_rebellion(unit)
+
+	def check_rebellion(self, unit):
+		reb = self.has_rebellion(unit.area, unit.player, same=False)
+		if reb:
+			reb.repressed = True
+			self.repressed.add(reb.id)
+
+	def delete_rebellion(self, reb):
+		del self.rebellions[reb.area_id]
+		self.strengths.remove_rebellion(reb.area_id)
+		self.repressed.discard(reb.id)
+		self.deleted_rebellions.add(reb.id)
+
+	##------------------------
+	## turn processing steps
+	##------------------------
+
+	@instrumentation.measured
+	def resolve_auto_garrisons(self):
+		info = "Step 1: Garrisoning units.\n"
+		garrisoning = []
+		for g in self.all_units():
+			order = self.get_order(g)
+			if order and order.code == '=' and order.type == 'G':
+				garrisoning.append(g)
+		for g in garrisoning:
+			info += "%s tries to convert into garrison.\n" % g
+			if len(self.units_in(g.area, types=('G',))) != 1:
+				reb = self.rebellions.get(g.area_id)
+				if reb is None or not reb.garrisoned:
+					info += "Success!\n"
+					self.convert(g, 'G')
+				else:
+					info += "There is a garrisoned rebellion.\n"
+				self.delete_order(g)
+			else:
+				info += "Fail: there is a garrison in the city.\n"
+		return info
+
+	def get_conflict_areas(self):
+		conflict_areas = set()
+		for o in self.all_orders():
+			if not o.code in ('-', '=') or o.type == 'G':
+				continue
+			if o.code == '-':
+				is_fleet = (o.unit.type == 'F')
+				if self.is_adjacent(o.unit.area.board_area, o.destination.board_area, fleet=is_fleet) or \
+					self.find_convoy_line(o):
+					conflict_areas.add(o.destination_id)
+			else:
+				conflict_areas.add(o.unit.area_id)
+		return conflict_areas
+
+	@instrumentation.measured
+	def filter_supports(self):
+		conflict_areas = self.get_conflict_areas()
+		for step in (1, 2):
+			if step == 1:
+				info = "Step 2a: Cancel supports from units under attack.\n"
+			elif step == 2:
+				info += "Step 2b: Cancel supports from units that will be dislodged.\n"
+			support_orders = [o for o in self.all_orders() if o.code == 'S']
+			for s in support_orders:
+				info += "Checking order %s.\n" % s
+				if s.unit.type != 'G' and s.unit.area_id in conflict_areas:
+					attacks = []
+					for a in self.all_orders():
+						if a.unit.player_id == s.unit.player_id:
+							continue
+						if (a.code == '-' and a.destination_id == s.unit.area_id) or \
+							(a.code == '=' and a.unit.area_id == s.unit.area_id and a.unit.type == 'G'):
+							attacks.append(a)
+					if len(attacks) > 0:
+						info += "Supporting unit is being attacked.\n"
+						for a in attacks:
+							if (s.subcode == '-' and s.subdestination_id == a.unit.area_id) or \
+							(s.subcode == '=' and s.subtype in ['A','F'] and s.subunit.area_id == a.unit.area_id):
+								if step == 1:
+									info += "Attack comes from area where support is given. Support is not broken.\n"
+									info += "Support will be broken if the unit is dislodged.\n"
+									continue
+								elif step == 2:
+									a_strength = self.get_strength(a.unit)
+									d_strength = self.get_strength(s.unit)
+									if a_strength > d_strength:
+										info += "Attack from %s breaks support (unit dislodged).\n" % a.unit
+										signals.support_broken.send(sender=s.unit)
+										self.delete_order(s.unit)
+										break
+							else:
+								if step == 1:
+									info += "Attack from %s breaks support.\n" % a.unit
+									signals.support_broken.send(sender=s.unit)
+									self.delete_order(s.unit)
+									break
+		return info
+
+	@instrumentation.measured
+	def filter_convoys(self):
+		info = "Step 3: Cancel convoys by fleets that will be dislodged.\n"
+		sea_attackers = []
+		for s in self.all_units():
+			order = self.get_order(s)
+			if not order:
+				continue
+			if (order.code == '-' and order.destination.board_area.is_sea) or \
+				(order.code == '=' and s.area.board_area.mixed and s.type == 'G'):
+				sea_attackers.append(s)
+		for s in sea_attackers:
+			order = self.get_order(s)
+			if not order:
+				continue
+			if order.code == '-':
+				area = order.destination
+			elif order.code == '=' and s.area.board_area.mixed:
+				area = s.area
+			else:
+				continue
+			candidates = []
+			for d in self.units_in(area, types=('F',)):
+				d_order = self.get_order(d)
+				if d_order and d_order.code == 'C':
+					candidates.append(d)
+			if len(candidates) != 1:
+				## no attacked convoying fleet is found
+				continue
+			defender = candidates[0]
+			info += "Convoying %s is being attacked by %s.\n" % (defender, s)
+			a_strength = self.get_strength(s)
+			d_strength = self.get_strength(defender)
+			if a_strength > d_strength:
+				if self.get_order(defender):
+					info += "%s can't convoy.\n" % defender
+					self.delete_order(defender)
+		return info
+
+	@instrumentation.measured
+	def filter_unreachable_attacks(self):
+		info = "Step 4: Cancel attacks to unreachable areas.\n"
+		attackers = [o for o in self.all_orders() if o.code == '-']
+		for o in attackers:
+			is_fleet = (o.unit.type == 'F')
+			if not self.is_adjacent(o.unit.area.board_area, o.destination.board_area, is_fleet):
+				if is_fleet:
+					info += "Impossible attack: %s.\n" % o
+					self.delete_order(o.unit)
+				else:
+					if not self.find_convoy_line(o):
+						info += "Impossible attack: %s.\n" % o
+						self.delete_order(o.unit)
+		return info
+
+	@instrumentation.measured
+	def resolve_conflicts(self):
+		info = "Step 5: Process conflicts.\n"
+		units = self.list_with_strength()
+		conditioned_invasions = []
+		conditioned_origins = []
+		holding = []
+		for u in units:
+			u_order = self.get_order(u)
+			if not u_order:
+				info += "%s has no orders.\n" % u
+				continue
+			else:
+				info += "%s was ordered: %s.\n" % (u, u_order)
+				if self.finances and u_order.code == 'H' and not u.type == 'G':
+					## the unit counts for removing a rebellion. As in
+					## Game.resolve_conflicts, must_retreat is read now
+					holding.append((u, u.must_retreat))
+				if u_order.code in ['H', 'S', 'B', 'C']:
+					continue
+			s = u.strength
+			info += "Total strength = %s.\n" % s
+			rivals = self.get_rivals(u_order)
+			defender = self.get_defender(u_order)
+			info += "Unit has %s rivals.\n" % len(rivals)
+			conflict_area = self.get_attacked_area(u)
+			if conflict_area.standoff:
+				info += "Trying to enter a standoff area.\n"
+				continue
+			else:
+				standoff = False
+			for r in rivals:
+				strength = self.get_strength(r)
+				info += "Rival %s has strength %s.\n" % (r, strength)
+				if strength >= s:
+					info += "Rival wins.\n"
+					standoff = True
+				else:
+					info += "Deleting order of %s.\n" % r
+					self.delete_order(r)
+			if standoff:
+				self.mark_as_standoff(conflict_area)
+				info += "Standoff in %s.\n" % conflict_area
+				for r in rivals:
+					self.delete_order(r)
+				self.delete_order(u)
+				continue
+			else:
+				if defender is not None:
+					## a 'friend enemy' is always as strong as the invading unit
+					if defender.player_id == u.player_id:
+						strength = s
+						info += "Defender is a friend.\n"
+					else:
+						strength = self.get_strength(defender)
+					info += "Defender %s has strength %s.\n" % (defender, strength)
+					if strength >= s:
+						d_attacked = self.get_attacked_area(defender)
+						if d_attacked is not None and d_attacked.id == u.area_id:
+							self.mark_as_standoff(defender.area)
+							info += "Trying to exchange areas.\n"
+							info += "Standoff in %s.\n" % defender.area
+						else:
+							info += "%s's movement is conditioned.\n" % u
+							inv = machiavelli.Invasion(u, defender.area)
+							if u_order.code == '-':
+								info += "%s might get empty.\n" % u.area
+								conditioned_origins.append(u.area)
+							elif u_order.code == '=':
+								inv.conversion = u_order.type
+							conditioned_invasions.append(inv)
+					else:
+						defender.must_retreat = u.area.board_area.code
+						self.changed_units.add(defender.id)
+						if u_order.code == '-':
+							self.invade_area(u, defender.area)
+							info += "Invading %s.\n" % defender.area
+						elif u_order.code == '=':
+							info += "Converting into %s.\n" % u_order.type
+							self.convert(u, u_order.type)
+						self.delete_order(defender)
+				else:
+					info += "There is no defender.\n"
+					unit_leaving = self.get_one(self.units_in(conflict_area, types=('A', 'F')))
+					if unit_leaving is None:
+						info += "Province is empty.\n"
+						if u_order.code == '-':
+							info += "Invading %s.\n" % conflict_area
+							self.invade_area(u, conflict_area)
+						elif u_order.code == '=':
+							info += "Converting into %s.\n" % u_order.type
+							self.convert(u, u_order.type)
+					else:
+						if unit_leaving.player_id != u.player_id and u.strength > unit_leaving.power:
+							info += "There is a unit in %s, but attacker is supported and beats defender's power.\n" % conflict_area
+							unit_leaving.must_retreat = u.area.board_area.code
+							self.changed_units.add(unit_leaving.id)
+							if u_order.code == '-':
+								self.invade_area(u, unit_leaving.area)
+								info += "Invading %s.\n" % unit_leaving.area
+							elif u_order.code == '=':
+								info += "Converting into %s.\n" % u_order.type
+								self.convert(u, u_order.type)
+						else:
+							info += "Area is not empty and attacker isn't supported, or there is a friend\n"
+							info += "%s movement is conditioned.\n" % u
+							inv = machiavelli.Invasion(u, conflict_area)
+							if u_order.code == '-':
+								info += "%s might get empty.\n" % u.area
+								conditioned_origins.append(u.area)
+							elif u_order.code == '=':
+								inv.conversion = u_order.type
+							conditioned_invasions.append(inv)
+		## first, the conditioned invasions directed to now empty areas
+		try_empty = True
+		while try_empty:
+			info += "Looking for possible, conditioned invasions.\n"
+			try_empty = False
+			for ci in conditioned_invasions:
+				if self.province_is_empty(ci.area):
+					info += "Found empty area in %s.\n" % ci.area
+					if ci.unit.area in conditioned_origins:
+						conditioned_origins.remove(ci.unit.area)
+					if ci.conversion == '':
+						self.invade_area(ci.unit, ci.area)
+					else:
+						self.convert(ci.unit, ci.conversion)
+					conditioned_invasions.remove(ci)
+					try_empty = True
+					break
+		## then, cancel the conditioned invasions that cannot be made
+		try_impossible = True
+		while try_impossible:
+			info += "Looking for impossible, conditioned.\n"
+			try_impossible = False
+			for ci in conditioned_invasions:
+				if not ci.area in conditioned_origins:
+					info += "Found impossible invasion in %s.\n" % ci.area
+					self.mark_as_standoff(ci.area)
+					conditioned_invasions.remove(ci)
+					if ci.unit.area in conditioned_origins:
+						conditioned_origins.remove(ci.unit.area)
+					try_impossible = True
+					break
+		## the remaining conditioned invasions form closed circuits
+		info += "Resolving closed circuits.\n"
+		for ci in conditioned_invasions:
+			if ci.conversion == '':
+				info += "%s invades %s.\n" % (ci.unit, ci.area)
+				self.invade_area(ci.unit, ci.area)
+			else:
+				info += "%s converts into %s.\n" % (ci.unit, ci.conversion)
+				self.convert(ci.unit, ci.conversion)
+		## units in 'holding' that don't need to retreat, can put rebellions down
+		for h, must_retreat in holding:
+			if must_retreat != '':
+				continue
+			else:
+				reb = self.has_rebellion(h.area, h.player, same=True)
+				if reb and not reb.garrisoned:
+					info += "Rebellion in %s is put down.\n" % h.area
+					self.delete_rebellion(reb)
+		info += "End of conflicts processing"
+		return info
+
+	@instrumentation.measured
+	def resolve_sieges(self):
+		info = "Step 6: Process sieges.\n"
+		for b in self.all_units():
+			order = self.get_order(b)
+			if b.besieging and (order is None or order.code != 'B'):
+				info += "Siege of %s is discontinued.\n" % b
+				b.besieging = False
+				self.changed_units.add(b.id)
+		besiegers = []
+		for b in self.all_units():
+			order = self.get_order(b)
+			if order and order.code == 'B':
+				besiegers.append(b)
+		for b in besiegers:
+			info += "%s besieges " % b
+			mode = ''
+			if b.player.assassinated:
+				info += "\n%s belongs to an assassinated player.\n" % b
+				continue
+			garrisons = self.units_in(b.area, types=('G',))
+			if len(garrisons) != 1:
+				reb = self.has_rebellion(b.area, b.player, same=True)
+				if reb and reb.garrisoned:
+					mode = 'rebellion'
+					info += "a rebellion "
+				else:
+					info += "Besieging an empty city. Ignoring.\n"
+					b.besieging = False
+					self.changed_units.add(b.id)
+					continue
+			else:
+				mode = 'garrison'
+				defender = garrisons[0]
+			if b.besieging:
+				info += "for second time.\n"
+				b.besieging = False
+				info += "Siege is successful. "
+				if mode == 'garrison':
+					info += "Garrison disbanded.\n"
+					signals.unit_surrendered.send(sender=defender)
+					self.delete_unit(defender)
+				elif mode == 'rebellion':
+					info += "Rebellion is put down.\n"
+					self.delete_rebellion(reb)
+			else:
+				info += "for first time.\n"
+				b.besieging = True
+				signals.siege_started.send(sender=b)
+				if mode == 'garrison' and defender.player.assassinated:
+					info += "Player is assassinated. Garrison surrenders\n"
+					signals.unit_surrendered.send(sender=defender)
+					self.delete_unit(defender)
+					b.besieging = False
+			self.changed_units.add(b.id)
+			self.delete_order(b)
+		return info
+
+	@instrumentation.measured
+	def announce_retreats(self):
+		info = "Step 7: Retreats\n"
+		retreating = [u for u in self.all_units() if u.must_retreat != '']
+		self.retreat_options, disbanded = self.plan_retreats()
+		for u in retreating:
+			info += "%s must retreat.\n" % u
+			signals.forced_to_retreat.send(sender=u)
+			## if the unit has no possible retreat, disband it
+			if u.id in disbanded:
+				self.delete_unit(u)
+		return info
+
+	##------------------------
+	## persistence
+	##------------------------
+
+	@instrumentation.measured
+	def flush(self):
+		""" Writes all the pending changes to the database """
+		if len(self.deleted_orders) > 0:
+			machiavelli.Order.objects.filter(id__in=self.deleted_orders).delete()
+		changed = [self.units[i] for i in self.changed_units if i in self.units]
+		bulk_update(machiavelli.Unit.objects.all(), changed, UNIT_FIELDS)
+		if len(self.deleted_units) > 0:
+			ids = [u.id for u in self.deleted_units]
+			machiavelli.Unit.objects.filter(id__in=ids).delete()
+		if len(self.standoffs) > 0:
+			machiavelli.GameArea.objects.filter(id__in=self.standoffs).update(standoff=True)
+		if len(self.deleted_rebellions) > 0:
+			machiavelli.Rebellion.objects.filter(id__in=self.deleted_rebellions).delete()
+		if len(self.repressed) > 0:
+			machiavelli.Rebellion.objects.filter(id__in=self.repressed).update(repressed=True)
+
+	def process(self):
+		""" Runs all the steps and saves the results. Returns the log text. """
+		info = self.resolve_auto_garrisons()
+		info += "\n"
+		info += self.filter_supports()
+		info += "\n"
+		info += self.filter_convoys()
+		info += "\n"
+		info += self.filter_unreachable_attacks()
+		info += "\n"
+		info += self.resolve_conflicts()
+		info += "\n"
+		info += self.resolve_sieges()
+		info += "\n"
+		info += self.announce_retreats()
+		self.flush()
+		## save the plan for the retreats phase
+		retreats.store_options(self.game, self.retreat_options)
+		return info
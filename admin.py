@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 import machiavelli.models as machiavelli
 
@@ -81,7 +81,15 @@ class LiveGameAdmin(admin.ModelAdmin):
 
 	def check_finished_phase(self, request, queryset):
 		for obj in queryset:
-			obj.check_finished_phase()
+			## the game may be being processed by check_turns
+			if not obj.claim_processing():
+				self.message_user(request, "Game %s is being processed" % obj.slug,
+					level=messages.WARNING)
+				continue
+			try:
+				obj.check_finished_phase()
+			finally:
+				obj.release_processing()
 	check_finished_phase.short_description = "Check finished phase"
 
 	def pause(self, request, queryset):
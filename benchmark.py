@@ -0,0 +1,456 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines a benchmark of the turn processing and of the maps.
+
+A synthetic game is built from an existing scenario, with a configurable
+number of players, unit density and optional rules. Then, random legal orders
+are given and the turns are processed, measuring the wall time, the number of
+queries and the peak memory of every phase and of every step.
+
+The maps of the synthetic game can also be measured at several stages of the
+game, with and without fog of war, and compared with golden images.
+"""
+
+import os
+import os.path
+import random
+import shutil
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from PIL import Image, ImageChops, ImageStat
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from . import models as machiavelli
+import machiavelli.adjudication as adjudication
+import machiavelli.retreats as retreats
+import machiavelli.strategic as strategic
+import machiavelli.graphics as graphics
+
+## optional rules that can be enabled in a synthetic game
+RULES = ('finances', 'assassinations', 'fow', 'famine', 'storms', 'strategic',
+	'lenders')
+
+PHASE_NAMES = {
+	machiavelli.PHREINFORCE: 'reinforcements',
+	machiavelli.PHORDERS: 'orders',
+	machiavelli.PHRETREATS: 'retreats',
+	machiavelli.PHSTRATEGIC: 'strategic',
+}
+
+## methods of Game that are measured as steps
+GAME_STEPS = (
+	'auto_reinforcements', 'adjust_units', 'check_credits', 'process_expenses',
+	'process_assassinations', 'process_orders', 'preprocess_orders',
+	'resolve_auto_garrisons', 'filter_supports', 'filter_convoys',
+	'filter_unreachable_attacks', 'resolve_conflicts', 'resolve_sieges',
+	'announce_retreats', 'process_retreats', 'process_strategic_movements',
+	'kill_plague_units', 'mark_storm_areas', 'update_controls',
+	'check_conquerings', 'check_winner', 'mark_famine_areas', 'assign_incomes',
+	'_next_season', 'make_map',
+)
+
+## methods of Adjudicator that are measured as steps
+ADJUDICATOR_STEPS = (
+	'resolve_auto_garrisons', 'filter_supports', 'filter_convoys',
+	'filter_unreachable_attacks', 'resolve_conflicts', 'resolve_sieges',
+	'announce_retreats', 'flush',
+)
+
+class Recorder(object):
+	""" Collects the measurements of a benchmark run """
+
+	def __init__(self):
+		self.results = []
+		self.stack = []
+		self.context = {}
+
+	@contextmanager
+	def measure(self, name):
+		frame = {'peak': 0}
+		if self.stack and hasattr(tracemalloc, 'reset_peak'):
+			parent = self.stack[-1]
+			parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+		self.stack.append(frame)
+		queries = CaptureQueriesContext(connection)
+		start = time.perf_counter()
+		try:
+			with queries:
+				yield
+		finally:
+			## the frame is removed even if the step fails, so that the
+			## following steps get the right depth and peak
+			elapsed = time.perf_counter() - start
+			self.stack.pop()
+		peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+		if self.stack:
+			self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+		result = dict(self.context)
+		result.update({
+			'step': name,
+			'depth': len(self.stack),
+			'seconds': elapsed,
+			'queries': len(queries.captured_queries),
+			'peak_memory': peak,
+		})
+		self.results.append(result)
+
+	def wrap(self, obj, name):
+		""" Replaces the method ``name`` of ``obj`` with a measured one. Returns
+		the original attribute, to be restored later """
+		original = getattr(obj, name)
+		recorder = self
+		def measured(*args, **kwargs):
+			with recorder.measure(name):
+				return original(*args, **kwargs)
+		setattr(obj, name, measured)
+		return original
+
+	def summary(self):
+		""" Returns the totals of each step """
+		totals = {}
+		for r in self.results:
+			key = (r.get('phase', ''), r['step'])
+			t = totals.setdefault(key, {'phase': key[0], 'step': key[1], 'calls': 0,
+				'seconds': 0, 'queries': 0, 'peak_memory': 0})
+			t['calls'] += 1
+			t['seconds'] += r['seconds']
+			t['queries'] += r['queries']
+			t['peak_memory'] = max(t['peak_memory'], r['peak_memory'])
+		return sorted(totals.values(), key=lambda t: (t['phase'], t['step']))
+
+@contextmanager
+def measured_steps(recorder, game):
+	""" Measures the steps of the game and of the adjudicator while the
+	context is active """
+	overridden = dict([(name, game.__dict__[name]) for name in GAME_STEPS if name in game.__dict__])
+	for name in GAME_STEPS:
+		recorder.wrap(game, name)
+	originals = {}
+	for name in ADJUDICATOR_STEPS:
+		originals[name] = recorder.wrap(adjudication.Adjudicator, name)
+	try:
+		yield
+	finally:
+		for name in GAME_STEPS:
+			if name in overridden:
+				setattr(game, name, overridden[name])
+			else:
+				delattr(game, name)
+		for name, original in originals.items():
+			setattr(adjudication.Adjudicator, name, original)
+
+##--------------------------
+## synthetic games
+##--------------------------
+
+def build_game(scenario, players=None, density=0.0, rules=(), maps=False, label='bench'):
+	""" Creates and starts a game in ``scenario``.
+
+	``players`` is the number of players (all the countries if None).
+	``density`` is the fraction of the empty areas where a new unit is placed
+	after the game has started. ``rules`` is a sequence with names from RULES.
+	If ``maps`` is False, the maps are neither drawn nor queued.
+	"""
+	contenders = scenario.contender_set.exclude(country__isnull=True).count()
+	if players is None or players > contenders:
+		players = contenders
+	owner, created = User.objects.get_or_create(username="%s-0" % label)
+	game = machiavelli.Game(title="%s %s" % (label, int(time.time() * 1000)),
+					scenario=scenario,
+					created_by=owner,
+					time_limit=machiavelli.TIME_LIMITS[0][0],
+					autostart=False,
+					uses_karma=False)
+	game.save()
+	config = game.configuration
+	for rule in rules:
+		setattr(config, rule, True)
+	config.save()
+	if not maps:
+		## update_map would queue a RenderJob with ASYNC_MAP_RENDERING
+		game.update_map = lambda *args, **kwargs: None
+		game.make_map = lambda *args, **kwargs: None
+	for i in range(0, players):
+		user, created = User.objects.get_or_create(username="%s-%s" % (label, i))
+		machiavelli.Player(user=user, game=game).save()
+	game.start()
+	if density > 0:
+		populate(game, density)
+	return game
+
+def populate(game, density):
+	""" Places new units in a fraction of the empty areas """
+	players = list(game.player_set.filter(user__isnull=False))
+	occupied = set(machiavelli.Unit.objects.filter(player__game=game).values_list('area', flat=True))
+	for area in game.gamearea_set.select_related('board_area').exclude(id__in=occupied):
+		if random.random() >= density:
+			continue
+		player = random.choice(players)
+		if area.board_area.is_sea:
+			machiavelli.Unit(type='F', area=area, player=player).save()
+		else:
+			machiavelli.Unit(type='A', area=area, player=player).save()
+			area.player = player
+			area.save()
+
+##--------------------------
+## random orders
+##--------------------------
+
+def random_orders(game):
+	""" Gives a random, possible and confirmed order to every unit """
+	adj = game.get_adjacency()
+	areas = dict([(a.board_area_id, a) for a in game.gamearea_set.select_related('board_area')])
+	units = list(machiavelli.Unit.objects.filter(player__game=game, player__user__isnull=False).select_related('area__board_area', 'player'))
+	neighbours = {}
+	for u in units:
+		neighbours.setdefault(u.area_id, []).append(u)
+	for u in units:
+		candidates = [machiavelli.Order(unit=u, code='H')]
+		for b in adj.borders(u.area.board_area_id):
+			if b in areas:
+				candidates.append(machiavelli.Order(unit=u, code='-', destination=areas[b]))
+				for s in neighbours.get(areas[b].id, []):
+					candidates.append(machiavelli.Order(unit=u, code='S', subunit=s, subcode='H'))
+		if u.type != 'G':
+			candidates.append(machiavelli.Order(unit=u, code='B'))
+			candidates.append(machiavelli.Order(unit=u, code='=', type='G'))
+		random.shuffle(candidates)
+		for order in candidates:
+			if order.is_possible():
+				order.player = u.player
+				order.confirmed = True
+				order.save()
+				break
+
+def random_reinforcements(game):
+	""" Pays, places and disbands units at random, as the players do in the
+	reinforcement views, and ends the phase of every player """
+	finances = game.configuration.finances
+	for p in game.player_set.filter(user__isnull=False, eliminated=False, surrendered=False):
+		if finances:
+			## pay some of the units that the player can afford
+			units = list(p.unit_set.filter(placed=True))
+			random.shuffle(units)
+			for u in units:
+				if u.cost <= p.ducats and random.random() < 0.8:
+					u.paid = True
+					u.save()
+					p.ducats -= u.cost
+			place = min(p.ducats // 3, p.get_areas_for_new_units(finances=True).count())
+		else:
+			place = p.units_to_place()
+			if place < 0:
+				units = list(p.unit_set.filter(placed=True))
+				for u in random.sample(units, min(-place, len(units))):
+					u.paid = False
+					u.save()
+		if place > 0:
+			areas = list(p.get_areas_for_new_units(finances))
+			random.shuffle(areas)
+			for area in areas[:place]:
+				types = area.possible_reinforcements()
+				if len(types) == 0:
+					continue
+				unit = machiavelli.Unit(type=random.choice(types), area=area, player=p,
+					placed=False)
+				if finances:
+					if unit.cost > p.ducats:
+						break
+					p.ducats -= unit.cost
+				unit.save()
+		p.save()
+		p.end_phase(forced=True)
+
+def random_retreats(game):
+	options = retreats.get_retreat_options(game)
+	for u in machiavelli.Unit.objects.filter(player__game=game).exclude(must_retreat__exact=''):
+		choices = options.get(u.id, [])
+		if len(choices) > 0 and random.random() < 0.9:
+			machiavelli.RetreatOrder(unit=u, area_id=random.choice(choices)).save()
+		else:
+			machiavelli.RetreatOrder(unit=u).save()
+
+def random_strategic_orders(game):
+	for p in game.player_set.filter(user__isnull=False):
+		strategic_map = strategic.get_strategic_map(p)
+		for unit_id, destinations in strategic_map.destinations.items():
+			if len(destinations) > 0 and random.random() < 0.5:
+				machiavelli.StrategicOrder(unit_id=unit_id, area_id=random.choice(list(destinations))).save()
+
+def give_orders(game):
+	if game.phase == machiavelli.PHREINFORCE:
+		random_reinforcements(game)
+	elif game.phase == machiavelli.PHORDERS:
+		random_orders(game)
+	elif game.phase == machiavelli.PHRETREATS:
+		random_retreats(game)
+	elif game.phase == machiavelli.PHSTRATEGIC:
+		random_strategic_orders(game)
+
+##--------------------------
+## runner
+##--------------------------
+
+def run(game, turns, recorder=None):
+	""" Gives random orders and processes ``turns`` phases. Returns the
+	Recorder """
+	if recorder is None:
+		recorder = Recorder()
+	started = tracemalloc.is_tracing()
+	if not started:
+		tracemalloc.start()
+	try:
+		with measured_steps(recorder, game):
+			for i in range(0, turns):
+				if game.finished or game.phase == machiavelli.PHINACTIVE:
+					break
+				recorder.context = {
+					'turn': i,
+					'year': game.year,
+					'season': game.season,
+					'phase': PHASE_NAMES.get(game.phase, str(game.phase)),
+				}
+				give_orders(game)
+				with recorder.measure('process_turn'):
+					game.process_turn()
+				game.clear_phase_cache()
+				for p in game.player_set.all():
+					p.new_phase()
+	finally:
+		if not started:
+			tracemalloc.stop()
+	return recorder
+
+##--------------------------
+## maps
+##--------------------------
+
+## stages of the game where the maps are measured, with the number of phases
+## processed before them
+MAP_STAGES = (('start', 0), ('mid', 12), ('late', 36))
+
+## the tokens shipped with the application
+BUNDLED_TOKENS = os.path.join(os.path.dirname(__file__), 'media', 'machiavelli', 'tokens')
+
+def clear_maps(game):
+	""" Deletes the maps, layers and tiles of the game """
+	graphics.clear_layer_cache()
+	shutil.rmtree(os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug),
+		ignore_errors=True)
+
+def measure_maps(recorder, game, fow):
+	""" Measures ``make_map``, ``paste_units`` and ``make_game_thumb`` from
+	an empty cache. Returns a list with the maps made. The game is switched to
+	raster maps, because vector maps are drawn by the browser and there would
+	be no image to measure or compare """
+	config = game.configuration
+	config.map_format = 'raster'
+	config.fow = fow
+	config.save()
+	clear_maps(game)
+	with recorder.measure('make_map'):
+		graphics.make_map(game, fow)
+	if fow:
+		watchers = list(game.player_set.filter(user__isnull=False).order_by('id'))
+	else:
+		watchers = [None]
+	board = Image.open(game.scenario.setting.board.path).convert("RGB")
+	for watcher in watchers:
+		with recorder.measure('paste_units'):
+			graphics.paste_units(board.copy(), game, watcher=watcher)
+	if not fow:
+		with recorder.measure('make_game_thumb'):
+			graphics.make_game_thumb(game, 187, 267)
+	maps = []
+	for watcher in watchers:
+		im = Image.open(game.get_map_path(watcher))
+		im.load()
+		maps.append(im)
+	clear_maps(game)
+	return maps
+
+def image_difference(a, b):
+	""" Returns the mean difference, from 0 to 255, between the two images
+	reduced to small grayscale images, so that only visible changes count """
+	if a.size != b.size:
+		return 255.0
+	size = (max(1, a.size[0] // 4), max(1, a.size[1] // 4))
+	a = a.convert("L").resize(size, Image.BILINEAR)
+	b = b.convert("L").resize(size, Image.BILINEAR)
+	return ImageStat.Stat(ImageChops.difference(a, b)).mean[0]
+
+def check_golden(maps, golden_dir, name, threshold=2.0, update=False):
+	""" Compares the maps with the golden images ``name``-N.png in
+	``golden_dir``. Returns a list with the difference of each map, or None
+	if there is no golden image. If ``update`` is True, the maps are saved as
+	golden images """
+	results = []
+	for i, im in enumerate(maps):
+		path = os.path.join(golden_dir, "%s-%s.png" % (name, i))
+		if update:
+			if not os.path.exists(golden_dir):
+				os.makedirs(golden_dir)
+			im.save(path)
+			results.append({'image': path, 'difference': 0.0, 'passed': True})
+		elif not os.path.exists(path):
+			results.append({'image': path, 'difference': None, 'passed': None})
+		else:
+			difference = image_difference(im, Image.open(path))
+			results.append({'image': path, 'difference': difference,
+				'passed': difference <= threshold})
+	return results
+
+def run_maps(game, recorder, golden_dir=None, threshold=2.0, update=False):
+	""" Processes the game up to each of MAP_STAGES and measures the maps,
+	with and without fog of war. Returns the results of the golden images """
+	checks = []
+	processed = 0
+	started = tracemalloc.is_tracing()
+	if not started:
+		tracemalloc.start()
+	try:
+		for stage, phases in MAP_STAGES:
+			if phases > processed:
+				run(game, phases - processed)
+				processed = phases
+			for fow in (False, True):
+				recorder.context = {
+					'scenario': game.scenario.name,
+					'phase': "%s-%s" % (stage, fow and "fow" or "full"),
+					'stage': stage,
+					'fow': fow,
+				}
+				maps = measure_maps(recorder, game, fow)
+				if golden_dir:
+					name = "%s-%s-%s" % (game.scenario.name, stage, fow and "fow" or "full")
+					for check in check_golden(maps, golden_dir, name, threshold, update):
+						check.update(recorder.context)
+						checks.append(check)
+	finally:
+		if not started:
+			tracemalloc.stop()
+	return checks
@@ -0,0 +1,106 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the resolution of convoy lines.
+
+A ``ConvoyResolver`` takes all the convoy orders of a turn, groups them by
+the convoyed army and its destination, and finds in a single pass over the
+adjacency graph which destinations each army can reach. After that, checking
+a convoy line is a dictionary lookup.
+"""
+
+from collections import deque
+
+from . import models as machiavelli
+from machiavelli.adjacency import SEA, MIXED
+
+class ConvoyResolver(object):
+	""" Convoy lines of a turn.
+
+	``convoys`` is an iterable of tuples with the fields: order id, board
+	area of the convoying fleet, convoyed unit id, board area of the convoyed
+	unit, destination game area id and destination board area id.
+	"""
+
+	def __init__(self, adjacency, convoys):
+		self.adjacency = adjacency
+		## convoying fleets, grouped by (unit id, destination id)
+		self.groups = {}
+		self.origins = {}
+		self.targets = {}
+		for order_id, fleet_area, unit_id, unit_area, dest_id, dest_area in convoys:
+			## only fleets in seas or Venice can convoy
+			if not (adjacency.has_flag(fleet_area, SEA) or adjacency.has_flag(fleet_area, MIXED)):
+				continue
+			self.groups.setdefault((unit_id, dest_id), {})[order_id] = fleet_area
+			self.origins[unit_id] = unit_area
+			self.targets[dest_id] = dest_area
+		self.lines = {}
+		for key in self.groups.keys():
+			self.lines[key] = self.resolve(key)
+
+	@classmethod
+	def for_game(cls, game):
+		""" Returns a ConvoyResolver with the convoy orders of a game """
+		convoys = machiavelli.Order.objects.filter(unit__player__game=game,
+									code__exact='C',
+									subdestination__isnull=False).values_list('id',
+									'unit__area__board_area', 'subunit',
+									'subunit__area__board_area', 'subdestination',
+									'subdestination__board_area')
+		return cls(game.get_adjacency(), convoys)
+
+	def resolve(self, key):
+		""" Returns True if there is a continuous line of convoying fleets
+		from the origin of the unit to the destination """
+		unit_id, dest_id = key
+		nodes = set(self.groups[key].values())
+		target = self.targets[dest_id]
+		closed = set()
+		pending = deque([self.origins[unit_id], ])
+		while len(pending) > 0:
+			current = pending.popleft()
+			if current in closed:
+				continue
+			closed.add(current)
+			borders = self.adjacency.borders(current)
+			if target in borders:
+				return True ## there is a valid convoy line
+			for b in borders & nodes:
+				if not b in closed:
+					pending.append(b)
+		return False ## there is not a valid convoy path
+
+	def has_line(self, unit_id, dest_id):
+		return self.lines.get((unit_id, dest_id), False)
+
+	def destinations(self, unit_id):
+		""" Returns the set of game areas that the unit can reach by convoy """
+		return set([d for (u, d), line in self.lines.items() if u == unit_id and line])
+
+	def remove_order(self, order_id):
+		""" Forgets a convoy order that has been cancelled """
+		for key, fleets in self.groups.items():
+			if order_id in fleets:
+				del fleets[order_id]
+				if len(fleets) == 0:
+					del self.groups[key]
+					del self.lines[key]
+				else:
+					self.lines[key] = self.resolve(key)
+				return
@@ -31,3 +31,9 @@ def check_one_six(dice=1):
 	prob = 1. - pow(5./6., dice)
 	rand = random()
 	return rand <= prob
+
+def choose(candidates):
+	""" Returns one of the candidates, rolling a die with as many faces as
+	candidates. Used to break ties """
+	assert len(candidates) > 0
+	return candidates[randint(1, len(candidates)) - 1]
@@ -20,10 +20,30 @@
 to get random natural disasters. 
 
 The arrays are ``FAMINE_TABLE`` and ``PLAGUE_TABLE``.
+
+The disaster tables of each setting are stored as ``FamineCell``,
+``PlagueCell`` and ``StormCell`` objects. The areas hit by each roll of the
+dice are kept in the cache for each setting, so that each table is read
+from the database once, and the disasters are applied to all the areas at
+once.
 """
 
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from condottieri_scenarios.models import FamineCell, PlagueCell, StormCell
 
 from machiavelli import dice
+from . import models as machiavelli
+import machiavelli.signals as signals
+
+## the model of each disaster table
+CELLS = {
+	'famine': FamineCell,
+	'plague': PlagueCell,
+	'storm': StormCell,
+}
 
 PLAGUE_TABLE = [
 [''     , 'SWI'  , ''     , ''     , 'CAR'  , ''     , ''     , ''     , ''     , 'MON'  , 'CAP'  ],
@@ -93,7 +113,7 @@ def get_column(year):
 
 def get_provinces(table):
 	""" Returns a list of province codes that will be affected by a natural
-	disaster in the current season.
+	disaster in the current season. The empty cells are skipped.
 	"""
 
 	year = get_year()
@@ -102,10 +122,12 @@ def get_provinces(table):
 	provinces = []
 	if row:	
 		for p in table[row]:
-			provinces.append(p)
+			if p:
+				provinces.append(p)
 	if column:
 		for r in table:
-			provinces.append(r[column])
+			if r[column]:
+				provinces.append(r[column])
 	return provinces
 
 def get_plague():
@@ -120,3 +142,70 @@ def get_storms():
 	""" A proxy function to call ``get_provinces`` with ``STORM_TABLE``. """
 	return get_provinces(STORM_TABLE)
 
+def get_cache_key(setting, kind):
+	return "setting-%s_%s_cells" % (setting.pk, kind)
+
+def get_cells(setting, kind, row, column):
+	""" Returns the ids of the board areas hit by ``row`` and ``column`` in
+	the ``kind`` table of the setting. The result of each roll is kept in
+	the cache, so the cells are read once for each setting """
+	## False is not a valid index, but it is equal to 0 as a key
+	index = (row is False and -1 or row, column is False and -1 or column)
+	key = get_cache_key(setting, kind)
+	table = cache.get(key) or {}
+	if not index in table:
+		cells = CELLS[kind].objects.roll(setting, row, column)
+		table[index] = list(cells.values_list('area', flat=True))
+		cache.set(key, table)
+	return table[index]
+
+def roll_areas(game, kind):
+	""" Rolls the dice for a disaster of ``kind`` and returns a list of the
+	areas of the game that are hit """
+	year = get_year()
+	row = get_row(year)
+	column = get_column(year)
+	area_ids = get_cells(game.scenario.setting, kind, row, column)
+	if len(area_ids) == 0:
+		return []
+	return list(machiavelli.GameArea.objects.filter(game=game,
+		board_area__in=area_ids).select_related('board_area').order_by('id'))
+
+def mark_areas(areas, field, signal):
+	""" Sets ``field`` to True in all the ``areas`` with a single UPDATE
+	statement, and then sends ``signal`` for each area """
+	if len(areas) == 0:
+		return
+	machiavelli.GameArea.objects.filter(id__in=[a.id for a in areas]).update(**{field: True})
+	for a in areas:
+		setattr(a, field, True)
+		signal.send(sender=a)
+
+def delete_units(units):
+	""" Deletes the units in the queryset ``units`` with a single DELETE
+	statement, after sending ``unit_disbanded`` for each unit, as
+	``Unit.delete`` does """
+	units = list(units.select_related('player__contender__country', 'area__board_area'))
+	if len(units) == 0:
+		return
+	for u in units:
+		signals.unit_disbanded.send(sender=u)
+	machiavelli.Unit.objects.filter(id__in=[u.id for u in units]).delete()
+
+def strike_areas(areas, signal):
+	""" Sends ``signal`` for each area in ``areas``, followed by
+	``unit_disbanded`` for each unit in that area, so that the log keeps the
+	order of the events of each area. Then, deletes all the units with a
+	single DELETE statement """
+	if len(areas) == 0:
+		return
+	units = list(machiavelli.Unit.objects.filter(area__in=[a.id for a in areas]).select_related(
+		'player__contender__country', 'area__board_area').order_by('id'))
+	by_area = defaultdict(list)
+	for u in units:
+		by_area[u.area_id].append(u)
+	for a in areas:
+		signal.send(sender=a)
+		for u in by_area[a.id]:
+			signals.unit_disbanded.send(sender=u)
+	machiavelli.Unit.objects.filter(id__in=[u.id for u in units]).delete()
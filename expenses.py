@@ -0,0 +1,177 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the resolution of the expenses of a season.
+
+All the expenses of a game are loaded with a single query and resolved in
+memory, in the same order as the rules: unconfirmed expenses are undone,
+famines are relieved, rebellions are pacified and promoted, diplomats are
+hired, countered bribes are discarded and the best bribe for each unit is
+executed. The changes are written with a few bulk statements.
+"""
+
+from collections import OrderedDict, defaultdict
+
+from django.db.models import Q, F, Case, When, PositiveIntegerField
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import models as machiavelli
+import machiavelli.signals as signals
+import machiavelli.dice as dice
+
+## types of expense
+FAMINE_RELIEF = (0,)
+PACIFICATION = (1,)
+REBELLION = (2, 3)
+COUNTER_BRIBE = (4,)
+BRIBES = (5, 6, 7, 8, 9)
+DIPLOMATS = (10, 11)
+
+def load_expenses(game):
+	return list(machiavelli.Expense.objects.filter(player__game=game).select_related(
+		'player__contender__country',
+		'area__board_area',
+		'area__player',
+		'unit__area__board_area',
+		'unit__player').order_by('id'))
+
+def undo_expenses(expenses):
+	""" Deletes the expenses and returns the money to the players, as
+	``Expense.undo`` does for each expense """
+	if len(expenses) == 0:
+		return
+	refunds = defaultdict(int)
+	orders = None
+	for e in expenses:
+		refunds[e.player_id] += e.ducats
+		if e.type in (6, 9):
+			## the order given to the unit that was going to be bought
+			q = Q(player=e.player_id, unit=e.unit_id)
+			orders = q if orders is None else orders | q
+	if orders is not None:
+		machiavelli.Order.objects.filter(orders).delete()
+	whens = [When(pk=k, then=F('ducats') + v) for k, v in refunds.items()]
+	machiavelli.Player.objects.filter(pk__in=list(refunds.keys())).update(
+		ducats=Case(*whens, default=F('ducats'), output_field=PositiveIntegerField()))
+	for e in expenses:
+		e.player.ducats += e.ducats
+		logger.info("Deleting expense in game %s: %s." % (e.player.game_id, e))
+	machiavelli.Expense.objects.filter(pk__in=[e.pk for e in expenses]).delete()
+
+def get_countered(bribes, counter_bribes):
+	""" Returns the bribes whose cost, plus the counter-bribes spent on the
+	same unit, is greater than the ducats spent """
+	protection = defaultdict(int)
+	for e in counter_bribes:
+		protection[e.unit_id] += e.ducats
+	countered = []
+	for e in bribes:
+		total_cost = machiavelli.get_expense_cost(e.type, e.unit) + protection[e.unit_id]
+		if total_cost > e.ducats:
+			countered.append(e)
+	return countered
+
+def choose_bribes(bribes):
+	""" Returns the successful bribe for each bribed unit, ordered by unit.
+	If several bribes spend the same ducats, one of them is chosen with a die """
+	by_unit = OrderedDict()
+	for e in sorted(bribes, key=lambda e: (e.unit_id, e.id)):
+		by_unit.setdefault(e.unit_id, []).append(e)
+	chosen = []
+	for unit_bribes in by_unit.values():
+		best = max(e.ducats for e in unit_bribes)
+		chosen.append(dice.choose([e for e in unit_bribes if e.ducats == best]))
+	return chosen
+
+def hire_diplomats(game, expenses):
+	""" Creates the diplomats, skipping the sea areas and the diplomats that
+	already exist, as ``Diplomat.save`` does """
+	existing = set(machiavelli.Diplomat.objects.filter(player__game=game).values_list('player', 'area'))
+	diplomats = []
+	for e in expenses:
+		logger.info("Saving diplomat in %s" % e.area)
+		key = (e.player_id, e.area_id)
+		if e.area.board_area.is_sea or key in existing:
+			continue
+		existing.add(key)
+		diplomats.append(machiavelli.Diplomat(player=e.player, area=e.area))
+	machiavelli.Diplomat.objects.bulk_create(diplomats)
+
+def process_expenses(game):
+	""" Resolves all the expenses of the game and deletes them """
+	expenses = load_expenses(game)
+	## undo unconfirmed expenses
+	undo_expenses([e for e in expenses if not e.confirmed])
+	expenses = [e for e in expenses if e.confirmed]
+	by_type = defaultdict(list)
+	for e in expenses:
+		by_type[e.type].append(e)
+	def of_types(types):
+		return [e for t in types for e in by_type[t]]
+	## log expenses (ignore diplomats)
+	if signals:
+		for e in expenses:
+			if not e.type in DIPLOMATS:
+				signals.expense_paid.send(sender=e)
+	## then, process famine reliefs
+	relieved = [e.area_id for e in of_types(FAMINE_RELIEF)]
+	if relieved:
+		machiavelli.GameArea.objects.filter(id__in=relieved).update(famine=False)
+	## then, delete the rebellions
+	pacified = [e.area_id for e in of_types(PACIFICATION)]
+	if pacified:
+		machiavelli.Rebellion.objects.filter(area__in=pacified).delete()
+	## then, place new rebellions. Rebellion.save checks each area and sends
+	## the signals, so they are saved one by one
+	promoted = of_types(REBELLION)
+	if promoted:
+		rebels = set(machiavelli.Rebellion.objects.filter(area__game=game).values_list('area', flat=True))
+		for e in promoted:
+			if e.area_id in rebels:
+				continue
+			rebels.add(e.area_id)
+			try:
+				rebellion = machiavelli.Rebellion(area=e.area)
+				rebellion.save()
+			except:
+				continue
+	## create diplomats
+	diplomats = of_types(DIPLOMATS)
+	if diplomats:
+		hire_diplomats(game, diplomats)
+	## then, delete bribes that are countered
+	bribes = of_types(BRIBES)
+	countered = get_countered(bribes, of_types(COUNTER_BRIBE))
+	if countered:
+		machiavelli.Expense.objects.filter(pk__in=[e.pk for e in countered]).delete()
+		countered = set(countered)
+		bribes = [e for e in bribes if not e in countered]
+	## then, resolve the bribes for each bribed unit. All the chosen bribes
+	## are successful, and executed one by one, because each unit sends its
+	## own signals
+	for c in choose_bribes(bribes):
+		if c.type in (5, 8): #disband unit
+			c.unit.delete()
+		elif c.type in (6, 9): #buy unit
+			c.unit.change_player(c.player)
+		elif c.type == 7: #to autonomous
+			c.unit.to_autonomous()
+	## finally, delete all the expenses
+	machiavelli.Expense.objects.filter(player__game=game).delete()
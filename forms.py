@@ -8,6 +8,8 @@ from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
 import machiavelli.models as machiavelli
+import machiavelli.strategic as strategic
+import machiavelli.retreats as retreats
 from condottieri_scenarios.models import Scenario, Country
 
 CITIES_TO_WIN = (
@@ -173,8 +175,10 @@ class UnitForm(forms.ModelForm):
         fields = ('type', 'area')
 
 def strategic_order_form_factory(player):
-    units = player.strategic_units()
-    areas = player.game.get_all_gameareas()
+    strategic_map = strategic.get_strategic_map(player)
+    movable = [u for u, d in strategic_map.destinations.items() if len(d) > 0]
+    units = player.strategic_units().filter(id__in=movable)
+    areas = machiavelli.GameArea.objects.filter(id__in=strategic_map.all_destinations()).select_related('board_area')
 
     class StrategicOrderForm(forms.ModelForm):
         unit = forms.ModelChoiceField(queryset=units, label=_("Unit"))
@@ -189,7 +193,7 @@ def strategic_order_form_factory(player):
             if 'unit' in cleaned_data and 'area' in cleaned_data:
                 unit = cleaned_data['unit']
                 area = cleaned_data['area']
-                if not unit.check_strategic_movement(area):
+                if not strategic_map.can_move(unit.id, area.id):
                     raise forms.ValidationError(_("%(unit)s cannot move to %(area)s") % {'unit': unit,
         'area': area.board_area.name})
             return cleaned_data
@@ -324,8 +328,11 @@ def make_order_form(player):
         
     return OrderForm
 
-def make_retreat_form(u):
-    possible_retreats = u.get_possible_retreats()
+def make_retreat_form(u, retreat_options=None):
+    if retreat_options is None:
+        retreat_options = retreats.get_retreat_options(u.player.game)
+    possible_retreats = machiavelli.GameArea.objects.filter(
+        id__in=retreat_options.get(u.id, [])).select_related('board_area')
     
     class RetreatForm(forms.Form):
         unitid = forms.IntegerField(widget=forms.HiddenInput, initial=u.id)
@@ -19,258 +19,514 @@
 """ This module defines functions to generate the map. """
 
 from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
 import os.path
+import shutil
+import threading
 
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 
 import logging
 logger = logging.getLogger(__name__)
 
+from condottieri_scenarios.models import Area
+
 from . import models as machiavelli
 from machiavelli.exceptions import GraphicsError
-
-TOKENS_DIR=os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT, 'tokens')
+from machiavelli.sprites import get_sprite
+import machiavelli.mapstore as mapstore
+import machiavelli.vector as vector
+import machiavelli.tiles as tiles
+import machiavelli.instrumentation as instrumentation
 
 def ensure_dir(f):
 	d = os.path.dirname(f)
 	if not os.path.exists(d):
 		os.makedirs(d)
 
-LOYAL_A = Image.open("%s/loyal-army.png" % TOKENS_DIR)
-LOYAL_F = Image.open("%s/loyal-fleet.png" % TOKENS_DIR)
-LOYAL_G = Image.open("%s/loyal-garrison.png" % TOKENS_DIR)
-ELITE_A = Image.open("%s/elite-army.png" % TOKENS_DIR)
-ELITE_F = Image.open("%s/elite-fleet.png" % TOKENS_DIR)
-ELITE_G = Image.open("%s/elite-garrison.png" % TOKENS_DIR)
-DIPLOMAT = Image.open("%s/diplomat-icon.png" % TOKENS_DIR)
-
-def load_unit_tokens(game):
+def load_unit_tokens(game, static_names=None):
+	if static_names is None:
+		static_names = game.player_set.filter(user__isnull=False).values_list('static_name', flat=True)
 	tokens = dict()
-	for player in game.player_set.filter(user__isnull=False):
+	for name in static_names:
 		t = dict()
-		name = player.static_name
 		try:
-			t.update({'A': Image.open("%s/A-%s.png" % (TOKENS_DIR, name))})
-			t.update({'F': Image.open("%s/F-%s.png" % (TOKENS_DIR, name))})
-			t.update({'G': Image.open("%s/G-%s.png" % (TOKENS_DIR, name))})
+			t.update({'A': get_sprite("A-%s" % name)})
+			t.update({'F': get_sprite("F-%s" % name)})
+			t.update({'G': get_sprite("G-%s" % name)})
 		except IOError:
 			logger.error("Missing unit token for %s" % name)
 			raise GraphicsError
 		tokens.update({name: t })
 	try:
-		tokens.update({'autonomous': {'G': Image.open("%s/G-autonomous.png" % TOKENS_DIR)}})
+		tokens.update({'autonomous': {'G': get_sprite("G-autonomous")}})
 	except IOError:
 		logger.error("Missing autonomous garrison token")
 		raise GraphicsError
 	return tokens
 
+def load_unit_marks():
+	""" Returns the tokens that mark elite and loyal units, and diplomats """
+	marks = dict()
+	try:
+		for key, name in (('LOYAL_A', 'loyal-army'), ('LOYAL_F', 'loyal-fleet'),
+			('LOYAL_G', 'loyal-garrison'), ('ELITE_A', 'elite-army'),
+			('ELITE_F', 'elite-fleet'), ('ELITE_G', 'elite-garrison'),
+			('DIPLOMAT', 'diplomat-icon')):
+			marks[key] = get_sprite(name)
+	except IOError:
+		logger.error("Missing unit mark token")
+		raise GraphicsError
+	return marks
 
-def paste_units(board, game, watcher=None):
-	tokens = load_unit_tokens(game)
-	if isinstance(watcher, machiavelli.Player):
-		visible = watcher.visible_areas()
-		print("Making secret map for %s" % watcher.static_name)
-	afs = machiavelli.Unit.objects.filter(type__in=('A','F'), player__game=game, placed=True)
-	gars = machiavelli.Unit.objects.filter(type__exact='G', player__game=game, placed=True)
-	dips = None
-	if isinstance(watcher, machiavelli.Player):
-		afs = afs.filter(area__board_area__in=visible)
-		gars = gars.filter(area__board_area__in=visible)
-		dips = watcher.diplomat_set.all()
-	## paste Armies and Fleets
-	for unit in afs:
-			t = tokens[unit.player.static_name][unit.type]
-			if unit.besieging:
-				try:
-					coords = (unit.area.board_area.gtoken.x, unit.area.board_area.gtoken.y)
-				except ObjectDoesNotExist:
-					logger.error("GToken object not found for area %s" % unit.area.board_area.code)
-					raise GraphicsError
+
+##--------------------------
+## render data
+##--------------------------
+
+_coordinates = {}
+_coordinates_lock = threading.Lock()
+
+def get_token_coordinates(setting_id):
+	""" Returns a dictionary with a tuple (code, aftoken, gtoken, controltoken)
+	for each Area of the setting. Each token is a tuple (x, y), or None if the
+	Area has no such token. The coordinates are loaded in one query and kept
+	for the life of the process """
+	with _coordinates_lock:
+		coordinates = _coordinates.get(setting_id)
+	if coordinates is None:
+		coordinates = {}
+		for row in Area.objects.filter(setting__id=setting_id).values_list('id', 'code',
+			'aftoken__x', 'aftoken__y', 'gtoken__x', 'gtoken__y', 'controltoken__x',
+			'controltoken__y'):
+			tokens = []
+			for i in (2, 4, 6):
+				if row[i] is None:
+					tokens.append(None)
+				else:
+					tokens.append((row[i], row[i + 1]))
+			coordinates[row[0]] = (row[1], tokens[0], tokens[1], tokens[2])
+		with _coordinates_lock:
+			_coordinates[setting_id] = coordinates
+	return coordinates
+
+def clear_coordinates_cache():
+	with _coordinates_lock:
+		_coordinates.clear()
+
+TOKEN_KINDS = {'AFToken': 1, 'GToken': 2, 'ControlToken': 3}
+
+class RenderData(object):
+	""" Loads, in a few queries, everything that is drawn on the map of a
+	game, as flat lists of coordinates. If any token is missing, all the
+	missing tokens are logged at once and GraphicsError is raised """
+
+	def __init__(self, game):
+		self.game = game
+		self.coordinates = get_token_coordinates(game.scenario.setting_id)
+		self.missing = set()
+		self.load_board()
+		self.load_units()
+		self.load_diplomats()
+		self.load_markers()
+		if self.missing:
+			logger.error("Tokens not found in game %s: %s" % (game.pk,
+				", ".join(sorted(self.missing))))
+			raise GraphicsError
+
+	def get_coords(self, board_id, kind, dx=0, dy=0):
+		""" Returns the coordinates of a token of an Area, moved by (dx, dy) """
+		code = self.coordinates[board_id][0]
+		coords = self.coordinates[board_id][TOKEN_KINDS[kind]]
+		if coords is None:
+			self.missing.add("%s for area %s" % (kind, code))
+			return None
+		return (coords[0] + dx, coords[1] + dy)
+
+	def load_board(self):
+		game = self.game
+		players = list(game.player_set.filter(user__isnull=False).order_by('id').values_list('id', 'static_name'))
+		self.static_names = [p[1] for p in players]
+		control_coords = dict([(p[0], []) for p in players])
+		flag_coords = dict([(p[0], []) for p in players])
+		self.gameareas = list(game.gamearea_set.order_by('id').values_list('board_area', 'player',
+			'home_of', 'famine', 'storm'))
+		self.controlled = {}
+		enabled = set()
+		for board_id, player_id, home_of, famine, storm in self.gameareas:
+			enabled.add(board_id)
+			if player_id is not None:
+				self.controlled.setdefault(player_id, set()).add(board_id)
+			if player_id in control_coords:
+				control_coords[player_id].append(self.get_coords(board_id, 'ControlToken'))
+			if home_of in flag_coords:
+				flag_coords[home_of].append(self.get_coords(board_id, 'ControlToken', 0, -10))
+		self.controls = [(name, control_coords[pk], flag_coords[pk]) for pk, name in players]
+		## disabled areas and special city incomes
+		self.disabled = []
+		for board_id in sorted(self.coordinates.keys()):
+			if not board_id in enabled:
+				self.disabled.append(self.get_coords(board_id, 'AFToken'))
+		self.chests = []
+		for city_id in game.scenario.cityincome_set.order_by('id').values_list('city', flat=True):
+			self.chests.append(self.get_coords(city_id, 'GToken', 32, 0))
+
+	def load_units(self):
+		""" Makes a list with the placed units of the game, armies and fleets
+		first, as tuples (player id, board area id, token, coordinates, marks) """
+		self.units = []
+		self.occupied = {}
+		rows = machiavelli.Unit.objects.filter(player__game=self.game).order_by('id').values_list(
+			'type', 'player', 'player__user', 'player__static_name', 'area__board_area',
+			'besieging', 'must_retreat', 'placed', 'power', 'loyalty')
+		for (unit_type, player_id, user_id, static_name, board_id, besieging, must_retreat,
+			placed, power, loyalty) in sorted(rows, key=lambda r: r[0] == 'G'):
+			self.occupied.setdefault(player_id, set()).add(board_id)
+			if not placed:
+				continue
+			if unit_type == 'G' or besieging:
+				coords = self.get_coords(board_id, 'GToken')
+			elif must_retreat != '':
+				coords = self.get_coords(board_id, 'AFToken', 15, 15)
 			else:
-				try:
-					coords = (unit.area.board_area.aftoken.x, unit.area.board_area.aftoken.y)
-				except ObjectDoesNotExist:
-					logger.error("AFToken object not found for area %s" % unit.area.board_area.code)
-					raise GraphicsError
-				if unit.must_retreat != '':
-					coords = (coords[0] + 15, coords[1] + 15)
-			if unit.type == 'A':
-				board.paste(t, coords, t)
-				if unit.power > 1:
-					board.paste(ELITE_A, coords, ELITE_A)
-				if unit.loyalty > 1:
-					board.paste(LOYAL_A, coords, LOYAL_A)
-			elif unit.type == 'F':
-				board.paste(t, coords, t)
-				if unit.power > 1:
-					board.paste(ELITE_F, coords, ELITE_F)
-				if unit.loyalty > 1:
-					board.paste(LOYAL_F, coords, LOYAL_F)
+				coords = self.get_coords(board_id, 'AFToken')
+			if unit_type == 'G' and not user_id:
+				token = ('autonomous', 'G')
 			else:
-				pass
-	## paste Garrisons
-	for unit in gars:
-		if unit.player.user:
-			t = tokens[unit.player.static_name]['G']
-		else:
-			t = tokens['autonomous']['G']
-		try:
-			coords = (unit.area.board_area.gtoken.x, unit.area.board_area.gtoken.y)
-		except ObjectDoesNotExist:
-			logger.error("GToken not found for area %s" % unit.area.board_area.code)
-			raise GraphicsError
+				token = (static_name, unit_type)
+			marks = []
+			if power > 1:
+				marks.append("ELITE_%s" % unit_type)
+			if loyalty > 1:
+				marks.append("LOYAL_%s" % unit_type)
+			self.units.append((player_id, board_id, token, coords, marks))
+
+	def load_diplomats(self):
+		""" Makes a dictionary with a list of tuples (board area id,
+		coordinates) for the diplomats of each player """
+		self.diplomats = {}
+		for player_id, board_id in machiavelli.Diplomat.objects.filter(player__game=self.game).order_by('id').values_list('player', 'area__board_area'):
+			coords = self.get_coords(board_id, 'ControlToken', -24, -4)
+			self.diplomats.setdefault(player_id, []).append((board_id, coords))
+
+	def load_markers(self):
+		""" Makes a list of tuples (token, coordinates) with the famine, storm
+		and rebellion markers """
+		config = self.game.configuration
+		self.markers = []
+		for board_id, player_id, home_of, famine, storm in self.gameareas:
+			if famine and config.famine:
+				self.markers.append(("famine-marker", self.get_coords(board_id, 'ControlToken', 12, 12)))
+		for board_id, player_id, home_of, famine, storm in self.gameareas:
+			if storm and config.storms:
+				self.markers.append(("storm-marker", self.get_coords(board_id, 'AFToken', -20, 30)))
+		if config.finances:
+			for board_id, garrisoned in self.game.get_rebellions().order_by('id').values_list('area__board_area', 'garrisoned'):
+				if garrisoned:
+					coords = self.get_coords(board_id, 'GToken')
+				else:
+					coords = self.get_coords(board_id, 'ControlToken', -12, -12)
+				self.markers.append(("rebellion-marker", coords))
+
+	def get_visible_areas(self):
+		""" Returns a dictionary with the ids of the Areas that each player can
+		see, as in ``Player.visible_areas`` """
+		seen = {}
+		for source in (self.controlled, self.occupied):
+			for player_id, ids in source.items():
+				seen.setdefault(player_id, set()).update(ids)
+		for player_id, dips in self.diplomats.items():
+			seen.setdefault(player_id, set()).update([d[0] for d in dips])
+		adj = self.game.get_adjacency()
+		visible = {}
+		for player_id, ids in seen.items():
+			visible[player_id] = ids | adj.neighbours(ids)
+		return visible
+
+def draw_units(board, tokens, marks, units, visible=None, diplomats=()):
+	""" Pastes the units that are in the ``visible`` areas (all of them if
+	``visible`` is None) and the diplomats """
+	for player_id, board_id, token, coords, unit_marks in units:
+		if visible is not None and not board_id in visible:
+			continue
+		t = tokens[token[0]][token[1]]
 		board.paste(t, coords, t)
-		if unit.power > 1:
-			board.paste(ELITE_G, coords, ELITE_G)
-		if unit.loyalty > 1:
-			board.paste(LOYAL_G, coords, LOYAL_G)
-	## paste diplomat icons
-	if dips:
-		for d in dips:
-			try:
-				coords = (d.area.board_area.controltoken.x - 24, d.area.board_area.controltoken.y - 4)
-			except ObjectDoesNotExist:
-				logger.error("ControlToken not found for %s" % d.area.board_area.code)
-				raise GraphicsError
-			board.paste(DIPLOMAT, coords, DIPLOMAT)
-	
-def make_map(game, fow=False):
-	""" Opens the base map and add flags, control markers, unit tokens and other tokens. Then saves
-	the map with an appropriate name in the maps directory.
-	If fow == True, makes one map for every player and doesn't make a thumbnail
-	"""
-	if game.finished:
-		fow = False
-	try:
-		base_map = Image.open(game.scenario.setting.board)
-	except IOError:
-		logger.error("Base map not found for scenario %s" % game.scenario.slug)
-		raise GraphicsError
-	## if there are disabled areas, mark them
+		for m in unit_marks:
+			board.paste(marks[m], coords, marks[m])
+	for board_id, coords in diplomats:
+		board.paste(marks['DIPLOMAT'], coords, marks['DIPLOMAT'])
+
+def paste_units(board, game, watcher=None):
+	data = RenderData(game)
+	tokens = load_unit_tokens(game, data.static_names)
+	marks = load_unit_marks()
+	if isinstance(watcher, machiavelli.Player):
+		visible = data.get_visible_areas().get(watcher.id, set())
+		draw_units(board, tokens, marks, data.units, visible, data.diplomats.get(watcher.id, []))
+	else:
+		draw_units(board, tokens, marks, data.units)
+
+def write_image(image, filename, format, **options):
+	""" Saves the image through a temporary file, so that the file is never
+	seen half-written. Returns the size of the file """
+	ensure_dir(filename)
+	tmp = "%s.%s-%s.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+	image.save(tmp, format, **options)
+	os.replace(tmp, filename)
+	return os.path.getsize(filename)
+
+def save_map(game, board, filename):
+	""" Encodes the map as JPEG, with MAP_JPEG_QUALITY and MAP_JPEG_PROGRESSIVE.
+	If MAP_WEBP is True, it is also encoded as WebP, with the same name and the
+	.webp extension. Returns the RGB image """
+	quality = getattr(settings, 'MAP_JPEG_QUALITY', 85)
+	with instrumentation.measure(game, "encode_map") as extra:
+		result = board.convert("RGB")
+		size = write_image(result, filename, "JPEG", quality=quality, optimize=True,
+			progressive=getattr(settings, 'MAP_JPEG_PROGRESSIVE', True))
+		if getattr(settings, 'MAP_WEBP', False):
+			size += write_image(result, "%s.webp" % os.path.splitext(filename)[0], "WEBP",
+				quality=quality)
+		extra['bytes'] = size
+	return result
+
+##--------------------------
+## map layers
+##--------------------------
+## The map is composited in three layers: the base layer has the board and
+## the markers that never change during the game; the control layer adds the
+## control markers and flags; the units and the rest of markers are drawn on
+## a copy of the control layer every time. The first two layers are kept in
+## memory and in the disk, with a signature of their contents, and are only
+## drawn again when the signature changes.
+
+_layers = OrderedDict()
+_layers_lock = threading.Lock()
+
+def clear_layer_cache():
+	with _layers_lock:
+		_layers.clear()
+
+def get_layers_dir(game):
+	return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug, "layers")
+
+def remove_layers(game):
+	""" Removes the layers of the game from the memory and the disk """
+	with _layers_lock:
+		for key in [k for k in _layers.keys() if k[0] == game.pk]:
+			del _layers[key]
+	shutil.rmtree(get_layers_dir(game), ignore_errors=True)
+
+def make_signature(*data):
+	return hashlib.sha1(repr(data).encode('utf-8')).hexdigest()
+
+def get_layer(game, name, signature, draw):
+	""" Returns the layer ``name`` of the map of ``game``. If the signature of
+	the cached layer is not ``signature``, the layer is drawn with ``draw()``
+	and saved. The returned image must not be modified """
+	key = (game.pk, name)
+	with _layers_lock:
+		cached = _layers.pop(key, None)
+		if cached is not None and cached[0] == signature:
+			_layers[key] = cached
+			return cached[1]
+	path = os.path.join(get_layers_dir(game), "%s.png" % name)
+	image = None
 	try:
-		marker = Image.open("%s/disabled.png" % TOKENS_DIR)
+		with open("%s.sig" % path) as f:
+			if f.read() == signature:
+				image = Image.open(path)
+				image.load()
 	except IOError:
-		logger.error("Disabled token not found")
-		raise GraphicsError
-	for a in game.get_disabled_areas():
-		try:
-			base_map.paste(marker, (a.aftoken.x, a.aftoken.y), marker)
-		except ObjectDoesNotExist:
-			logger.error("AFToken not found for area %s" % a.code)
-			raise GraphicsError
-	## mark special city incomes
+		image = None
+	if image is None:
+		image = draw()
+		write_image(image, path, "PNG", compress_level=1)
+		with open("%s.sig" % path, "w") as f:
+			f.write(signature)
+	with _layers_lock:
+		_layers[key] = (signature, image)
+		while len(_layers) > getattr(settings, 'MAP_LAYER_CACHE_SIZE', 16):
+			_layers.popitem(last=False)
+	return image
+
+def load_base_layer(game, data):
+	""" Returns the signature of the base layer, and a function that draws the
+	board with the disabled areas and the special city incomes marked """
+	board = game.scenario.setting.board
 	try:
-		marker = Image.open("%s/chest.png" % TOKENS_DIR)
-	except IOError:
-		logger.error("Chest token not found")
+		board_path = board.path
+		mtime = os.path.getmtime(board_path)
+	except (IOError, OSError, ValueError):
+		logger.error("Base map not found for scenario %s" % game.scenario.slug)
 		raise GraphicsError
-	for i in game.scenario.cityincome_set.all():
-		try:
-			base_map.paste(marker, (i.city.gtoken.x + 32, i.city.gtoken.y), marker)
-		except ObjectDoesNotExist:
-			logger.error("GToken not found for area %s" % i.city.code)
-			raise GraphicsError
-	##
-	for player in game.player_set.filter(user__isnull=False):
-		## paste control markers
-		controls = player.gamearea_set.all()
+	disabled, chests = data.disabled, data.chests
+	def draw():
 		try:
-			marker = Image.open("%s/control-%s.png" % (TOKENS_DIR, player.static_name))
+			base_map = Image.open(board_path).convert("RGB")
 		except IOError:
-			logger.error("Control token not found for player %s" % player.static_name)
+			logger.error("Base map not found for scenario %s" % game.scenario.slug)
 			raise GraphicsError
-		for area in controls:
-			try:
-				base_map.paste(marker, (area.board_area.controltoken.x, area.board_area.controltoken.y), marker)
-			except ObjectDoesNotExist:
-				logger.error("ControlToken object not found for area %s" % area.board_area.code)
-				raise GraphicsError
-		## paste flags
-		home = player.home_country()
+		## if there are disabled areas, mark them
 		try:
-			flag = Image.open("%s/flag-%s.png" % (TOKENS_DIR, player.static_name))
+			marker = get_sprite("disabled")
 		except IOError:
-			logger.error("Flag token not found for player %s" % player.static_name)
+			logger.error("Disabled token not found")
 			raise GraphicsError
-		for game_area in home:
-			area = game_area.board_area
-			try:
-				base_map.paste(flag, (area.controltoken.x, area.controltoken.y - 10), flag)
-			except ObjectDoesNotExist:
-				logger.error("ControlToken object not found for area %s" % area.board_area.code)
-				raise GraphicsError
-	## paste famine markers
-	if game.configuration.famine:
+		for coords in disabled:
+			base_map.paste(marker, coords, marker)
+		## mark special city incomes
 		try:
-			famine = Image.open("%s/famine-marker.png" % TOKENS_DIR)
+			marker = get_sprite("chest")
 		except IOError:
-			logger.error("Famine token not found")
+			logger.error("Chest token not found")
 			raise GraphicsError
-		for a in game.gamearea_set.filter(famine=True):
+		for coords in chests:
+			base_map.paste(marker, coords, marker)
+		return base_map
+	return (make_signature(board_path, mtime, disabled, chests), draw)
+
+def load_control_layer(game, data):
+	""" Returns the signature of the control layer, and a function that draws
+	the base layer with the control markers and the flags """
+	base_signature, draw_base = load_base_layer(game, data)
+	controls = data.controls
+	def draw():
+		control_map = get_layer(game, "base", base_signature, draw_base).copy()
+		for static_name, control_coords, flag_coords in controls:
+			## paste control markers
 			try:
-				coords = (a.board_area.controltoken.x + 12, a.board_area.controltoken.y + 12)
-			except ObjectDoesNotExist:
-				logger.error("ControlToken object not found for area %s" % a.board_area.code)
+				marker = get_sprite("control-%s" % static_name)
+			except IOError:
+				logger.error("Control token not found for player %s" % static_name)
 				raise GraphicsError
-			base_map.paste(famine, coords, famine)
-	## paste storm markers
-	if game.configuration.storms:
-		try:
-			storm = Image.open("%s/storm-marker.png" % TOKENS_DIR)
-		except IOError:
-			logger.error("Storm token not found")
-			raise GraphicsError
-		for a in game.gamearea_set.filter(storm=True):
+			for coords in control_coords:
+				control_map.paste(marker, coords, marker)
+			## paste flags
 			try:
-				coords = (a.board_area.aftoken.x - 20, a.board_area.aftoken.y + 30)
-			except ObjectDoesNotExist:
-				logger.error("AFToken object not found for area %s" % a.board_area.code)
+				flag = get_sprite("flag-%s" % static_name)
+			except IOError:
+				logger.error("Flag token not found for player %s" % static_name)
 				raise GraphicsError
-			base_map.paste(storm, coords, storm)
-	## paste rebellion markers
-	if game.configuration.finances:
+			for coords in flag_coords:
+				control_map.paste(flag, coords, flag)
+		return control_map
+	return (make_signature(base_signature, controls), draw)
+
+def draw_markers(board, markers):
+	for name, coords in markers:
 		try:
-			rebellion_marker = Image.open("%s/rebellion-marker.png" % TOKENS_DIR)
+			marker = get_sprite(name)
 		except IOError:
-			logger.error("Rebellion token not found")
+			logger.error("Token %s not found" % name)
 			raise GraphicsError
-		for r in game.get_rebellions():
-			try:
-				if r.garrisoned:
-					coords = (r.area.board_area.gtoken.x, r.area.board_area.gtoken.y)
-				else:
-					coords = (r.area.board_area.controltoken.x - 12, r.area.board_area.controltoken.y - 12)
-			except ObjectDoesNotExist:
-				logger.error("ControlToken object not found for area %s" % r.area.board_area.code)
-				raise GraphicsError
-			base_map.paste(rebellion_marker, coords, rebellion_marker)
+		board.paste(marker, coords, marker)
+
+def draw_map(game, data):
+	""" Returns the raster image of the map described by the RenderData
+	``data``, with all the units, without saving it """
+	layer_signature, draw_layer = load_control_layer(game, data)
+	board = get_layer(game, "controls", layer_signature, draw_layer).copy()
+	draw_markers(board, data.markers)
+	draw_units(board, load_unit_tokens(game, data.static_names), load_unit_marks(), data.units)
+	return board
+
+def make_map(game, fow=False):
+	""" Composites the cached base and control layers, and adds the markers and the unit
+	tokens. Then saves the map in the map store, and links it with an appropriate name in
+	the maps directory. A map that is already in the store is not rendered again.
+	If fow == True, makes one map for every player and doesn't make a thumbnail.
+	The maps of the players are made in parallel by MAP_RENDER_WORKERS threads
+	"""
+	if game.configuration.map_format == 'vector':
+		return vector.make_map(game, fow)
+	if game.finished:
+		fow = False
+	data = RenderData(game)
+	layer_signature, draw_layer = load_control_layer(game, data)
+	markers = data.markers
+	units = data.units
+	state = make_signature(layer_signature, markers, units)
+	boards = []
+	def get_board():
+		## the board with the markers is only made if any map must be rendered
+		if not boards:
+			board = get_layer(game, "controls", layer_signature, draw_layer).copy()
+			draw_markers(board, markers)
+			boards.append(board)
+		return boards[0]
+	tokens = load_unit_tokens(game, data.static_names)
+	marks = load_unit_marks()
 	if fow:
+		diplomats = data.diplomats
+		visible = data.get_visible_areas()
+		links = []
+		jobs = []
 		for player in game.player_set.filter(user__isnull=False):
-			player_map = base_map.copy()
-			paste_units(player_map, game, watcher=player)
-			result = player_map.convert("RBG")
-			filename = game.get_map_path(player)
-			ensure_dir(filename)
-			result.save(filename)
+			player_visible = visible.get(player.id, set())
+			player_diplomats = diplomats.get(player.id, [])
+			key = make_signature(state, sorted(player_visible), player_diplomats)
+			links.append((key, game.get_map_path(player)))
+			links.append((key, mapstore.get_latest_path(game, player)))
+			if not mapstore.exists(game, key):
+				jobs.append((player_visible, player_diplomats, key))
+		if jobs:
+			base_map = get_board()
+		profile = instrumentation.get_profile()
+		def render(job):
+			with instrumentation.use_profile(profile):
+				player_map = base_map.copy()
+				draw_units(player_map, tokens, marks, units, job[0], job[1])
+				result = save_map(game, player_map, mapstore.get_path(game, job[2]))
+				if tiles.is_enabled():
+					tiles.make_tiles(game, result, job[2])
+		workers = getattr(settings, 'MAP_RENDER_WORKERS', 4)
+		if workers > 1 and len(jobs) > 1:
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				## list() raises the errors of the threads, if any
+				list(executor.map(render, jobs))
+		else:
+			for job in jobs:
+				render(job)
+		for key, filename in links:
+			mapstore.link(game, key, filename)
 	else:
-		paste_units(base_map, game)
-		result = base_map.convert("RGB")
-		filename = game.get_map_path()
-		ensure_dir(filename)
-		result.save(filename)
-		make_game_thumb(game, 187, 267)
+		if not mapstore.exists(game, state):
+			base_map = get_board()
+			draw_units(base_map, tokens, marks, units)
+			result = save_map(game, base_map, mapstore.get_path(game, state))
+			if tiles.is_enabled():
+				tiles.make_tiles(game, result, state)
+		else:
+			result = None
+		mapstore.link(game, state, game.get_map_path())
+		mapstore.link(game, state, mapstore.get_latest_path(game))
+		thumb = "%s-thumb" % state
+		if not mapstore.exists(game, thumb):
+			make_game_thumb(game, 187, 267, mapstore.get_path(game, thumb), result)
+		mapstore.link(game, thumb, game.thumbnail_path)
 
 	return True
 
-def make_game_thumb(game, w, h):
-	""" Make a thumbnail of the game map image """
+def make_game_thumb(game, w, h, outfile=None, image=None):
+	""" Make a thumbnail of the game map image. If ``image`` is given, the
+	thumbnail is made from it instead of reading the map from the disk """
 	size = w, h
-	fd = game.get_map_path()
-	outfile = game.thumbnail_path
-	im = Image.open(fd)
-	im.thumbnail(size, Image.ANTIALIAS)
-	ensure_dir(outfile)
-	im.save(outfile, "JPEG")
-
+	if outfile is None:
+		outfile = game.thumbnail_path
+	with instrumentation.measure(game, "encode_thumbnail") as extra:
+		if image is None:
+			image = Image.open(game.get_map_path())
+			## decode the JPEG at the smallest scale that is not below the size
+			image.draft("RGB", size)
+		factor = min(image.size[0] // w, image.size[1] // h)
+		if factor > 1 and hasattr(image, 'reduce'):
+			im = image.reduce(factor)
+		else:
+			im = image.copy()
+		im.thumbnail(size, getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', None)))
+		extra['bytes'] = write_image(im.convert("RGB"), outfile, "JPEG",
+			quality=getattr(settings, 'MAP_JPEG_QUALITY', 85))
@@ -0,0 +1,282 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the income engine.
+
+The income of every player in a season is computed from a few grouped
+queries: the game areas, the units, the rebellions and the ends of the safe
+trade routes are loaded once for the whole game into ``IncomeSources``. The
+random income of the major cities and the countries is taken from a
+``RandomIncomeTable``, which has the income for the six faces of the die and
+is kept in the cache for each setting. The result is an ``IncomeBreakdown``
+for each player, so that the income can be computed for the die that is
+rolled, or forecast for all the faces at once.
+"""
+
+from collections import Counter, OrderedDict, defaultdict
+
+from django.core.cache import cache
+from django.db.models import Case, When, F, PositiveIntegerField
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import models as machiavelli
+import machiavelli.signals as signals
+import machiavelli.routes as routes
+
+DIE_FACES = (1, 2, 3, 4, 5, 6)
+
+class IncomeBreakdown(object):
+	""" The income of a player in one season, by source """
+
+	SOURCES = ('control', 'occupation', 'garrisons', 'variable', 'trade')
+
+	def __init__(self, player):
+		self.player = player
+		self.control = 0
+		self.occupation = 0
+		self.garrisons = 0
+		self.variable = 0
+		self.trade = 0
+
+	def _get_total(self):
+		return sum(getattr(self, s) for s in self.SOURCES)
+
+	total = property(_get_total)
+
+	def copy(self):
+		b = IncomeBreakdown(self.player)
+		for s in self.SOURCES:
+			setattr(b, s, getattr(self, s))
+		return b
+
+	def as_dict(self):
+		d = dict((s, getattr(self, s)) for s in self.SOURCES)
+		d['total'] = self.total
+		return d
+
+	def __str__(self):
+		return ", ".join(["%s: %s" % (s, getattr(self, s)) for s in self.SOURCES])
+
+class RandomIncomeTable(object):
+	""" The random income of the major cities and the countries of a setting
+	for each face of the die. The table is completed when a city or country
+	is needed for the first time, and kept in the cache """
+
+	def __init__(self, setting):
+		self.setting = setting
+		self.key = "setting-%s_income_table" % setting.pk
+		self.values = cache.get(self.key) or {}
+
+	def prepare(self, sources):
+		""" Adds to the table the cities and countries in ``sources`` """
+		changed = False
+		area_ids = set()
+		for terms in sources.cities.values():
+			for source, area_id, times in terms:
+				if not ('city', area_id) in self.values:
+					area_ids.add(area_id)
+		if area_ids:
+			for area in machiavelli.Area.objects.filter(id__in=area_ids):
+				self.values[('city', area.id)] = [area.get_random_income(d) for d in DIE_FACES]
+			changed = True
+		for terms in sources.countries.values():
+			for country, double in terms:
+				key = ('country', country.pk, double)
+				if not key in self.values:
+					self.values[key] = [country.get_random_income(self.setting, d, double) for d in DIE_FACES]
+					changed = True
+		if changed:
+			cache.set(self.key, self.values)
+
+	def get_city(self, area_id, die):
+		return self.values[('city', area_id)][die - 1]
+
+	def get_country(self, country, double, die):
+		return self.values[('country', country.pk, double)][die - 1]
+
+class IncomeSources(object):
+	""" The sources of income of the active players of a game, applying the
+	same rules as ``Player.get_income``. The income that does not depend on
+	the die is computed when the sources are loaded. The trade income is
+	taken from ``evaluator``, a RouteEvaluator, or from a new one """
+
+	def __init__(self, game, majors_ids=None, evaluator=None):
+		self.game = game
+		self.setting = game.scenario.setting
+		## fixed income of each player, keyed by player id
+		self.fixed = OrderedDict()
+		## random income of the major cities: (source, area id, times)
+		self.cities = defaultdict(list)
+		## variable income of the countries: (country, double income)
+		self.countries = defaultdict(list)
+		self.load(majors_ids, evaluator)
+
+	def load(self, majors_ids, evaluator=None):
+		game = self.game
+		if majors_ids is None:
+			majors_ids = game.scenario.major_cities.values_list('city', flat=True)
+		## a city is counted as many times as it is listed, as in Player.get_control_income
+		majors = Counter(majors_ids)
+		all_players = list(game.player_set.select_related('contender__country').order_by('id'))
+		for p in all_players:
+			if p.user_id is not None and not p.eliminated:
+				self.fixed[p.id] = IncomeBreakdown(p)
+		if len(self.fixed) == 0:
+			return
+		## rebellions, keyed by the player they are against
+		rebellions = {}
+		for player_id, area_id in machiavelli.Rebellion.objects.filter(player__game=game).values_list('player', 'area'):
+			rebellions.setdefault(player_id, set()).add(area_id)
+		## game areas
+		areas = {}
+		garrison_income = {}
+		for area_id, player_id, board_area_id, famine, control, garrison in machiavelli.GameArea.objects.filter(game=game).values_list('id', 'player', 'board_area', 'famine', 'board_area__control_income', 'board_area__garrison_income'):
+			areas[area_id] = (player_id, board_area_id, famine)
+			garrison_income[board_area_id] = garrison or 0
+			b = self.fixed.get(player_id)
+			if b is None or famine or area_id in rebellions.get(player_id, ()):
+				continue
+			b.control += control or 0
+			if board_area_id in majors:
+				self.cities[player_id].append(('control', board_area_id, majors[board_area_id]))
+		## units
+		sieges = set()
+		garrisons = {}
+		for player_id, unit_type, area_id, besieging in machiavelli.Unit.objects.filter(player__game=game).values_list('player', 'type', 'area', 'besieging'):
+			owner, board_area_id, famine = areas[area_id]
+			if besieging:
+				sieges.add(board_area_id)
+			b = self.fixed.get(player_id)
+			if b is None:
+				continue
+			if unit_type == 'G':
+				if owner != player_id or famine or area_id in rebellions.get(player_id, ()):
+					garrisons.setdefault(player_id, set()).add(board_area_id)
+			elif not famine and owner != player_id:
+				b.occupation += 1
+		for player_id, board_area_ids in garrisons.items():
+			b = self.fixed[player_id]
+			for board_area_id in sorted(board_area_ids - sieges):
+				b.garrisons += garrison_income[board_area_id]
+				if board_area_id in majors:
+					self.cities[player_id].append(('garrisons', board_area_id, 1))
+		## variable income, including the income of the conquered players
+		conquering = game.configuration.conquering
+		for b in self.fixed.values():
+			p = b.player
+			self.countries[p.id].append((p.contender.country, p.double_income))
+			if conquering:
+				for c in all_players:
+					if c.conqueror_id == p.id:
+						self.countries[p.id].append((c.contender.country, c.double_income))
+		## trade routes: one ducat for each end of a safe route
+		if self.setting.configuration.trade_routes:
+			if evaluator is None:
+				evaluator = routes.RouteEvaluator(game)
+			trade = evaluator.get_trade_income()
+			for player_id, b in self.fixed.items():
+				b.trade = trade.get(player_id, 0)
+
+	def get_breakdowns(self, die, table):
+		""" Returns an ordered dictionary with the ``IncomeBreakdown`` of each
+		player for ``die``, keyed by player id """
+		breakdowns = OrderedDict()
+		for player_id, fixed in self.fixed.items():
+			b = fixed.copy()
+			for source, area_id, times in self.cities[player_id]:
+				setattr(b, source, getattr(b, source) + table.get_city(area_id, die) * times)
+			for country, double in self.countries[player_id]:
+				b.variable += table.get_country(country, double, die)
+			breakdowns[player_id] = b
+		return breakdowns
+
+def get_breakdowns(game, die, majors_ids=None, evaluator=None):
+	""" Returns an ordered dictionary with the ``IncomeBreakdown`` of each
+	active player for ``die``, keyed by player id """
+	sources = IncomeSources(game, majors_ids, evaluator)
+	table = RandomIncomeTable(sources.setting)
+	table.prepare(sources)
+	return sources.get_breakdowns(die, table)
+
+def get_forecasts(game, majors_ids=None):
+	""" Returns a dictionary, keyed by player id, with a list of the
+	``IncomeBreakdown`` of the player for each face of the die. No dice are
+	rolled """
+	sources = IncomeSources(game, majors_ids)
+	table = RandomIncomeTable(sources.setting)
+	table.prepare(sources)
+	forecasts = dict((player_id, []) for player_id in sources.fixed.keys())
+	for die in DIE_FACES:
+		for player_id, b in sources.get_breakdowns(die, table).items():
+			forecasts[player_id].append(b)
+	return forecasts
+
+def get_forecast_cache_key(player_id):
+	return "player-%s_forecast" % player_id
+
+def get_forecast(player):
+	""" Returns the income forecast of the player, as a dictionary with the
+	breakdown for each face of the die in 'faces', and the 'minimum',
+	'maximum' and 'expected' income. The forecasts of all the players are
+	computed at once and kept in the cache until the phase changes """
+	game = player.game
+	phase = (game.year, game.season, game.phase)
+	data = cache.get(get_forecast_cache_key(player.pk))
+	if data is not None and data['phase'] == phase:
+		return data['forecast']
+	forecast = None
+	to_cache = {}
+	for player_id, breakdowns in get_forecasts(game).items():
+		faces = []
+		for die, b in zip(DIE_FACES, breakdowns):
+			d = b.as_dict()
+			d['die'] = die
+			faces.append(d)
+		totals = [f['total'] for f in faces]
+		f = {
+			'faces': faces,
+			'minimum': min(totals),
+			'maximum': max(totals),
+			'expected': float(sum(totals)) / len(totals),
+		}
+		to_cache[get_forecast_cache_key(player_id)] = {'phase': phase, 'forecast': f}
+		if player_id == player.pk:
+			forecast = f
+	cache.set_many(to_cache)
+	return forecast
+
+def assign_incomes(game, die, majors_ids=None, evaluator=None):
+	""" Adds the income of the season to the treasury of each player, with a
+	single UPDATE statement, and sends ``income_raised`` for each player that
+	raised any ducats. ``evaluator`` is the RouteEvaluator that has just
+	updated the safety of the routes, so that they are not loaded again.
+	Returns the breakdowns """
+	breakdowns = get_breakdowns(game, die, majors_ids, evaluator)
+	raised = [b for b in breakdowns.values() if b.total > 0]
+	if len(raised) == 0:
+		return breakdowns
+	whens = [When(pk=b.player.pk, then=F('ducats') + b.total) for b in raised]
+	machiavelli.Player.objects.filter(pk__in=[b.player.pk for b in raised]).update(
+		ducats=Case(*whens, default=F('ducats'), output_field=PositiveIntegerField()))
+	for b in raised:
+		b.player.ducats += b.total
+		signals.income_raised.send(sender=b.player, ducats=b.total)
+		logger.info("Player %s raised %s ducats (%s)." % (b.player.pk, b.total, b))
+	return breakdowns
@@ -0,0 +1,152 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the instrumentation of the turn processing.
+
+Each measured step records its elapsed time, the number of database queries
+and the number of rows touched by them. The measures are sent with the
+``turn_step_measured`` signal and logged to the ``machiavelli.instrumentation``
+logger. The measures of a whole turn can be collected with a ``Profile``.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+import logging
+logger = logging.getLogger(__name__)
+
+import machiavelli.signals as signals
+
+_local = threading.local()
+
+def is_enabled():
+	return getattr(settings, 'TURN_INSTRUMENTATION', True)
+
+class QueryCounter(object):
+	""" Counts the queries run and the rows touched while it is installed
+	with ``connection.execute_wrapper`` """
+
+	def __init__(self):
+		self.queries = 0
+		self.rows = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		result = execute(sql, params, many, context)
+		self.queries += 1
+		rowcount = getattr(context.get('cursor'), 'rowcount', -1)
+		if rowcount is not None and rowcount > 0:
+			self.rows += rowcount
+		return result
+
+@contextmanager
+def count_queries():
+	""" Yields a QueryCounter that counts the queries run inside the context """
+	counter = QueryCounter()
+	if hasattr(connection, 'execute_wrapper'):
+		with connection.execute_wrapper(counter):
+			yield counter
+	else:
+		## older Django versions: count the queries, but not the rows
+		from django.test.utils import CaptureQueriesContext
+		captured = CaptureQueriesContext(connection)
+		counter.rows = None
+		with captured:
+			yield counter
+		counter.queries = len(captured.captured_queries)
+
+class Profile(object):
+	""" Collects all the measures taken while it is active """
+
+	def __init__(self):
+		self.measures = []
+
+	def __enter__(self):
+		self.parent = getattr(_local, 'profile', None)
+		_local.profile = self
+		return self
+
+	def __exit__(self, *args):
+		_local.profile = self.parent
+		return False
+
+	def as_json(self):
+		return json.dumps(self.measures)
+
+def get_profile():
+	""" Returns the active profile of this thread, if any """
+	return getattr(_local, 'profile', None)
+
+@contextmanager
+def use_profile(profile):
+	""" Makes ``profile`` the active profile in this thread, e.g. in a worker
+	thread started while the profile is active in another one """
+	parent = getattr(_local, 'profile', None)
+	_local.profile = profile
+	try:
+		yield profile
+	finally:
+		_local.profile = parent
+
+@contextmanager
+def measure(game, step):
+	""" Measures the code run inside the context, as the step ``step`` of
+	the game. Yields a dictionary where the code can add its own measures,
+	e.g. the bytes written """
+	extra = {}
+	if not is_enabled():
+		yield extra
+		return
+	depth = getattr(_local, 'depth', 0)
+	_local.depth = depth + 1
+	start = time.time()
+	try:
+		with count_queries() as counter:
+			yield extra
+	finally:
+		_local.depth = depth
+	elapsed = time.time() - start
+	data = {
+		'step': step,
+		'depth': depth,
+		'seconds': round(elapsed, 4),
+		'queries': counter.queries,
+		'rows': counter.rows,
+	}
+	data.update(extra)
+	profile = getattr(_local, 'profile', None)
+	if profile is not None:
+		profile.measures.append(data)
+	logger.debug("Game %s: %s took %.4f s, %s queries, %s rows" % (game.pk,
+		step, elapsed, counter.queries, counter.rows))
+	signals.turn_step_measured.send(sender=game, **data)
+
+def measured(func):
+	""" Decorator that measures a method of a Game, or of an object with a
+	``game`` attribute """
+	@wraps(func)
+	def wrapper(self, *args, **kwargs):
+		game = getattr(self, 'game', self)
+		with measure(game, func.__name__):
+			return func(self, *args, **kwargs)
+	return wrapper
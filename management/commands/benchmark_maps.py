@@ -0,0 +1,89 @@
+import json
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from condottieri_scenarios.models import Scenario
+
+from machiavelli import benchmark
+from machiavelli import sprites
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    """
+Builds a synthetic game in each scenario and measures make_map, paste_units and make_game_thumb
+at the start, middle and end of the game, with and without fog of war. The maps can be compared
+with golden images. The games are created inside a transaction that is rolled back at the end.
+    """
+
+    help = """ Benchmarks the maps of synthetic games in the given scenarios and compares them
+    with golden images. """
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='+', type=str, help='Names of the scenarios')
+        parser.add_argument('--tokens', type=str, default=benchmark.BUNDLED_TOKENS,
+            help='Directory of the tokens (default: the bundled tokens)')
+        parser.add_argument('--players', type=int, default=None,
+            help='Number of players (default: all the countries)')
+        parser.add_argument('--density', type=float, default=0.0,
+            help='Fraction of the empty areas where an extra unit is placed')
+        parser.add_argument('--seed', type=int, default=1,
+            help='Seed for the random orders; the golden images need the same seed')
+        parser.add_argument('--golden', type=str, default='',
+            help='Directory of the golden images')
+        parser.add_argument('--update-golden', action='store_true', default=False,
+            help='Save the maps as the new golden images')
+        parser.add_argument('--threshold', type=float, default=2.0,
+            help='Maximum mean difference, from 0 to 255, with a golden image')
+        parser.add_argument('--output', type=str, default='',
+            help='Path of the JSON file (default: standard output)')
+
+    def handle(self, *args, **options):
+        scenarios = []
+        for name in options['scenario']:
+            try:
+                scenarios.append(Scenario.objects.get(name=name))
+            except Scenario.DoesNotExist:
+                raise CommandError("Scenario %s does not exist" % name)
+        if options['update_golden'] and not options['golden']:
+            raise CommandError("--update-golden needs --golden")
+        sprites.use_tokens_dir(options['tokens'])
+        recorder = benchmark.Recorder()
+        checks = []
+        for scenario in scenarios:
+            random.seed(options['seed'])
+            try:
+                with transaction.atomic():
+                    game = benchmark.build_game(scenario,
+                        players=options['players'],
+                        density=options['density'])
+                    checks += benchmark.run_maps(game, recorder,
+                        golden_dir=options['golden'],
+                        threshold=options['threshold'],
+                        update=options['update_golden'])
+                    raise Rollback
+            except Rollback:
+                pass
+        result = {
+            'scenarios': options['scenario'],
+            'tokens': options['tokens'],
+            'players': options['players'],
+            'density': options['density'],
+            'seed': options['seed'],
+            'summary': recorder.summary(),
+            'steps': recorder.results,
+            'golden': checks,
+        }
+        data = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            self.stdout.write("Results saved in %s\n" % options['output'])
+        else:
+            self.stdout.write(data)
+        failed = [c for c in checks if c['passed'] is False]
+        if failed:
+            raise CommandError("%s maps differ from the golden images" % len(failed))
@@ -0,0 +1,93 @@
+import json
+import random
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from condottieri_scenarios.models import Scenario
+
+from machiavelli import benchmark
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    """
+Builds a synthetic game, gives random orders and measures the processing of each phase
+and each step. The game is created inside a transaction that is rolled back at the end.
+    """
+
+    help = """ Benchmarks the turn processing with a synthetic game in the given scenario
+    and writes the results as JSON. """
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', type=str, help='Name of the scenario')
+        parser.add_argument('--players', type=int, default=None,
+            help='Number of players (default: all the countries)')
+        parser.add_argument('--density', type=float, default=0.0,
+            help='Fraction of the empty areas where an extra unit is placed')
+        parser.add_argument('--turns', type=int, default=12,
+            help='Number of phases to process')
+        parser.add_argument('--rules', type=str, default='',
+            help='Comma separated optional rules: %s' % ', '.join(benchmark.RULES))
+        parser.add_argument('--maps', action='store_true', default=False,
+            help='Draw the maps')
+        parser.add_argument('--seed', type=int, default=None,
+            help='Seed for the random orders')
+        parser.add_argument('--label', type=str, default='',
+            help='Label of this run, e.g. the name of the branch')
+        parser.add_argument('--output', type=str, default='',
+            help='Path of the JSON file (default: standard output)')
+        parser.add_argument('--keep', action='store_true', default=False,
+            help='Keep the synthetic game in the database')
+
+    def handle(self, *args, **options):
+        try:
+            scenario = Scenario.objects.get(name=options['scenario'])
+        except Scenario.DoesNotExist:
+            raise CommandError("Scenario %s does not exist" % options['scenario'])
+        rules = [r for r in options['rules'].split(',') if r != '']
+        for r in rules:
+            if not r in benchmark.RULES:
+                raise CommandError("Unknown rule %s" % r)
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+        try:
+            with transaction.atomic():
+                game = benchmark.build_game(scenario,
+                    players=options['players'],
+                    density=options['density'],
+                    rules=rules,
+                    maps=options['maps'])
+                recorder = benchmark.run(game, options['turns'])
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            pass
+        result = {
+            'label': options['label'] or self.get_revision(),
+            'scenario': options['scenario'],
+            'players': options['players'],
+            'density': options['density'],
+            'turns': options['turns'],
+            'rules': rules,
+            'maps': options['maps'],
+            'seed': options['seed'],
+            'summary': recorder.summary(),
+            'steps': recorder.results,
+        }
+        data = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            self.stdout.write("Results saved in %s\n" % options['output'])
+        else:
+            self.stdout.write(data)
+
+    def get_revision(self):
+        """ Returns the current git revision, if any """
+        try:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip().decode()
+        except Exception:
+            return ''
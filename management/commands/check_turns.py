@@ -7,6 +7,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from machiavelli import models
+from machiavelli import scheduler
 
 class Command(BaseCommand):
 	"""
@@ -17,32 +18,24 @@ when all the players have finished OR the time limit is exceeded
 	help = 'This script checks in every active game if the current turn must change. \
 	This happens either when all the players have finished OR the time limit is exceeded.'
 
-	def handle_noargs(self, **options):
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=None,
+			help='Number of worker processes (default: TURN_WORKERS setting, or 1)')
+		parser.add_argument('--priority', choices=sorted(scheduler.PRIORITIES.keys()),
+			default='fast',
+			help='Order of the games: fast games first, or earliest deadline first')
+
+	def handle(self, *args, **options):
 		self.stdout.write("Checking phase changes.")
 		if settings.MAINTENANCE_MODE:
 			logger.warning("App is in maintenance mode. Exiting.")
 			self.stderr.write("App is in maintenance mode. Exiting.")
 			return
-		games = models.LiveGame.objects.filter(fast=False, paused=False)
-		for g in games:
-			self.stdout.write("Checking game %s" % g.slug)
-			try:
-				g.check_finished_phase()
-			except Exception as e:
-				msg = "Error while checking if phase is finished in game %s\n\n" % g.pk
-				logger.error(msg)
-				logger.error(e)
-				self.stderr.write(msg)
-				self.stderr.write(e)
-				continue
-		fast_games = models.LiveGame.objects.filter(fast=True, paused=False)
-		for game in fast_games:
-			try:
-				game.check_finished_phase()
-			except Exception as e:
-				self.stderr.write("Error while checking if phase is finished in game %s\n\n" % game.pk)
-				self.stderr.write(e)
-				continue
+		## only the games where all the players are done or the deadline has
+		## been reached are checked
+		errors = scheduler.run(workers=options['workers'], priority=options['priority'])
+		for game_id, msg in errors:
+			self.stderr.write(msg)
 		## check for fast games that have not yet started and are older than
 		## one hour
 		fast_games = models.Game.objects.filter(slots__gt=0, fast=True)
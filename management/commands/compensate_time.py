@@ -43,6 +43,7 @@ to compensate downtime periods.
                 t = current + tplus
                 g.last_phase_change = t
                 g.save()
+                g.update_deadline()
             except:
                 self.stderr.write("ERROR: Could not change time of game %s\n" % g.slug)
             else:
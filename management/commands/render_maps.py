@@ -0,0 +1,54 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+import logging
+logger = logging.getLogger(__name__)
+
+from machiavelli.models import RenderJob
+
+class Command(BaseCommand):
+    """
+Makes the maps that have been queued by the games when ASYNC_MAP_RENDERING is True. The maps
+of fast games are made first. A map that cannot be made is tried again after RENDER_JOB_BACKOFF
+seconds, doubled after each failure, and the game is paused after RENDER_JOB_ATTEMPTS failures.
+    """
+
+    help = """ Makes the queued maps. By default, it keeps waiting for new jobs; with --once,
+    it exits when the queue is empty. """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Exit when there are no more jobs',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2.0,
+            help='Seconds to wait when the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            ## the jobs that failed wait until their retry time
+            ready = Q(retry_after__isnull=True) | Q(retry_after__lte=datetime.now())
+            jobs = RenderJob.objects.filter(ready).select_related('game').order_by('-game__fast', 'requested')
+            done = 0
+            for job in jobs:
+                try:
+                    if job.run():
+                        done += 1
+                        self.stdout.write("Map made for game %s\n" % job.game.slug)
+                except Exception as e:
+                    ## an unexpected error must not stop the other jobs
+                    logger.error("Error while making the map of game %s: %s" % (job.game_id, e))
+                    self.stderr.write("Error while making the map of game %s\n" % job.game_id)
+            if done == 0:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
@@ -0,0 +1,188 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the store of rendered maps.
+
+Each rendered map is saved once in the ``store`` directory of the game, with
+the hash of everything drawn on it as file name. The map names given by
+``Game.get_map_name`` are symbolic links to the stored files, so that a board
+that has not changed since the last phase is not rendered again.
+
+The stored files that no map name links to any more are deleted by
+``collect_garbage``, with the tiles that only they used.
+"""
+
+import json
+import os
+import os.path
+import shutil
+import time
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "store"
+
+def get_store_dir(game):
+	return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug, STORE_DIR)
+
+def get_path(game, key, ext="jpg"):
+	""" Returns the absolute path of the stored map ``key`` """
+	return os.path.join(get_store_dir(game), "%s.%s" % (key, ext))
+
+def exists(game, key, ext="jpg"):
+	return os.path.exists(get_path(game, key, ext))
+
+def link(game, key, filename, ext="jpg"):
+	""" Makes ``filename`` point to the stored map ``key`` """
+	target = get_path(game, key, ext)
+	d = os.path.dirname(filename)
+	if not os.path.exists(d):
+		os.makedirs(d)
+	tmp = "%s.%s.tmp" % (filename, os.getpid())
+	try:
+		os.symlink(os.path.relpath(target, d), tmp)
+	except (OSError, NotImplementedError, AttributeError):
+		## symbolic links are not available, copy the file and write the
+		## key next to it, so that the stored map can still be found
+		shutil.copyfile(target, tmp)
+		key_tmp = "%s.%s.key.tmp" % (filename, os.getpid())
+		with open(key_tmp, 'w') as f:
+			f.write(key)
+		os.replace(key_tmp, get_key_path(filename))
+	os.replace(tmp, filename)
+
+def get_key_path(filename):
+	return "%s.key" % filename
+
+def get_key(filename):
+	""" Returns the key of the stored map that ``filename`` points to, or
+	None if it is not a link to the store """
+	if os.path.islink(filename):
+		return os.path.splitext(os.path.basename(os.readlink(filename)))[0]
+	try:
+		with open(get_key_path(filename)) as f:
+			return f.read().strip() or None
+	except (IOError, OSError):
+		return None
+
+def get_store_url(game, key, ext="jpg"):
+	return os.path.join(settings.MEDIA_URL, settings.MAPS_ROOT, game.slug,
+		STORE_DIR, "%s.%s" % (key, ext))
+
+def get_latest_path(game, player=None, ext="jpg"):
+	""" Returns the path of the link to the latest map made for ``player``,
+	which is shown while the map of the current phase is being made """
+	if player is None:
+		name = "latest.%s" % ext
+	else:
+		name = "latest-%s.%s" % (player.secret_key, ext)
+	return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug, name)
+
+def get_url(game, path):
+	""" Returns the url of the map in ``path``. If it is a link to a stored
+	map, returns the url of the stored map """
+	key = get_key(path)
+	if key is not None:
+		return get_store_url(game, key, os.path.splitext(path)[1][1:])
+	return os.path.join(settings.MEDIA_URL,
+		os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/'))
+
+def unlink(filename):
+	""" Removes the map name ``filename``. The stored map is removed later by
+	``collect_garbage`` if nothing else links to it """
+	for path in (filename, get_key_path(filename)):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
+def get_maps_dir(game):
+	return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug)
+
+def get_linked_keys(game):
+	""" Returns the set of keys that the map names, the latest maps and the
+	thumbnails of the game link to """
+	keys = set()
+	maps_dir = get_maps_dir(game)
+	for d in (maps_dir, os.path.join(maps_dir, "thumb")):
+		if not os.path.isdir(d):
+			continue
+		for name in os.listdir(d):
+			path = os.path.join(d, name)
+			if name.endswith(".key") or os.path.isdir(path):
+				continue
+			key = get_key(path)
+			if key is not None:
+				keys.add(key)
+	return keys
+
+def collect_garbage(game, grace=None):
+	""" Deletes the stored maps, thumbnails, tile indexes and tiles that are
+	not linked any more. Files modified in the last ``grace`` seconds
+	(MAP_STORE_GRACE by default) are kept, because they may be waiting to be
+	linked by a map that is being made. Returns the number of files deleted """
+	if grace is None:
+		grace = getattr(settings, 'MAP_STORE_GRACE', 60*10)
+	store_dir = get_store_dir(game)
+	if not os.path.isdir(store_dir):
+		return 0
+	limit = time.time() - grace
+	keys = get_linked_keys(game)
+	deleted = 0
+	tiles = set()
+	for name in os.listdir(store_dir):
+		path = os.path.join(store_dir, name)
+		if name.endswith(".tmp"):
+			continue
+		if name.split(".", 1)[0] in keys or os.path.getmtime(path) > limit:
+			if name.endswith(".tiles.json") and tiles is not None:
+				try:
+					with open(path) as f:
+						for level in json.load(f)['levels']:
+							for row in level['tiles']:
+								tiles.update(row)
+				except (IOError, OSError, ValueError, KeyError, TypeError):
+					logger.error("Can't read the tile index %s" % path)
+					## the tiles used by this index are not known, keep them all
+					tiles = None
+			continue
+		if remove(path):
+			deleted += 1
+	## the tiles are named by their content and shared by the maps
+	tiles_dir = os.path.join(get_maps_dir(game), "tiles")
+	if tiles is not None and os.path.isdir(tiles_dir):
+		for name in os.listdir(tiles_dir):
+			path = os.path.join(tiles_dir, name)
+			if name.endswith(".tmp") or name.split(".", 1)[0] in tiles:
+				continue
+			if os.path.getmtime(path) > limit:
+				continue
+			if remove(path):
+				deleted += 1
+	return deleted
+
+def remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		logger.error("Can't delete stored map %s" % path)
+		return False
+	return True
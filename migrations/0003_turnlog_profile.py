@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.24 on 2026-10-17 10:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machiavelli', '0002_auto_20190910_1959'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='turnlog',
+            name='profile',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.24 on 2026-10-17 10:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machiavelli', '0003_turnlog_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='all_done',
+            field=models.BooleanField(default=False, editable=False, verbose_name='all players done'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='next_deadline',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='next deadline'),
+        ),
+    ]
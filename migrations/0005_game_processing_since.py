@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.24 on 2026-10-17 11:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machiavelli', '0004_game_deadline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='processing_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='processing since'),
+        ),
+    ]
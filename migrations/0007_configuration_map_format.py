@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.24 on 2026-10-17 13:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import machiavelli.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machiavelli', '0006_renderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='map_format',
+            field=models.CharField(choices=[('raster', 'Image'), ('vector', 'Vector (drawn by the browser)')], default=machiavelli.models.get_default_map_format, max_length=6, verbose_name='map format'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.24 on 2026-10-17 14:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machiavelli', '0007_configuration_map_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -58,6 +58,18 @@ else:
 
 ## machiavelli
 from machiavelli.graphics import make_map
+import machiavelli.graphics as graphics
+import machiavelli.adjudication as adjudication
+import machiavelli.adjacency as adjacency
+import machiavelli.convoys as convoys
+import machiavelli.strategic as strategic
+import machiavelli.retreats as retreats
+import machiavelli.instrumentation as instrumentation
+import machiavelli.mapstore as mapstore
+import machiavelli.tiles as tiles
+import machiavelli.income as income
+import machiavelli.expenses as expenses
+import machiavelli.routes as routes
 import machiavelli.dice as dice
 import machiavelli.disasters as disasters
 import machiavelli.exceptions as exceptions
@@ -213,6 +225,17 @@ class Game(models.Model):
                 default=get_default_version)
         extended_deadline = models.BooleanField(_("extended deadline"),
                 default=False)
+        ## the time of the next compulsory phase change and whether all the
+        ## players are done. They are kept by update_deadline() so that
+        ## check_turns only loads the games that are due
+        next_deadline = models.DateTimeField(_("next deadline"), blank=True,
+                null=True, editable=False, db_index=True)
+        all_done = models.BooleanField(_("all players done"), default=False,
+                editable=False)
+        ## when a worker started checking the phase, so that two workers never
+        ## process the same game
+        processing_since = models.DateTimeField(_("processing since"),
+                blank=True, null=True, editable=False)
         """ if teams < 2, there will be no teams """
         teams = models.PositiveIntegerField(_("teams"), default=0)
 
@@ -324,10 +347,32 @@ class Game(models.Model):
         ## map methods
         ##------------------------
         
+        @instrumentation.measured
         def make_map(self, fow=False):
                 make_map(self, fow)
                 return True
 
+        def update_map(self):
+                """ Makes the map of the current phase. If ASYNC_MAP_RENDERING is True,
+                the map is queued to be made by the render_maps command.
+                """
+                if getattr(settings, 'ASYNC_MAP_RENDERING', False):
+                        RenderJob.objects.update_or_create(game=self,
+                                defaults={'requested': datetime.now()})
+                else:
+                        try:
+                                self.make_map(fow=self.configuration.fow)
+                        except exceptions.GraphicsError:
+                                self.pause_for_graphics_error()
+
+        def pause_for_graphics_error(self):
+                logger.error("Pausing the game %s" % self)
+                self.paused = True
+                self.save()
+                msg = "Game %s has been paused due to a graphics error." % self.slug
+                report = ErrorReport(game=self, user=self.created_by, description=msg)
+                report.save()
+
         def map_changed(self):
                 if self.map_outdated == False:
                         self.map_outdated = True
@@ -338,16 +383,23 @@ class Game(models.Model):
                         self.map_outdated = False
                         self.save()
 
-        def get_map_name(self, player=None):
+        def get_map_extension(self):
+                if self.configuration.map_format == 'vector':
+                        return "svg"
+                return "jpg"
+
+        def get_map_name(self, player=None, ext=None):
+                if ext is None:
+                        ext = self.get_map_extension()
                 if self.finished:
-                        return "%s_final.jpg" % self.id
+                        return "%s_final.%s" % (self.id, ext)
                 elif not self.configuration.fow:
-                        return "%s_%s_%s_%s.jpg" % (self.id, self.year, self.season,
-                                self.phase)
+                        return "%s_%s_%s_%s.%s" % (self.id, self.year, self.season,
+                                self.phase, ext)
                 else: #fow is enabled
                         if isinstance(player, Player):
-                                return "%s_%s_%s_%s.jpg" % (player.secret_key, self.year,
-                                        self.season, self.phase)
+                                return "%s_%s_%s_%s.%s" % (player.secret_key, self.year,
+                                        self.season, self.phase, ext)
                         else:
                                 return "" ## show scenario map
 
@@ -360,17 +412,47 @@ class Game(models.Model):
                         return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT,
                                 self.slug, name)
 
+        def get_current_map_path(self, player=None):
+                """ returns the path of the map of the current phase or, if it is
+                still being made, the path of the latest map. Returns None if
+                there is no map of the game """
+                if self.get_map_name(player) == "":
+                        return None
+                path = self.get_map_path(player)
+                if not os.path.exists(path):
+                        path = mapstore.get_latest_path(self, player,
+                                self.get_map_extension())
+                        if not os.path.exists(path):
+                                return None
+                return path
+
         def get_map_url(self, player=None):
-                """ returns the relative url of the map file """
-                name = self.get_map_name(player)
-                if name == "":
+                """ returns the relative url of the map file. If the map is still
+                being made, returns the url of the latest map """
+                path = self.get_current_map_path(player)
+                if path is None:
                         return self.scenario.map_url
-                else:
-                        return os.path.join(settings.MEDIA_URL, settings.MAPS_ROOT,
-                                self.slug, name)
+                return mapstore.get_url(self, path)
+
+        def get_map_webp_url(self, player=None):
+                """ returns the url of the WebP copy of the map, or None if the map
+                has no WebP copy """
+                path = self.get_current_map_path(player)
+                if path is None:
+                        return None
+                key = mapstore.get_key(path)
+                if key is None or not mapstore.exists(self, key, "webp"):
+                        return None
+                return mapstore.get_store_url(self, key, "webp")
+
+        def get_map_tiles_url(self, player=None):
+                """ returns the url of the tile index of the map, or None if the map
+                has no tiles """
+                return tiles.get_index_url(self, player)
 
         def _get_thumbnail_path(self):
-                name = self.get_map_name()
+                ## thumbnails are always raster images
+                name = self.get_map_name(ext="jpg")
                 if name == "" or not self.started:
                         return self.scenario.thumbnail_path
                 else:
@@ -380,22 +462,22 @@ class Game(models.Model):
         thumbnail_path = property(_get_thumbnail_path)
 
         def _get_thumbnail_url(self):
-                name = self.get_map_name()
+                name = self.get_map_name(ext="jpg")
                 if name == "" or not self.started:
                         return self.scenario.thumbnail_url
                 else:
-                        return os.path.join(settings.MEDIA_URL, settings.MAPS_ROOT,
-                                self.slug, "thumb", name)
+                        path = self.thumbnail_path
+                        if not os.path.exists(path):
+                                return self.scenario.thumbnail_url
+                        return mapstore.get_url(self, path)
         
         thumbnail_url = property(_get_thumbnail_url)
 
         def remove_private_maps(self):
+                """ Removes the names of the maps of the current phase in games with
+                fog of war """
                 for p in self.player_set.filter(user__isnull=False):
-                        path = self.get_map_path(p)
-                        try:
-                                os.remove(path)
-                        except:
-                                logger.error("Can't delete map %s" % path)
+                        mapstore.unlink(self.get_map_path(p))
 
         ##------------------------
         ## game starting methods
@@ -431,15 +513,8 @@ class Game(models.Model):
                 self.last_phase_change = datetime.now()
                 self.notify_players("game_started", {"game": self})
                 self.save()
-                try:
-                        self.make_map(fow=self.configuration.fow)
-                except exceptions.GraphicsError:
-                        logger.error("Pausing the game %s" % self)
-                        self.paused = True
-                        self.save()
-                        msg = "Game %s has been paused due to a graphics error." % self.slug
-                        report = ErrorReport(game=self, user=self.created_by, description=msg)
-                        report.save()
+                self.update_deadline()
+                self.update_map()
 
         def player_joined(self):
                 self.slots -= 1
@@ -515,6 +590,16 @@ class Game(models.Model):
                         p.save()
                         i += 1
 
+        def get_adjacency(self):
+                """ Returns the AdjacencyIndex of the game setting """
+                return adjacency.get_index(self.scenario.setting_id)
+
+        def get_convoy_resolver(self):
+                """ Returns the ConvoyResolver of the turn being processed """
+                if getattr(self, '_convoy_resolver', None) is None:
+                        self._convoy_resolver = convoys.ConvoyResolver.for_game(self)
+                return self._convoy_resolver
+
         def get_disabled_areas(self):
                 """ Returns the disabled Areas in the game scenario """
                 enabled = self.gamearea_set.values_list('board_area', flat=True)
@@ -650,8 +735,39 @@ class Game(models.Model):
                 duration = timedelta(0, time_limit)
 
                 return self.last_phase_change + duration
+
+        def update_deadline(self):
+                """ Saves the time of the next compulsory phase change and whether
+                all the players are done. This method must be called whenever any of
+                them may change: a player ends the phase, the karma of a player changes
+                or the phase changes.
+                """
+                if self.started is None or self.finished or self.phase == PHINACTIVE:
+                        deadline = None
+                else:
+                        deadline = self.next_phase_change()
+                all_done = not self.player_set.filter(done=False).exists()
+                Game.objects.filter(pk=self.pk).update(next_deadline=deadline,
+                                                                                all_done=all_done)
+                self.next_deadline = deadline
+                self.all_done = all_done
         
 
+        def claim_processing(self):
+                """ Marks the game as being processed and reloads it, so that it is
+                never checked with the state it had before another worker processed
+                it. Returns False if another worker is already processing it. A claim
+                older than TURN_PROCESSING_TIMEOUT seconds is considered abandoned.
+                """
+                if not Game.objects.filter(pk=self.pk).claim():
+                        return False
+                self.refresh_from_db()
+                return True
+
+        def release_processing(self):
+                Game.objects.filter(pk=self.pk).update(processing_since=None)
+                self.processing_since = None
+
         def force_phase_change(self):
                 """ When the time limit is reached and one or more of the players are
                 not done, if game is not in extended deadline, make extended_deadline
@@ -664,6 +780,7 @@ class Game(models.Model):
                         for p in self.player_set.all():
                                 if not p.done:
                                         p.check_revolution()
+                        self.update_deadline()
                 else: #game in extended deadline
                         for p in self.player_set.all():
                                 if not p.done:
@@ -696,11 +813,25 @@ class Game(models.Model):
                 for p in players:
                         if not p.done:
                                 msg += "At least a player is not done.\n"
+                                self.update_deadline()
                                 return False
                 msg += "All players done.\n"
                 if logging:
                         logger.info(msg)
-                self.process_turn()
+                turn = (self.year, self.season, self.phase)
+                with instrumentation.Profile() as profile:
+                        self.process_turn()
+                if getattr(settings, 'SAVE_TURN_PROFILE', False):
+                        ## keep the measures of the steps with the log of the turn.
+                        ## Only process_orders writes a log, so the other phases
+                        ## get a row with an empty log
+                        turn_log = TurnLog.objects.filter(game=self, year=turn[0],
+                                season=turn[1], phase=turn[2]).first()
+                        if turn_log is None:
+                                turn_log = TurnLog(game=self, year=turn[0], season=turn[1],
+                                        phase=turn[2], log='')
+                        turn_log.profile = profile.as_json()
+                        turn_log.save()
                 self.clear_phase_cache()
                 ## If I don't reload players, p.new_phase overwrite the changes made by
                 ## self.assign_incomes()
@@ -708,6 +839,7 @@ class Game(models.Model):
                 players = self.player_set.all()
                 for p in players:
                         p.new_phase()
+                self.update_deadline()
 
         
         def check_bonus_time(self):
@@ -741,10 +873,13 @@ class Game(models.Model):
                 Unit.objects.filter(player__game=self).update(must_retreat='')
                 GameArea.objects.filter(game=self).update(standoff=False)
 
+        @instrumentation.measured
         def process_turn(self):
                 ## remove current private maps in games with Fog of War
                 if self.configuration.fow:
                         self.remove_private_maps()
+                ## delete the stored maps that are not linked any more
+                mapstore.collect_garbage(self)
                 ##
                 end_season = False
                 if self.phase == PHINACTIVE:
@@ -795,9 +930,7 @@ class Game(models.Model):
                         if self.season == 1:
                                 ## delete units in famine areas
                                 if self.configuration.famine:
-                                        famine_units = Unit.objects.filter(player__game=self, area__famine=True)
-                                        for f in famine_units:
-                                                f.delete()
+                                        disasters.delete_units(Unit.objects.filter(player__game=self, area__famine=True))
                                         ## reset famine markers
                                         self.gamearea_set.all().update(famine=False)
                                         ## check plagues
@@ -808,9 +941,7 @@ class Game(models.Model):
                         elif self.season == 3:
                                 ## if storms are enabled, delete fleets in storm areas
                                 if self.configuration.storms:
-                                        storm_units = Unit.objects.filter(player__game=self, area__storm=True)
-                                        for f in storm_units:
-                                                f.delete()
+                                        disasters.delete_units(Unit.objects.filter(player__game=self, area__storm=True))
                                         ## reset storm markers
                                         self.gamearea_set.all().update(storm=False)
                                 ## check if any users are eliminated
@@ -844,13 +975,14 @@ class Game(models.Model):
                                         signals.famine_marker_placed.send(sender=t)
                                 self.gamearea_set.all().update(taxed=False)
                         ## check which trade routes are safe
+                        evaluator = None
                         if self.scenario.setting.configuration.trade_routes:
-                                for r in self.gameroute_set.all():
-                                        r.update_status()
+                                evaluator = routes.RouteEvaluator(self)
+                                evaluator.update()
                         ## if finances are enabled, assign incomes
                         ## this has been moved after taxation famines
                         if self.season == 3 and self.configuration.finances:
-                                self.assign_incomes()
+                                self.assign_incomes(evaluator)
                         ## reset assassinations, and the pope can excommunicate again
                         self.player_set.all().update(assassinated=False, has_sentenced=False)
                         self._next_season()
@@ -875,16 +1007,7 @@ class Game(models.Model):
                 #self.map_changed()
                 self.extended_deadline = False
                 self.save()
-                ##TODO: Catch errors in make_map
-                try:
-                        self.make_map(fow=self.configuration.fow)
-                except exceptions.GraphicsError:
-                        logger.error("Pausing the game %s" % self)
-                        self.paused = True
-                        self.save()
-                        msg = "Game %s has been paused due to a graphics error." % self.slug
-                        report = ErrorReport(game=self, user=self.created_by, description=msg)
-                        report.save()
+                self.update_map()
                 if end_season and self.configuration.fow:
                         for dip in Diplomat.objects.filter(player__game=self):
                                 dip.uncover()
@@ -952,48 +1075,27 @@ class Game(models.Model):
         def mark_famine_areas(self):
                 if not self.configuration.famine:
                         return
-                #codes = disasters.get_famine()
-                year = disasters.get_year()
-                row = disasters.get_row(year)
-                column = disasters.get_column(year)
-                codes = FamineCell.objects.roll(self.scenario.setting, row, column).values_list('area__code', flat=True)
-                famine_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
-                for f in famine_areas:
-                        print(f)
-                        f.famine=True
-                        f.save()
-                        signals.famine_marker_placed.send(sender=f)
+                famine_areas = disasters.roll_areas(self, 'famine')
+                disasters.mark_areas(famine_areas, 'famine', signals.famine_marker_placed)
         
         def mark_storm_areas(self):
                 if not self.configuration.storms:
                         return
-                #codes = disasters.get_storms()
-                year = disasters.get_year()
-                row = disasters.get_row(year)
-                column = disasters.get_column(year)
-                codes = StormCell.objects.roll(self.scenario.setting, row, column).values_list('area__code', flat=True)
-                storm_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
-                for f in storm_areas:
-                        f.storm=True
-                        f.save()
-                        signals.storm_marker_placed.send(sender=f)
+                storm_areas = disasters.roll_areas(self, 'storm')
+                disasters.mark_areas(storm_areas, 'storm', signals.storm_marker_placed)
         
         def kill_plague_units(self):
                 if not self.configuration.plague:
                         return
-                #codes = disasters.get_plague()
-                year = disasters.get_year()
-                row = disasters.get_row(year)
-                column = disasters.get_column(year)
-                codes = PlagueCell.objects.roll(self.scenario.setting, row, column).values_list('area__code', flat=True)
-                plague_areas = GameArea.objects.filter(game=self, board_area__code__in=codes)
-                for p in plague_areas:
-                        signals.plague_placed.send(sender=p)
-                        for u in p.unit_set.all():
-                                u.delete()
-
-        def assign_incomes(self):
-                """ Gets each player's income and add it to the player's treasury """
+                plague_areas = disasters.roll_areas(self, 'plague')
+                disasters.strike_areas(plague_areas, signals.plague_placed)
+
+        @instrumentation.measured
+        def assign_incomes(self, evaluator=None):
+                """ Gets each player's income and add it to the player's treasury.
+                ``evaluator`` is the RouteEvaluator that has just updated the trade
+                routes, if any. Returns the ``IncomeBreakdown`` of each player, keyed
+                by player id """
                 ## get the column for variable income
                 die = dice.roll_1d6()
                 if logging:
@@ -1001,13 +1103,9 @@ class Game(models.Model):
                         logger.info(msg)
                 ## get a list of the ids of the major cities that generate income
                 majors = self.scenario.major_cities
-                majors_ids = majors.values_list('city', flat=True)
-                ##
-                players = self.player_set.filter(user__isnull=False, eliminated=False)
-                for p in players:
-                        i = p.get_income(die, majors_ids)
-                        if i > 0:
-                                p.add_ducats(i)
+                majors_ids = list(majors.values_list('city', flat=True))
+                ## the income of all the players is computed at once
+                return income.assign_incomes(self, die, majors_ids, evaluator)
 
         def check_credits(self):
                 """ Check if any credits have exceeded their terms. If so, apply the
@@ -1024,64 +1122,11 @@ class Game(models.Model):
                                         credit.player.save()
                                         credit.player.assassinate()
         
+        @instrumentation.measured
         def process_expenses(self):
-                ## undo unconfirmed expenses
-                invalid_expenses = Expense.objects.filter(player__game=self, confirmed=False)
-                for e in invalid_expenses:
-                        e.undo()
-                ## log expenses (ignore diplomats)
-                if signals:
-                        for e in Expense.objects.filter(player__game=self, confirmed=True).exclude(type__in=(10,11)):
-                                signals.expense_paid.send(sender=e)
-                ## then, process famine reliefs
-                for e in Expense.objects.filter(player__game=self, type=0):
-                        e.area.famine = False
-                        e.area.save()
-                ## then, delete the rebellions
-                for e in Expense.objects.filter(player__game=self, type=1):
-                        Rebellion.objects.filter(area=e.area).delete()
-                ## then, place new rebellions
-                for e in Expense.objects.filter(player__game=self, type__in=(2,3)):
-                        try:
-                                rebellion = Rebellion(area=e.area)
-                                rebellion.save()
-                        except:
-                                continue
-                ## create diplomats
-                for e in Expense.objects.filter(player__game=self, type__in=(10,11)):
-                        try:
-                                dip = Diplomat(player=e.player, area=e.area)
-                                dip.save()
-                        except:
-                                continue
-                ## then, delete bribes that are countered
-                expenses = Expense.objects.filter(player__game=self)
-                for e in expenses:
-                        if e.is_bribe():
-                                ## get the sum of counter-bribes
-                                cb = Expense.objects.filter(player__game=self, type=4, unit=e.unit).aggregate(Sum('ducats'))
-                                if not cb['ducats__sum']:
-                                        cb['ducats__sum'] = 0
-                                total_cost = get_expense_cost(e.type, e.unit) + cb['ducats__sum']
-                                if total_cost > e.ducats:
-                                        e.delete()
-                ## then, resolve the bribes for each bribed unit
-                bribed_ids = Expense.objects.filter(unit__player__game=self, type__in=(5,6,7,8,9)).values_list('unit', flat=True).distinct()
-                chosen = []
-                ## TODO: if two bribes have the same value, decide randomly between them
-                for i in bribed_ids:
-                        bribes = Expense.objects.filter(type__in=(5,6,7,8,9), unit__id=i).order_by('-ducats')
-                        chosen.append(bribes[0])
-                ## all bribes in 'chosen' are successful, and executed
-                for c in chosen:
-                        if c.type in (5, 8): #disband unit
-                                c.unit.delete()
-                        elif c.type in (6, 9): #buy unit
-                                c.unit.change_player(c.player)
-                        elif c.type == 7: #to autonomous
-                                c.unit.to_autonomous()
-                ## finally, delete all the expenses
-                Expense.objects.filter(player__game=self).delete()
+                """ Resolves the expenses of the season. All the expenses are
+                loaded at once and resolved by the expenses module """
+                expenses.process_expenses(self)
 
         def get_rebellions(self):
                 """ Returns a queryset with all the rebellions in this game """
@@ -1128,11 +1173,12 @@ class Game(models.Model):
                 """
 
                 conflict_orders = Order.objects.filter(unit__player__game=self, code__in=['-', '=']).exclude(type__exact='G')
+                adj = self.get_adjacency()
                 conflict_areas = []
                 for o in conflict_orders:
                         if o.code == '-':
-                                if o.unit.area.board_area.is_adjacent(o.destination.board_area, fleet=(o.unit.type=='F')) or \
-                                        o.find_convoy_line():
+                                if adj.is_adjacent(o.unit.area.board_area_id, o.destination.board_area_id, fleet=(o.unit.type=='F')) or \
+                                        o.find_convoy_line(self.get_convoy_resolver()):
                                                 area = o.destination
                                 else:
                                         continue
@@ -1142,12 +1188,14 @@ class Game(models.Model):
                         conflict_areas.append(area)
                 return conflict_areas
 
+        @instrumentation.measured
         def filter_supports(self):
                 """ Checks which Units with support orders are being attacked and delete their
                 orders.
                 """
 
                 conflict_areas = self.get_conflict_areas()
+                strengths = StrengthMap(self)
                 for step in (1, 2):
                         ## This for sequence is run twice.
                         ## In the first pass, all the supporting units under attack are deleted, except the ones
@@ -1176,21 +1224,24 @@ class Game(models.Model):
                                                                         info += "Support will be broken if the unit is dislodged.\n"
                                                                         continue
                                                                 elif step == 2:
-                                                                        a_unit = Unit.objects.get_with_strength(self, id=a.unit.id)
-                                                                        d_unit = Unit.objects.get_with_strength(self, id=s.unit.id)
+                                                                        a_unit = Unit.objects.get_with_strength(self, strengths, id=a.unit.id)
+                                                                        d_unit = Unit.objects.get_with_strength(self, strengths, id=s.unit.id)
                                                                         if a_unit.strength > d_unit.strength:
                                                                                 info += "Attack from %s breaks support (unit dislodged).\n" % a_unit
                                                                                 signals.support_broken.send(sender=s.unit)
+                                                                                strengths.remove_order(s.unit_id)
                                                                                 s.delete()
                                                                                 break
                                                         else:
                                                                 if step == 1:
                                                                         info += "Attack from %s breaks support.\n" % a.unit
                                                                         signals.support_broken.send(sender=s.unit)
+                                                                        strengths.remove_order(s.unit_id)
                                                                         s.delete()
                                                                         break
                 return info
 
+        @instrumentation.measured
         def filter_convoys(self):
                 """ Checks which Units with C orders are being attacked. Checks if they
                 are going to be defeated, and if so, delete the C order. However, it
@@ -1205,6 +1256,7 @@ class Game(models.Model):
                                                                                         (Q(order__code__exact='=') &
                                                                                         Q(area__board_area__mixed=True) &
                                                                                         Q(type__exact='G')))
+                strengths = StrengthMap(self)
                 for s in sea_attackers:
                         order = s.get_order()
                         try:
@@ -1224,17 +1276,20 @@ class Game(models.Model):
                                 continue
                         else:
                                 info += "Convoying %s is being attacked by %s.\n" % (defender, s)
-                                a_strength = Unit.objects.get_with_strength(self, id=s.id).strength
-                                d_strength = Unit.objects.get_with_strength(self, id=defender.id).strength
+                                a_strength = strengths.get_strength(s)
+                                d_strength = strengths.get_strength(defender)
                                 if a_strength > d_strength:
                                         d_order = defender.get_order()
                                         if d_order:
                                                 info += "%s can't convoy.\n" % defender
+                                                strengths.remove_order(defender.id)
+                                                self.get_convoy_resolver().remove_order(d_order.id)
                                                 defender.delete_order()
                                         else:
                                                 continue
                 return info
         
+        @instrumentation.measured
         def filter_unreachable_attacks(self):
                 """ Delete the orders of units trying to go to non-adjacent areas and not
                 having a convoy line.
@@ -1242,18 +1297,20 @@ class Game(models.Model):
 
                 info = "Step 4: Cancel attacks to unreachable areas.\n"
                 attackers = Order.objects.filter(unit__player__game=self, code__exact='-')
+                adj = self.get_adjacency()
                 for o in attackers:
                         is_fleet = (o.unit.type == 'F')
-                        if not o.unit.area.board_area.is_adjacent(o.destination.board_area, is_fleet):
+                        if not adj.is_adjacent(o.unit.area.board_area_id, o.destination.board_area_id, is_fleet):
                                 if is_fleet:
                                         info += "Impossible attack: %s.\n" % o
                                         o.delete()
                                 else:
-                                        if not o.find_convoy_line():
+                                        if not o.find_convoy_line(self.get_convoy_resolver()):
                                                 info += "Impossible attack: %s.\n" % o
                                                 o.delete()
                 return info
         
+        @instrumentation.measured
         def resolve_auto_garrisons(self):
                 """ Units with '= G' orders in areas without a garrison, convert into garrison.
                 """
@@ -1281,6 +1338,7 @@ class Game(models.Model):
                                 info += "Fail: there is a garrison in the city.\n"
                 return info
 
+        @instrumentation.measured
         def resolve_conflicts(self):
                 """ Conflict: When two or more units want to occupy the same area.
                 
@@ -1291,7 +1349,8 @@ class Game(models.Model):
                 ## units sorted (reverse) by a temporary strength attribute
                 ## strength = 1 means unit without supports
                 info = "Step 5: Process conflicts.\n"
-                units = Unit.objects.list_with_strength(self)
+                strengths = StrengthMap(self)
+                units = Unit.objects.list_with_strength(self, strengths)
                 conditioned_invasions = []
                 conditioned_origins = []
                 finances = self.configuration.finances
@@ -1331,7 +1390,7 @@ class Game(models.Model):
                         ## standoff.
                         ## if not, check for defenders
                         for r in rivals:
-                                strength = Unit.objects.get_with_strength(self, id=r.id).strength
+                                strength = strengths.get_strength(r)
                                 info += "Rival %s has strength %s.\n" % (r, strength)
                                 if strength >= s: #in fact, strength cannot be greater
                                         info += "Rival wins.\n"
@@ -1340,13 +1399,16 @@ class Game(models.Model):
                                 else:
                                         ## the rival is defeated and loses its orders
                                         info += "Deleting order of %s.\n" % r
+                                        strengths.remove_order(r.id)
                                         r.delete_order()
                         ## if there is a standoff, delete the order and all rivals' orders
                         if standoff:
                                 conflict_area.mark_as_standoff()
                                 info += "Standoff in %s.\n" % conflict_area
                                 for r in rivals:
+                                        strengths.remove_order(r.id)
                                         r.delete_order()
+                                strengths.remove_order(u.id)
                                 u.delete_order()
                                 continue
                         ## if there is no standoff, rivals allow the unit to enter the area
@@ -1360,8 +1422,7 @@ class Game(models.Model):
                                                 strength = s
                                                 info += "Defender is a friend.\n"
                                         else:
-                                                strength = Unit.objects.get_with_strength(self,
-                                                                                                                id=defender.id).strength
+                                                strength = strengths.get_strength(defender)
                                         info += "Defender %s has strength %s.\n" % (defender, strength)
                                         ## if attacker is not as strong as defender
                                         if strength >= s:
@@ -1393,6 +1454,7 @@ class Game(models.Model):
                                                 elif u_order.code == '=':
                                                         info += "Converting into %s.\n" % u_order.type
                                                         u.convert(u_order.type)
+                                                strengths.remove_order(defender.id)
                                                 defender.delete_order()
                                 ## no defender means either that the area is empty *OR*
                                 ## that there is a unit trying to leave the area
@@ -1498,6 +1560,7 @@ class Game(models.Model):
                 info += "End of conflicts processing"
                 return info
 
+        @instrumentation.measured
         def resolve_sieges(self):
                 ## get units that are besieging but do not besiege a second time
                 info = "Step 6: Process sieges.\n"
@@ -1573,9 +1636,11 @@ class Game(models.Model):
                         b.delete_order()
                 return info
         
+        @instrumentation.measured
         def announce_retreats(self):
                 info = "Step 7: Retreats\n"
                 retreating = Unit.objects.filter(player__game=self).exclude(must_retreat__exact='')
+                options, disbanded = retreats.load_plan(self)
                 for u in retreating:
                         info += "%s must retreat.\n" % u
                         if signals:
@@ -1583,11 +1648,13 @@ class Game(models.Model):
                         else:
                                 self.log_event(UnitEvent, type=u.type, area=u.area.board_area, message=1)
                         ## if the unit has no possible retreat, disband it
-                        options = u.get_possible_retreats().count()
-                        if options == 0:
+                        if u.id in disbanded:
                                 u.delete()
+                ## save the plan for the retreats phase
+                retreats.store_options(self, options)
                 return info
 
+        @instrumentation.measured
         def preprocess_orders(self):
                 """
                 Deletes unconfirmed orders and logs confirmed ones.
@@ -1618,6 +1685,7 @@ class Game(models.Model):
                                 info += "%s was ordered to hold\n" % o.unit
                 return info
         
+        @instrumentation.measured
         def process_orders(self):
                 """ Run a batch of methods in the correct order to process all the orders.
                 """
@@ -1626,25 +1694,31 @@ class Game(models.Model):
                 info += "------------------------------\n\n"
                 info += self.preprocess_orders()
                 info += "\n"
-                ## resolve =G that are not opposed
-                info += self.resolve_auto_garrisons()
-                info += "\n"
-                ## delete supports from units in conflict areas
-                info += self.filter_supports()
-                info += "\n"
-                ## delete convoys that will be invaded
-                info += self.filter_convoys()
-                info += "\n"
-                ## delete attacks to areas that are not reachable
-                info += self.filter_unreachable_attacks()
-                info += "\n"
-                ## process conflicts
-                info += self.resolve_conflicts()
-                info += "\n"
-                ## resolve sieges
-                info += self.resolve_sieges()
-                info += "\n"
-                info += self.announce_retreats()
+                self._convoy_resolver = None
+                if getattr(settings, 'MEMORY_ADJUDICATION', True):
+                        ## run all the steps in memory and save the results at the end
+                        info += adjudication.Adjudicator(self).process()
+                else:
+                        ## resolve =G that are not opposed
+                        info += self.resolve_auto_garrisons()
+                        info += "\n"
+                        ## delete supports from units in conflict areas
+                        info += self.filter_supports()
+                        info += "\n"
+                        ## delete convoys that will be invaded
+                        info += self.filter_convoys()
+                        info += "\n"
+                        ## delete attacks to areas that are not reachable
+                        info += self.filter_unreachable_attacks()
+                        info += "\n"
+                        ## process conflicts
+                        info += self.resolve_conflicts()
+                        info += "\n"
+                        ## resolve sieges
+                        info += self.resolve_sieges()
+                        info += "\n"
+                        info += self.announce_retreats()
+                self._convoy_resolver = None
                 info += "--- END ---\n"
                 if logging:
                         logger.info(info)
@@ -1688,6 +1762,7 @@ class Game(models.Model):
                                 o.unit.invade_area(o.area)
                 orders.delete()
 
+        @instrumentation.measured
         def update_controls(self):
                 """ Checks which GameAreas have been controlled by a Player and update them.
                 """
@@ -1732,6 +1807,7 @@ class Game(models.Model):
         ## game ending methods
         ##------------------------
 
+        @instrumentation.measured
         def check_winner(self):
                 """ Returns True if at least one player has reached the victory conditions. """
                 if self.teams > 1:
@@ -1898,6 +1974,12 @@ class Game(models.Model):
                 """ In a finished game, delete all the data that is not going to be used
                 anymore. """
 
+                ## only the final map is shown when the game is finished
+                for p in self.player_set.filter(user__isnull=False):
+                        mapstore.unlink(mapstore.get_latest_path(self, p,
+                                self.get_map_extension()))
+                mapstore.collect_garbage(self)
+                graphics.remove_layers(self)
                 self.player_set.all().delete()
                 self.gamearea_set.all().delete()
                 self.invitation_set.all().delete()
@@ -1953,6 +2035,54 @@ class LiveGame(Game):
         class Meta:
                 proxy = True
 
+class RenderJob(models.Model):
+        """ A RenderJob is a request to make the map of a game. It is used when
+        ASYNC_MAP_RENDERING is True, and run by the render_maps command.
+        """
+        game = models.OneToOneField(Game, on_delete=models.CASCADE)
+        requested = models.DateTimeField()
+        started = models.DateTimeField(blank=True, null=True)
+        attempts = models.PositiveSmallIntegerField(default=0)
+        ## a failed job is not tried again before this time
+        retry_after = models.DateTimeField(blank=True, null=True)
+
+        def __str__(self):
+                return "Render job for game %s" % self.game_id
+
+        def run(self):
+                """ Makes the map, unless another worker is already making it.
+                Returns True if the map has been made.
+                """
+                now = datetime.now()
+                timeout = getattr(settings, 'RENDER_JOB_TIMEOUT', 60*10)
+                stale = now - timedelta(0, timeout)
+                claimed = RenderJob.objects.filter(pk=self.pk).filter(
+                        Q(started__isnull=True) | Q(started__lt=stale)).update(started=now)
+                if not claimed:
+                        return False
+                game = self.game
+                try:
+                        game.make_map(fow=game.configuration.fow)
+                except exceptions.GraphicsError:
+                        attempts = self.attempts + 1
+                        if attempts >= getattr(settings, 'RENDER_JOB_ATTEMPTS', 3):
+                                game.pause_for_graphics_error()
+                                self.delete()
+                        else:
+                                ## the wait is doubled after each failure
+                                delay = getattr(settings, 'RENDER_JOB_BACKOFF', 60) * 2 ** (attempts - 1)
+                                RenderJob.objects.filter(pk=self.pk).update(started=None,
+                                        attempts=attempts,
+                                        retry_after=datetime.now() + timedelta(0, delay))
+                        return False
+                ## if the map has been requested again while it was being made,
+                ## the job is kept to make it again
+                deleted = RenderJob.objects.filter(pk=self.pk, requested__lte=now).delete()[0]
+                if not deleted:
+                        RenderJob.objects.filter(pk=self.pk).update(started=None, attempts=0,
+                                retry_after=None)
+                return True
+
 class ErrorReport(models.Model):
         """ This class defines an error report sent by a player to the staff """
         game = models.ForeignKey(Game, on_delete=models.CASCADE)
@@ -2041,11 +2171,11 @@ class GameArea(models.Model):
 
         def get_adjacent_areas(self, include_self=False):
                 """ Returns a queryset with all the adjacent GameAreas """
+                borders = adjacency.for_area(self.board_area).borders(self.board_area_id)
+                cond = Q(board_area__id__in=borders, game__id=self.game_id)
                 if include_self:
-                        cond = Q(board_area__borders=self.board_area, game=self.game) | Q(id=self.id)
-                else:
-                        cond = Q(board_area__borders=self.board_area, game=self.game)
-                adj = GameArea.objects.filter(cond).distinct()
+                        cond = cond | Q(id=self.id)
+                adj = GameArea.objects.filter(cond)
                 return adj
         
         def has_rebellion(self, player, same=True):
@@ -2146,6 +2276,17 @@ def check_min_karma(sender, instance, created, raw, **kwargs):
         
 models.signals.post_save.connect(check_min_karma, sender=CondottieriProfile)
 
+def update_karma_deadlines(sender, instance, created, raw, **kwargs):
+        """ The deadline of a game depends on the karma of its players """
+        if raw or created:
+                return
+        if isinstance(instance, CondottieriProfile):
+                games = LiveGame.objects.filter(player__user=instance.user, uses_karma=True)
+                for game in games.distinct():
+                        game.update_deadline()
+
+models.signals.post_save.connect(update_karma_deadlines, sender=CondottieriProfile)
+
 
 class Score(models.Model):
         """ This class defines the scores that a user got in a finished game. """
@@ -2284,7 +2425,8 @@ class Player(models.Model):
                         return ''
 
         def clear_phase_cache(self):
-                cache_keys = ["player-%s_log" % self.pk,]
+                cache_keys = ["player-%s_log" % self.pk,
+                        strategic.get_cache_key(self),]
                 try:
                         cache.delete_many(cache_keys)
                 except:
@@ -2428,13 +2570,12 @@ class Player(models.Model):
         def visible_areas(self):
                 """ Returns the Areas that are controlled or occupied by the player
                 or adjacent to them """
-                q = Q(gamearea__player=self) | \
-                        Q(gamearea__unit__player=self) | \
-                        Q(gamearea__diplomat__player=self) | \
-                        Q(borders__gamearea__player=self) | \
-                        Q(borders__gamearea__unit__player=self) | \
-                        Q(borders__gamearea__diplomat__player=self)
-                return Area.objects.filter(q).distinct()
+                q = Q(player=self) | \
+                        Q(unit__player=self) | \
+                        Q(diplomat__player=self)
+                ids = set(GameArea.objects.filter(q, game=self.game).values_list('board_area', flat=True))
+                ids |= self.game.get_adjacency().neighbours(ids)
+                return Area.objects.filter(id__in=ids)
 
         def cancel_orders(self):
                 """ Delete all the player's orders """
@@ -2529,6 +2670,7 @@ class Player(models.Model):
                         rev.voluntary = True
                         rev.save()
                 self.save()
+                self.game.update_deadline()
                 signals.player_surrendered.send(sender=self)
 
         def set_conqueror(self, player):
@@ -2623,6 +2765,7 @@ class Player(models.Model):
                         msg = "Player %s ended phase" % self.pk
                 else:
                         msg = "Player %s forced to end phase" % self.pk
+                self.game.update_deadline()
                 if logging:
                         logger.info(msg)
 
@@ -2840,13 +2983,7 @@ class Player(models.Model):
                 return v
 
         def get_trade_income(self):
-                i = 0
-                safe_routes = self.game.gameroute_set.filter(safe=True)
-                for r in safe_routes:
-                        for t in r.traders:
-                                if t == self:
-                                        i += 1
-                return i
+                return routes.RouteEvaluator(self.game).get_trade_income().get(self.id, 0)
                         
         def get_income(self, die, majors_ids):
                 """ Gets the total income in one turn """
@@ -2859,6 +2996,12 @@ class Player(models.Model):
                         income += self.get_trade_income()
                 return income
 
+        def get_income_forecast(self):
+                """ Returns the income that the player would get if the incomes were
+                assigned now, for each face of the die, as returned by
+                ``income.get_forecast`` """
+                return income.get_forecast(self)
+
         def add_ducats(self, d):
                 """ Adds d to the ducats field of the player."""
                 self.ducats = F('ducats') + d
@@ -3000,88 +3143,94 @@ def notify_overthrow_attempt(sender, **kw):
 
 signals.overthrow_attempted.connect(notify_overthrow_attempt)
 
-class UnitManager(models.Manager):
-        def get_with_strength(self, game, **kwargs):
-                u = self.get_queryset().get(**kwargs)
-                qry = Q(unit__player__game=game,
-                                  code__exact='S',
-                                  subunit=u)
-                u_order = u.get_order()
-                if not u_order:
-                        qry &= Q(subcode__exact='H')
+class StrengthMap(object):
+        """ Keeps the orders and rebellions of a game in memory, so that the
+        strength of every unit can be calculated without querying the database.
+
+        The map must be told about the orders that are deleted while it is in
+        use, by calling ``remove_order()``, and about the rebellions that are
+        deleted, by calling ``remove_rebellion()``.
+
+        The orders and rebellions are read from the database, unless they are
+        given as lists of ``Order`` and ``Rebellion`` objects, as the
+        adjudicator does with the objects it keeps in memory.
+        """
+
+        def __init__(self, game, orders=None, rebellions=None):
+                self.finances = game.configuration.finances
+                ## orders indexed by unit id
+                self.orders = {}
+                ## support orders indexed by supported unit id
+                self.supports = {}
+                if orders is None:
+                        orders = Order.objects.filter(unit__player__game=game).values_list('id',
+                                                        'unit', 'unit__power', 'code', 'type', 'destination',
+                                                        'subunit', 'subcode', 'subtype', 'subdestination')
                 else:
-                        if u_order.code in ('', 'H', 'S', 'C', 'B'): #unit is holding
-                                qry &= Q(subcode__exact='H')
-                        elif u_order.code == '=':
-                                qry &= Q(subcode__exact='=',
-                                                   subtype=u_order.type)
-                        elif u_order.code == '-':
-                                qry &= Q(subcode__exact='-',
-                                                   subdestination=u_order.destination)
-                support_sum = Order.objects.filter(qry).aggregate(Sum('unit__power'))
-                if support_sum['unit__power__sum'] is None:
-                        support = 0
+                        orders = [(o.id, o.unit_id, o.unit.power, o.code, o.type,
+                                                        o.destination_id, o.subunit_id, o.subcode, o.subtype,
+                                                        o.subdestination_id) for o in orders]
+                for row in orders:
+                        self.orders[row[1]] = row
+                        if row[3] == 'S':
+                                self.supports.setdefault(row[6], {})[row[0]] = row
+                if rebellions is None:
+                        self.rebellions = dict(Rebellion.objects.filter(area__game=game).values_list('area', 'player'))
                 else:
-                        support = int(support_sum['unit__power__sum'])
-                if game.configuration.finances:
-                        if not u_order is None and u_order.code == '-':
-                                if u_order.destination.has_rebellion(u.player, same=False):
+                        self.rebellions = dict([(r.area_id, r.player_id) for r in rebellions])
+
+        def remove_order(self, unit_id):
+                """ Forgets the order given to the unit """
+                order = self.orders.pop(unit_id, None)
+                if order and order[3] == 'S':
+                        self.supports.get(order[6], {}).pop(order[0], None)
+
+        def remove_rebellion(self, area_id):
+                """ Forgets the rebellion in the area """
+                self.rebellions.pop(area_id, None)
+
+        def get_support(self, unit_id):
+                """ Returns the sum of the power of the units supporting the unit """
+                u_order = self.orders.get(unit_id)
+                support = 0
+                for s in self.supports.get(unit_id, {}).values():
+                        if u_order is None or u_order[3] in ('', 'H', 'S', 'C', 'B'): #unit is holding
+                                match = s[7] == 'H'
+                        elif u_order[3] == '=':
+                                match = s[7] == '=' and s[8] == u_order[4]
+                        elif u_order[3] == '-':
+                                match = s[7] == '-' and s[9] == u_order[5]
+                        else:
+                                match = False
+                        if match:
+                                support += s[2]
+                return support
+
+        def get_strength(self, unit):
+                support = self.get_support(unit.id)
+                if self.finances:
+                        u_order = self.orders.get(unit.id)
+                        if not u_order is None and u_order[3] == '-':
+                                rebel = self.rebellions.get(u_order[5])
+                                if not rebel is None and rebel != unit.player_id:
                                         support += 1
-                u.strength = u.power + support
+                return unit.power + support
+
+class UnitManager(models.Manager):
+        def get_with_strength(self, game, strengths=None, **kwargs):
+                u = self.get_queryset().get(**kwargs)
+                if strengths is None:
+                        strengths = StrengthMap(game)
+                u.strength = strengths.get_strength(u)
                 return u
 
-        def list_with_strength(self, game):
-                from django.db import connection
-                cursor = connection.cursor()
-                cursor.execute("SELECT u.id, \
-                                                        u.type, \
-                                                        u.area_id, \
-                                                        u.player_id, \
-                                                        u.besieging, \
-                                                        u.must_retreat, \
-                                                        u.placed, \
-                                                        u.paid, \
-                                                        u.cost, \
-                                                        u.power, \
-                                                        u.loyalty, \
-                                                        o.code, \
-                                                        o.destination_id, \
-                                                        o.type \
-                FROM (machiavelli_player p INNER JOIN machiavelli_unit u on p.id=u.player_id) \
-                LEFT JOIN machiavelli_order o ON u.id=o.unit_id \
-                WHERE p.game_id=%s" % game.id)
-                result_list = []
-                for row in cursor.fetchall():
-                        support_query = Q(unit__player__game=game,
-                                                          code__exact='S',
-                                                          subunit__pk=row[0])
-                        if row[11] in (None, '', 'H', 'S', 'C', 'B'): #unit is holding
-                                support_query &= Q(subcode__exact='H')
-                        elif row[11] == '=':
-                                support_query &= Q(subcode__exact='=',
-                                                                subtype__exact=row[13])
-                        elif row[11] == '-':
-                                support_query &= Q(subcode__exact='-',
-                                                                subdestination__pk__exact=row[12])
-                        #support = Order.objects.filter(support_query).count()
-                        support_sum = Order.objects.filter(support_query).aggregate(Sum('unit__power'))
-                        if support_sum['unit__power__sum'] is None:
-                                support = 0
-                        else:
-                                support = int(support_sum['unit__power__sum'])
-                        unit = self.model(id=row[0], type=row[1], area_id=row[2],
-                                                        player_id=row[3], besieging=row[4],
-                                                        must_retreat=row[5], placed=row[6], paid=row[7],
-                                                        cost=row[8], power=row[9], loyalty=row[10])
-                        if game.configuration.finances:
-                                if row[11] == '-':
-                                        destination = GameArea.objects.get(id=row[12])
-                                        player = Player.objects.get(id=row[3])
-                                        if destination.has_rebellion(player, same=False):
-                                                support += 1
-                        unit.strength = unit.power + support
-                        result_list.append(unit)
-                result_list.sort(cmp=lambda x,y: cmp(x.strength, y.strength), reverse=True)
+        def list_with_strength(self, game, strengths=None):
+                if strengths is None:
+                        strengths = StrengthMap(game)
+                result_list = list(self.get_queryset().filter(player__game=game).order_by('id'))
+                for unit in result_list:
+                        unit.strength = strengths.get_strength(unit)
+                result_list.sort(key=lambda x: x.strength, reverse=True)
                 return result_list
 
 class Unit(models.Model):
@@ -3171,9 +3320,10 @@ class Unit(models.Model):
         def get_possible_retreats(self):
                 ## possible_retreats includes all adjancent, non-standoff areas, and the
                 ## same area where the unit is located (convert to garrison)
+                adj = adjacency.for_area(self.area.board_area)
                 cond = Q(game=self.player.game)
                 cond = cond & Q(standoff=False)
-                cond = cond & Q(board_area__borders=self.area.board_area)
+                cond = cond & Q(board_area__id__in=adj.borders(self.area.board_area_id))
                 ## exclude the area where the attack came from
                 cond = cond & ~Q(board_area__code__exact=self.must_retreat)
                 ## exclude areas with 'A' or 'F'
@@ -3185,9 +3335,9 @@ class Unit(models.Model):
                 ## for fleets, exclude areas that are adjacent but their coasts are not
                 elif self.type == 'F':
                         exclude = []
-                        for area in self.area.board_area.borders.all():
-                                if not area.is_adjacent(self.area.board_area, fleet=True):
-                                        exclude.append(area.id)
+                        for area_id in adj.borders(self.area.board_area_id):
+                                if not adj.is_adjacent(area_id, self.area.board_area_id, fleet=True):
+                                        exclude.append(area_id)
                         cond = cond & ~Q(board_area__id__in=exclude)
                         ## for fleets, exclude areas that are not seas or coasts
                         cond = cond & ~Q(board_area__is_sea=False, board_area__is_coast=False)
@@ -3295,44 +3445,15 @@ class Unit(models.Model):
                         sea_filter = (Q(board_area__is_sea=True) | Q(board_area__mixed=True)) & Q(unit__type='F') & Q(unit__player=self.player)
                 elif self.type == "F":
                         land_filter = land_filter & Q(board_area__is_coast=True)
-                        sea_filter = Q(board_area__is_sea=True) & Q(unit__isnull=True) & Q(board_area__borders__gamearea__player=self.player)
+                        controlled = game_areas.filter(player=self.player).values_list('board_area', flat=True)
+                        coast_ids = adjacency.for_area(self.area.board_area).neighbours(controlled)
+                        sea_filter = Q(board_area__is_sea=True) & Q(unit__isnull=True) & Q(board_area__id__in=coast_ids)
 
                 return game_areas.filter(land_filter | sea_filter).distinct()
 
         def check_strategic_movement(self, destination):
                 """ Returns True if the unit is able to make a strategic movement to the area"""
-                if self.type == "G" or self.besieging:
-                        return False
-                if self.type == "A" and (not self.area.player or self.area.player != self.player):
-                        return False
-                if self.type == "A" and (destination.board_area.is_sea or destination.board_area.mixed):
-                        return False
-                if self.type == "F" and not (destination.board_area.is_coast or destination.board_area.is_sea):
-                        return False
-                valid_areas = self.valid_strategic_areas()
-                if not destination in valid_areas:
-                        return False
-                ##
-                ## find a valid strategic path
-                ##
-                closed = []
-                pending = [self.area, ]
-                if len(valid_areas) < 1:
-                        return False ## there are no valid areas
-                while len(pending) > 0:
-                        for area in pending:
-                                if area in closed:
-                                        continue
-                                borders = list(valid_areas.filter(board_area__borders=area.board_area))
-                                if destination in borders:
-                                        return True ## there is a valid strategic line
-                                closed.append(area)
-                                pending.remove(area)
-                                for b in borders:
-                                        if not b in closed and not b in pending:
-                                                pending.append(b)
-                                break
-                return False ## there is not a valid convoy path
+                return strategic.get_strategic_map(self.player).can_move(self.id, destination.id)
 
 class Order(models.Model):
         """ This class defines an order from a player to a unit. The order will not be
@@ -3464,45 +3585,18 @@ class Order(models.Model):
                         f += " %s" % self.format_suborder()
                 return f
 
-        def find_convoy_line(self):
+        def find_convoy_line(self, resolver=None):
                 """
                 Returns True if there is a continuous line of convoy orders from 
                 the origin to the destination of the order.
+
+                ``resolver`` is the ConvoyResolver of the turn. If it is not given,
+                a new one is created.
                 """
 
-                closed = []
-                pending = [self.unit.area, ]
-                destination = self.destination
-                convoy_areas = GameArea.objects.filter(
-                                                ## in this game
-                                                (Q(game=self.unit.player.game) &
-                                                ## being sea areas or Venice
-                                                (Q(board_area__is_sea=True) | Q(board_area__mixed=True)) & 
-                                                ## with convoy orders
-                                                Q(unit__order__code__exact='C') &
-                                                ## convoying this unit
-                                                Q(unit__order__subunit=self.unit) &
-                                                ## convoying to this destination
-                                                Q(unit__order__subdestination=self.destination)) |
-                                                ## OR being the destination
-                                                Q(id=self.destination.id))
-                if len(convoy_areas) <= 1:
-                        return False ## there are no units with valid convoy orders
-                while len(pending) > 0:
-                        for area in pending:
-                                if area in closed:
-                                        continue
-                                borders = list(convoy_areas.filter(game=self.unit.player.game,
-                                        board_area__borders=area.board_area))
-                                if destination in borders:
-                                        return True ## there is a valid convoy line
-                                closed.append(area)
-                                pending.remove(area)
-                                for b in borders:
-                                        if not b in closed and not b in pending:
-                                                pending.append(b)
-                                break
-                return False ## there is not a valid convoy path
+                if resolver is None:
+                        resolver = convoys.ConvoyResolver.for_game(self.unit.player.game)
+                return resolver.has_line(self.unit_id, self.destination_id)
 
         def get_enemies(self):
                 """ Returns a Queryset with all the units trying to oppose an advance or
@@ -3622,12 +3716,14 @@ class Order(models.Model):
                                         return False
                                 if self.unit.area.board_area.is_coast and self.destination.board_area.is_coast:
                                         return True
-                                if self.unit.area.board_area.is_adjacent(self.destination.board_area):
+                                if adjacency.for_area(self.unit.area.board_area).is_adjacent(self.unit.area.board_area_id,
+                                                                                                self.destination.board_area_id):
                                         return True
                         elif self.unit.type == 'F':
                                 ## it only can go to adjacent seas or coastal provinces
                                 if self.destination.board_area.is_sea or self.destination.board_area.is_coast:
-                                        if self.unit.area.board_area.is_adjacent(self.destination.board_area, fleet=True):
+                                        if adjacency.for_area(self.unit.area.board_area).is_adjacent(self.unit.area.board_area_id,
+                                                                                                self.destination.board_area_id, fleet=True):
                                                 return True
                 elif self.code == 'B':
                         ## only fortified cities can be besieged
@@ -3681,14 +3777,14 @@ class Order(models.Model):
                                 elif self.subcode in ('H', 'B', '='):
                                         sup_area = self.subunit.area.board_area
                                 if sup_area.is_sea or sup_area.is_coast:
-                                        if sup_area.is_adjacent(self.unit.area.board_area, fleet=True):
+                                        if adjacency.for_area(sup_area).is_adjacent(sup_area.id, self.unit.area.board_area_id, fleet=True):
                                                 return True
                         elif self.unit.type == 'A':
                                 if self.subcode == '-':
                                         sup_area = self.subdestination.board_area
                                 elif self.subcode in ('H', 'B', '='):
                                         sup_area = self.subunit.area.board_area
-                                if not sup_area.is_sea and sup_area.is_adjacent(self.unit.area.board_area):
+                                if not sup_area.is_sea and adjacency.for_area(sup_area).is_adjacent(sup_area.id, self.unit.area.board_area_id):
                                         return True
                 return False
 
@@ -3718,7 +3814,8 @@ class StrategicOrder(models.Model):
 
 class TurnLog(models.Model):
         """ A TurnLog is text describing the processing of the method
-        ``Game.process_orders()``.
+        ``Game.process_orders()``. If SAVE_TURN_PROFILE is True, the other
+        phases get a TurnLog with an empty log, to keep their profile.
         """
 
         game = models.ForeignKey(Game, on_delete=models.CASCADE)
@@ -3727,6 +3824,8 @@ class TurnLog(models.Model):
         phase = models.PositiveIntegerField(choices=GAME_PHASES)
         timestamp = models.DateTimeField(auto_now_add=True)
         log = models.TextField()
+        ## JSON list with the measures of each step, if SAVE_TURN_PROFILE is True
+        profile = models.TextField(blank=True, default='')
 
         class Meta:
                 ordering = ['-timestamp',]
@@ -3734,6 +3833,14 @@ class TurnLog(models.Model):
         def __str__(self):
                 return self.log
 
+MAP_FORMATS = (
+        ('raster', _("Image")),
+        ('vector', _("Vector (drawn by the browser)")),
+)
+
+def get_default_map_format():
+        return getattr(settings, 'MAP_FORMAT', 'raster')
+
 PRESS_TYPES = (
         (0, _("Normal (private letters, anonymous gossip)")),
         (1, _("Gunboat diplomacy (no letters, no gossip)")),
@@ -3768,6 +3875,8 @@ class Configuration(models.Model):
         fow = models.BooleanField(_('fog of war'), default=False,
                 help_text=_('each player sees only what happens near his borders'))
         press = models.PositiveIntegerField(_('press'), choices=PRESS_TYPES, default=0)
+        map_format = models.CharField(_('map format'), max_length=6, choices=MAP_FORMATS,
+                default=get_default_map_format)
 
         def __str__(self):
                 return str(self.game)
@@ -29,6 +29,34 @@ class GameQuerySet(models.query.QuerySet):
 			qs = qs.filter(score__user=user)
 		return qs
 
+	def due(self):
+		"""Return a queryset of the games in progress whose phase must be
+		checked: all the players are done, or the deadline has been reached.
+		Games without a stored deadline are always checked."""
+		return self.filter(
+			started__isnull=False,
+			finished__isnull=True,
+			paused=False
+		).filter(
+			models.Q(all_done=True) |
+			models.Q(next_deadline__lte=datetime.now()) |
+			models.Q(next_deadline__isnull=True)
+		)
+
+	def claim(self, timeout=None):
+		"""Marks the games as being processed, unless another worker is
+		already processing them. A claim older than ``timeout`` seconds
+		(TURN_PROCESSING_TIMEOUT by default) is considered abandoned. Returns
+		the number of games claimed."""
+		if timeout is None:
+			timeout = getattr(settings, 'TURN_PROCESSING_TIMEOUT', 60*30)
+		now = datetime.now()
+		stale = now - timedelta(0, timeout)
+		return self.filter(
+			models.Q(processing_since__isnull=True) |
+			models.Q(processing_since__lt=stale)
+		).update(processing_since=now)
+
 	def private(self):
 		return self.filter(private=True)
 
@@ -0,0 +1,124 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the planning of retreats.
+
+``plan_retreats`` finds the possible retreats of all the units that must
+retreat, following the same rules as ``Unit.get_possible_retreats``. The
+plan is made when the retreats are announced and cached for the retreats
+phase, so that the retreat forms don't need to calculate it again.
+"""
+
+from django.core.cache import cache
+
+from . import models as machiavelli
+from machiavelli.adjacency import SEA, COAST, MIXED, FORTIFIED, PORT
+
+def plan_retreats(adj, areas, units, rebellions):
+	""" Returns a tuple (options, disbanded).
+
+	``areas`` maps each GameArea id to a tuple (board area id, board area
+	code, standoff). ``units`` is a list of tuples (id, type, GameArea id,
+	must_retreat) sorted by id. ``rebellions`` is a set with the ids of the
+	GameAreas with a garrisoned rebellion.
+
+	``options`` maps the id of each unit that can retreat to the list of
+	GameArea ids where it can go. ``disbanded`` is the list of ids of the
+	units that have no possible retreat, and must be disbanded.
+	"""
+	game_area_ids = dict([(v[0], k) for k, v in areas.items()])
+	occupied = {}
+	garrisons = set()
+	for unit_id, unit_type, area_id, must_retreat in units:
+		if unit_type in ('A', 'F'):
+			occupied[area_id] = occupied.get(area_id, 0) + 1
+		else:
+			garrisons.add(area_id)
+
+	def get_options(unit_type, area_id, must_retreat):
+		origin, code, standoff = areas[area_id]
+		result = []
+		for board_id in adj.borders(origin):
+			ga_id = game_area_ids.get(board_id)
+			if ga_id is None:
+				continue
+			b_code, b_standoff = areas[ga_id][1:]
+			if b_standoff or b_code == must_retreat or occupied.get(ga_id, 0) > 0:
+				continue
+			if unit_type == 'A':
+				if adj.has_flag(board_id, SEA) or adj.has_flag(board_id, MIXED):
+					continue
+			elif unit_type == 'F':
+				## exclude areas that are adjacent but their coasts are not
+				if not adj.is_adjacent(board_id, origin, fleet=True):
+					continue
+				if not (adj.has_flag(board_id, SEA) or adj.has_flag(board_id, COAST)):
+					continue
+			result.append(ga_id)
+		## the own area, if there is no garrison, the attack didn't come
+		## from the city and there is no rebellion in the city
+		if adj.has_flag(origin, FORTIFIED):
+			if unit_type == 'A' or (unit_type == 'F' and adj.has_flag(origin, PORT)):
+				if must_retreat != code and not area_id in garrisons and not area_id in rebellions:
+					result.append(area_id)
+		result.sort()
+		return result
+
+	retreating = [u for u in units if u[3] != '']
+	## units without retreats are disbanded one by one, as they make room for
+	## the next ones
+	disbanded = []
+	for unit_id, unit_type, area_id, must_retreat in retreating:
+		if len(get_options(unit_type, area_id, must_retreat)) == 0:
+			disbanded.append(unit_id)
+			occupied[area_id] -= 1
+	options = {}
+	for unit_id, unit_type, area_id, must_retreat in retreating:
+		if not unit_id in disbanded:
+			options[unit_id] = get_options(unit_type, area_id, must_retreat)
+	return (options, disbanded)
+
+def load_plan(game):
+	""" Loads the game in three queries and returns ``plan_retreats`` """
+	areas = {}
+	for ga_id, board_id, code, standoff in machiavelli.GameArea.objects.filter(game=game).values_list('id', 'board_area', 'board_area__code', 'standoff'):
+		areas[ga_id] = (board_id, code, standoff)
+	units = list(machiavelli.Unit.objects.filter(player__game=game).order_by('id').values_list('id', 'type', 'area', 'must_retreat'))
+	rebellions = set(machiavelli.Rebellion.objects.filter(area__game=game, garrisoned=True).values_list('area', flat=True))
+	return plan_retreats(game.get_adjacency(), areas, units, rebellions)
+
+def get_cache_key(game):
+	return "game-%s_retreats" % game.pk
+
+def store_options(game, options, phase=None):
+	""" Saves the retreat options for ``phase`` of the current season, by
+	default the retreats phase that follows the orders """
+	if phase is None:
+		phase = machiavelli.PHRETREATS
+	cache.set(get_cache_key(game), {'turn': (game.year, game.season, phase),
+		'options': options})
+
+def get_retreat_options(game):
+	""" Returns a dictionary with the possible retreats of each unit. The
+	saved options are only used in the phase they were saved for """
+	data = cache.get(get_cache_key(game))
+	if data is None or data['turn'] != (game.year, game.season, game.phase):
+		options, disbanded = load_plan(game)
+		store_options(game, options, game.phase)
+		return options
+	return data['options']
@@ -0,0 +1,111 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the evaluation of the trade routes of a game.
+
+A trade route is safe if no unit of a player other than the players who
+control its ends is in any of its areas. The ``RouteEvaluator`` loads the
+steps of all the routes, the owners of the areas and the positions of the
+units once, works out the safety of every route and the trade income of
+every player together, and saves the routes with a single UPDATE statement.
+"""
+
+from collections import defaultdict
+
+from django.db.models import Case, When, Value, BooleanField
+
+from . import models as machiavelli
+
+class RouteEvaluator(object):
+	""" Evaluates all the trade routes of a game at once """
+
+	def __init__(self, game):
+		self.game = game
+		## safe flag of each game route, keyed by game route id
+		self.safe = {}
+		## trade route of each game route
+		self.trade_routes = {}
+		for route_id, trade_route_id, safe in game.gameroute_set.values_list('id', 'trade_route', 'safe'):
+			self.safe[route_id] = safe
+			self.trade_routes[route_id] = trade_route_id
+		## areas and ends of each trade route, as board area ids. An area may
+		## be a step of a route more than once
+		self.areas = defaultdict(set)
+		self.ends = defaultdict(list)
+		steps = machiavelli.TradeRoute.objects.filter(id__in=list(self.trade_routes.values()))
+		for trade_route_id, area_id, is_end in steps.values_list('id', 'routestep__area', 'routestep__is_end'):
+			if area_id is None:
+				continue
+			self.areas[trade_route_id].add(area_id)
+			if is_end:
+				self.ends[trade_route_id].append(area_id)
+		## player who controls each board area
+		self.owners = dict(game.gamearea_set.filter(player__isnull=False).values_list('board_area', 'player'))
+		self.changed = set()
+
+	def get_traders(self, route_id):
+		""" Returns the ids of the players who control the ends of the route """
+		traders = set()
+		for area_id in self.ends[self.trade_routes[route_id]]:
+			if area_id in self.owners:
+				traders.add(self.owners[area_id])
+		return traders
+
+	def evaluate(self):
+		""" Works out the safety of every route, as ``GameRoute.update_status``
+		does. Only the units of the players with a user are enemies """
+		units = defaultdict(set)
+		for player_id, area_id in machiavelli.Unit.objects.filter(player__game=self.game, player__user__isnull=False).values_list('player', 'area__board_area'):
+			units[area_id].add(player_id)
+		for route_id, trade_route_id in self.trade_routes.items():
+			traders = self.get_traders(route_id)
+			safe = True
+			for area_id in self.areas[trade_route_id]:
+				if units[area_id] - traders:
+					safe = False
+					break
+			if safe != self.safe[route_id]:
+				self.safe[route_id] = safe
+				self.changed.add(route_id)
+
+	def save(self):
+		""" Saves the routes whose safety has changed """
+		if len(self.changed) == 0:
+			return 0
+		whens = [When(pk=r, then=Value(self.safe[r])) for r in self.changed]
+		count = machiavelli.GameRoute.objects.filter(pk__in=list(self.changed)).update(
+			safe=Case(*whens, output_field=BooleanField()))
+		self.changed = set()
+		return count
+
+	def update(self):
+		self.evaluate()
+		return self.save()
+
+	def get_trade_income(self):
+		""" Returns a dictionary with the trade income of each player, keyed by
+		player id: one ducat for each end of a safe route that the player
+		controls """
+		income = defaultdict(int)
+		for route_id, trade_route_id in self.trade_routes.items():
+			if not self.safe[route_id]:
+				continue
+			for area_id in self.ends[trade_route_id]:
+				if area_id in self.owners:
+					income[self.owners[area_id]] += 1
+		return income
@@ -0,0 +1,93 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the runner that checks the phase of the due games.
+
+The games can be spread across a pool of worker processes. Each game is
+claimed before it is checked, so that it is never processed twice at the same
+time, and an error in a game does not stop the rest.
+"""
+
+import multiprocessing
+import traceback
+
+from django.conf import settings
+from django.db import connections
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import models as machiavelli
+
+## orderings of the due games
+PRIORITIES = {
+	'fast': ('-fast', 'next_deadline', 'id'),
+	'deadline': ('next_deadline', 'id'),
+}
+
+def get_due_games(priority='fast'):
+	""" Returns the ids of the games that must be checked, in the order they
+	must be processed """
+	games = machiavelli.Game.objects.due().order_by(*PRIORITIES[priority])
+	return list(games.values_list('id', flat=True))
+
+def check_game(game_id):
+	""" Checks the phase of a game. Returns a tuple (game_id, error), where
+	error is None if the game was checked, or was being processed by another
+	worker """
+	try:
+		game = machiavelli.Game.objects.get(pk=game_id)
+	except machiavelli.Game.DoesNotExist:
+		return (game_id, None)
+	if not game.claim_processing():
+		return (game_id, None)
+	try:
+		## another worker may have processed the game since it was listed
+		if machiavelli.Game.objects.due().filter(pk=game_id).exists():
+			game.check_finished_phase()
+	except Exception:
+		msg = "Error while checking if phase is finished in game %s\n\n" % game_id
+		msg += traceback.format_exc()
+		logger.error(msg)
+		return (game_id, msg)
+	finally:
+		game.release_processing()
+	return (game_id, None)
+
+def _init_worker():
+	## each worker opens its own connections
+	connections.close_all()
+
+def run(workers=None, priority='fast'):
+	""" Checks all the due games with ``workers`` processes. Returns a list of
+	tuples (game_id, error) for the games that failed """
+	if workers is None:
+		workers = getattr(settings, 'TURN_WORKERS', 1)
+	game_ids = get_due_games(priority)
+	if workers <= 1 or len(game_ids) <= 1:
+		results = [check_game(game_id) for game_id in game_ids]
+	else:
+		## the connections must not be shared with the forked processes
+		connections.close_all()
+		pool = multiprocessing.Pool(min(workers, len(game_ids)), _init_worker)
+		try:
+			results = list(pool.imap_unordered(check_game, game_ids))
+		finally:
+			pool.close()
+			pool.join()
+	return [r for r in results if r[1] is not None]
@@ -62,3 +62,7 @@ player_assassinated = Signal(providing_args=[])
 assassination_attempted = Signal(providing_args=[])
 game_finished = Signal(providing_args=[])
 diplomat_uncovered = Signal(providing_args=[])
+
+## turn_step_measured is sent by machiavelli.instrumentation after each measured
+## step of the turn processing. It is not related to any event
+turn_step_measured = Signal(providing_args=["step", "depth", "seconds", "queries", "rows", "bytes"])
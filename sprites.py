@@ -0,0 +1,86 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines a cache of the token images used to draw the maps.
+
+Each token is opened the first time it is needed, converted to RGBA and kept
+for the life of the process, so that it can be pasted with its own alpha
+channel as mask. A token is loaded again if its file is modified. The number
+of tokens in the cache is limited by the setting SPRITE_CACHE_SIZE; the least
+recently used token is evicted first.
+"""
+
+from collections import OrderedDict
+import os
+import threading
+
+from PIL import Image
+
+from django.conf import settings
+
+TOKENS_DIR=os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT, 'tokens')
+
+class SpriteCache(object):
+	""" A thread-safe LRU cache of images, keyed by token name """
+
+	def __init__(self, max_size=128):
+		self.max_size = max_size
+		self.images = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get_path(self, name):
+		return os.path.join(TOKENS_DIR, "%s.png" % name)
+
+	def get(self, name):
+		""" Returns the RGBA image of the token ``name``. Raises IOError if
+		the file cannot be read """
+		path = self.get_path(name)
+		mtime = os.stat(path).st_mtime
+		with self.lock:
+			cached = self.images.pop(name, None)
+			if cached is not None and cached[0] == mtime:
+				self.images[name] = cached
+				return cached[1]
+		image = Image.open(path)
+		image.load()
+		image = image.convert("RGBA")
+		with self.lock:
+			self.images[name] = (mtime, image)
+			while len(self.images) > self.max_size:
+				self.images.popitem(last=False)
+		return image
+
+	def clear(self):
+		with self.lock:
+			self.images.clear()
+
+_cache = SpriteCache(getattr(settings, 'SPRITE_CACHE_SIZE', 128))
+
+def get_sprite(name):
+	""" Returns the image of the token ``name``, e.g. 'A-venice' or
+	'famine-marker' """
+	return _cache.get(name)
+
+def clear_cache():
+	_cache.clear()
+
+def use_tokens_dir(path):
+	""" Makes the cache read the tokens from ``path`` """
+	global TOKENS_DIR
+	TOKENS_DIR = path
+	_cache.clear()
@@ -12,7 +12,29 @@ function setMapHeight() {
 	$("#map").height(mapHeight);
 }
 
-function loadMapViewer(map_url) {
+// true if the browser can decode WebP images
+function supportsWebP() {
+	var canvas = document.createElement("canvas");
+	if (!canvas.getContext) {
+		return false;
+	}
+	return canvas.toDataURL("image/webp").indexOf("data:image/webp") == 0;
+}
+
+// options may have the url of the WebP copy of the map in 'webp', and
+// 'update_on_resize' for the viewer
+function loadMapViewer(map_url, options) {
+	options = options || {};
+	if (/\.svg$/.test(map_url)) {
+		// vector maps use tokens from the sprite sheet, and must be loaded
+		// as a document, not as an image
+		$("#map").html('<object type="image/svg+xml" width="100%" height="100%"></object>');
+		$("#map object").attr("data", map_url);
+		return;
+	}
+	if (options.webp && supportsWebP()) {
+		map_url = options.webp;
+	}
 	var viewer_opts = {
 		src: map_url,
 		ui_disabled: true,
@@ -21,12 +43,137 @@ function loadMapViewer(map_url) {
 		zoom_min: 10,
 		zoom_delta: 1.4,
 		//zoom_base:
-		update_on_resize: false,
-		initCallback: function() {
+		update_on_resize: options.update_on_resize || false
+	};
+	if (!options.update_on_resize) {
+		viewer_opts.initCallback = function() {
 			var object = this;
 			$(window).resize(function(){ object.fit();});
-		},
-	};
+		};
+	}
 	$("#map").iviewer(viewer_opts);
 }
 
+
+// Shows a map cut in tiles, as described by its tile index. Only the tiles
+// that are visible at the current zoom level are loaded.
+function TileViewer(element, index) {
+	this.element = element;
+	this.index = index;
+	this.level = 0;
+	this.x = 0;
+	this.y = 0;
+	this.loaded = {};
+	element.html('<div class="tile_viewer" style="position: relative; overflow: hidden; width: 100%; height: 100%; cursor: move;"><div class="tile_layer" style="position: absolute;"></div></div>');
+	this.layer = element.find(".tile_layer");
+	this.fit();
+	this.bind();
+}
+
+// shows the largest level that fits in the container, centered
+TileViewer.prototype.fit = function() {
+	var width = this.element.width();
+	var height = this.element.height();
+	var level = 0;
+	for (var i = 0; i < this.index.levels.length; i++) {
+		var size = this.index.levels[i].size;
+		if (size[0] <= width && size[1] <= height) {
+			level = i;
+		}
+	}
+	this.setLevel(level);
+	var size = this.index.levels[level].size;
+	this.x = Math.round((width - size[0]) / 2);
+	this.y = Math.round((height - size[1]) / 2);
+	this.draw();
+};
+
+// changes the zoom level, keeping in place the point of the container at
+// center, if given
+TileViewer.prototype.setLevel = function(level, center) {
+	if (level < 0 || level >= this.index.levels.length) {
+		return;
+	}
+	var size = this.index.levels[level].size;
+	if (center) {
+		var old = this.index.levels[this.level].size;
+		var k = size[0] / old[0];
+		this.x = Math.round(center[0] - (center[0] - this.x) * k);
+		this.y = Math.round(center[1] - (center[1] - this.y) * k);
+	}
+	this.level = level;
+	this.loaded = {};
+	this.layer.html("");
+	this.layer.css({width: size[0] + "px", height: size[1] + "px"});
+};
+
+// moves the layer and loads the visible tiles that are not loaded yet
+TileViewer.prototype.draw = function() {
+	this.layer.css({left: this.x + "px", top: this.y + "px"});
+	var tile_size = this.index.tile_size;
+	var tiles = this.index.levels[this.level].tiles;
+	var first_col = Math.max(0, Math.floor(-this.x / tile_size));
+	var first_row = Math.max(0, Math.floor(-this.y / tile_size));
+	var last_col = Math.floor((this.element.width() - this.x) / tile_size);
+	var last_row = Math.floor((this.element.height() - this.y) / tile_size);
+	var html = [];
+	for (var r = first_row; r <= last_row && r < tiles.length; r++) {
+		for (var c = first_col; c <= last_col && c < tiles[r].length; c++) {
+			var key = r + "-" + c;
+			if (this.loaded[key]) {
+				continue;
+			}
+			this.loaded[key] = true;
+			html.push('<img src="' + this.index.url + '/' + tiles[r][c] + '.jpg" style="position: absolute; left: ' + (c * tile_size) + 'px; top: ' + (r * tile_size) + 'px;" alt="" />');
+		}
+	}
+	if (html.length > 0) {
+		this.layer.append(html.join(""));
+	}
+};
+
+TileViewer.prototype.bind = function() {
+	var viewer = this;
+	var drag = null;
+	this.element.mousedown(function(e) {
+		drag = [e.pageX - viewer.x, e.pageY - viewer.y];
+		return false;
+	});
+	$(document).mousemove(function(e) {
+		if (drag) {
+			viewer.x = e.pageX - drag[0];
+			viewer.y = e.pageY - drag[1];
+			viewer.draw();
+		}
+	});
+	$(document).mouseup(function() {
+		drag = null;
+	});
+	if (this.element.mousewheel) {
+		this.element.mousewheel(function(e, delta) {
+			var offset = viewer.element.offset();
+			var center = [e.pageX - offset.left, e.pageY - offset.top];
+			viewer.setLevel(viewer.level + (delta > 0 ? 1 : -1), center);
+			viewer.draw();
+			return false;
+		});
+	}
+	$(window).resize(function() {
+		viewer.draw();
+	});
+};
+
+// loads the tile index in tiles_url and shows the tiles. If the index cannot
+// be loaded, shows the whole map
+function loadTiledMap(tiles_url, map_url, options) {
+	$.ajax({
+		url: tiles_url,
+		dataType: "json",
+		success: function(index) {
+			new TileViewer($("#map"), index);
+		},
+		error: function() {
+			loadMapViewer(map_url, options);
+		}
+	});
+}
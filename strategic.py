@@ -0,0 +1,133 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the areas that the units of a player can reach with a
+strategic movement.
+
+The valid areas for armies and fleets are split into connected components
+once, and the destinations of each unit are the components bordering its area.
+The result is cached for the rest of the phase.
+"""
+
+from django.core.cache import cache
+
+from . import models as machiavelli
+from machiavelli.adjacency import SEA, COAST, MIXED
+
+class StrategicMap(object):
+	""" Legal strategic destinations of the units of a player.
+
+	``destinations`` maps the id of each unit to a frozenset with the ids of
+	the GameAreas where it can move.
+	"""
+
+	def __init__(self, player):
+		game = player.game
+		self.turn = (game.year, game.season, game.phase)
+		adj = game.get_adjacency()
+		## load the board in two queries
+		owners = {}
+		board_ids = {}
+		for ga_id, board_id, owner_id in machiavelli.GameArea.objects.filter(game=game).values_list('id', 'board_area', 'player'):
+			owners[board_id] = owner_id
+			board_ids[ga_id] = board_id
+		game_area_ids = dict([(b, g) for g, b in board_ids.items()])
+		units = list(machiavelli.Unit.objects.filter(player__game=game).values_list('id', 'type', 'area', 'player', 'besieging'))
+		occupied = set()
+		with_units = set()
+		own_fleets = set()
+		for unit_id, unit_type, area_id, player_id, besieging in units:
+			board_id = board_ids[area_id]
+			with_units.add(board_id)
+			if unit_type in ('A', 'F'):
+				occupied.add(board_id)
+			if unit_type == 'F' and player_id == player.id:
+				own_fleets.add(board_id)
+		controlled = [b for b, owner in owners.items() if owner == player.id]
+		coast_neighbours = adj.neighbours(controlled)
+		## valid areas for armies and fleets, as in Unit.valid_strategic_areas
+		valid = {'A': set(), 'F': set()}
+		for board_id in owners.keys():
+			is_sea = adj.has_flag(board_id, SEA)
+			if owners[board_id] == player.id and not board_id in occupied:
+				valid['A'].add(board_id)
+				if adj.has_flag(board_id, COAST):
+					valid['F'].add(board_id)
+			if (is_sea or adj.has_flag(board_id, MIXED)) and board_id in own_fleets:
+				valid['A'].add(board_id)
+			if is_sea and not board_id in with_units and board_id in coast_neighbours:
+				valid['F'].add(board_id)
+		components = {'A': self.get_components(adj, valid['A']),
+					'F': self.get_components(adj, valid['F'])}
+		self.destinations = {}
+		for unit_id, unit_type, area_id, player_id, besieging in units:
+			if player_id != player.id or unit_type == 'G' or besieging:
+				continue
+			board_id = board_ids[area_id]
+			if unit_type == 'A' and owners[board_id] != player.id:
+				continue
+			reachable = set()
+			for b in adj.borders(board_id) & valid[unit_type]:
+				reachable |= components[unit_type][b]
+			if unit_type == 'A':
+				reachable = [b for b in reachable if not (adj.has_flag(b, SEA) or adj.has_flag(b, MIXED))]
+			else:
+				reachable = [b for b in reachable if adj.has_flag(b, COAST) or adj.has_flag(b, SEA)]
+			self.destinations[unit_id] = frozenset([game_area_ids[b] for b in reachable])
+
+	def get_components(self, adj, nodes):
+		""" Returns a dictionary that maps each node to the frozenset of nodes
+		in its connected component """
+		result = {}
+		for start in nodes:
+			if start in result:
+				continue
+			component = set([start, ])
+			pending = [start, ]
+			while len(pending) > 0:
+				current = pending.pop()
+				for b in adj.borders(current) & nodes:
+					if not b in component:
+						component.add(b)
+						pending.append(b)
+			component = frozenset(component)
+			for n in component:
+				result[n] = component
+		return result
+
+	def can_move(self, unit_id, area_id):
+		return area_id in self.destinations.get(unit_id, ())
+
+	def all_destinations(self):
+		result = set()
+		for d in self.destinations.values():
+			result |= d
+		return result
+
+def get_cache_key(player):
+	return "player-%s_strategic" % player.pk
+
+def get_strategic_map(player):
+	""" Returns the StrategicMap of the player in the current phase """
+	game = player.game
+	key = get_cache_key(player)
+	strategic = cache.get(key)
+	if strategic is None or strategic.turn != (game.year, game.season, game.phase):
+		strategic = StrategicMap(player)
+		cache.set(key, strategic)
+	return strategic
@@ -0,0 +1,1188 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the tests of the turn processing.
+
+The tests build small synthetic games and process them, so they can be run
+against SQLite with ``manage.py test machiavelli``. They need a scenario in
+the database: the one named in the setting BENCHMARK_SCENARIO, or else the
+first one that has the features needed by the test. The fixtures listed in
+the setting BENCHMARK_FIXTURES are loaded before each test.
+
+The engines that replaced a query per object are compared with the rules
+they replaced, which are kept here as reference functions.
+"""
+
+import random
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.dispatch import Signal
+from django.test import TestCase, override_settings
+
+from condottieri_scenarios.models import Scenario, Area
+
+from . import models as machiavelli
+import machiavelli.adjacency as adjacency
+import machiavelli.benchmark as benchmark
+import machiavelli.convoys as convoys
+import machiavelli.disasters as disasters
+import machiavelli.income as income
+import machiavelli.retreats as retreats
+import machiavelli.routes as routes
+import machiavelli.signals as signals
+import machiavelli.strategic as strategic
+
+class ScenarioTestCase(TestCase):
+	""" Base class of the tests that play a game in a scenario of the
+	database. The test is skipped if no scenario is accepted """
+	fixtures = getattr(settings, 'BENCHMARK_FIXTURES', [])
+
+	def setUp(self):
+		self.scenario = self.get_scenario()
+		if self.scenario is None:
+			self.skipTest("There are no suitable scenarios in the database")
+		random.seed(1)
+		## the plans and tables kept in the cache belong to other tests
+		cache.clear()
+
+	def accepts(self, scenario):
+		""" Returns True if the test can be run in the scenario """
+		return True
+
+	def get_scenario(self):
+		name = getattr(settings, 'BENCHMARK_SCENARIO', None)
+		scenarios = list(Scenario.objects.order_by('id'))
+		if name:
+			## the scenario named in the settings is tried first
+			scenarios.sort(key=lambda s: s.name != name)
+		for scenario in scenarios:
+			if self.accepts(scenario):
+				return scenario
+		return None
+
+class RecorderTestCase(TestCase):
+	def test_measure(self):
+		recorder = benchmark.Recorder()
+		with recorder.measure('outer'):
+			with recorder.measure('inner'):
+				pass
+		self.assertEqual([r['step'] for r in recorder.results], ['inner', 'outer'])
+		self.assertEqual([r['depth'] for r in recorder.results], [1, 0])
+		self.assertEqual(recorder.stack, [])
+
+	def test_measure_error(self):
+		recorder = benchmark.Recorder()
+		with self.assertRaises(ValueError):
+			with recorder.measure('failed'):
+				raise ValueError
+		self.assertEqual(recorder.stack, [])
+		with recorder.measure('next'):
+			pass
+		self.assertEqual(recorder.results[-1]['depth'], 0)
+
+class BenchmarkTestCase(ScenarioTestCase):
+	def test_build_game(self):
+		game = benchmark.build_game(self.scenario, players=2, density=0.2)
+		self.assertIsNotNone(game.started)
+		self.assertEqual(game.player_set.filter(user__isnull=False).count(), 2)
+		self.assertTrue(machiavelli.Unit.objects.filter(player__game=game).exists())
+
+	def test_random_reinforcements(self):
+		game = benchmark.build_game(self.scenario, players=2, density=0.3)
+		game.phase = machiavelli.PHREINFORCE
+		game.save()
+		## without finances, all the units are paid when the phase begins
+		machiavelli.Unit.objects.filter(player__game=game).update(paid=True)
+		players = list(game.player_set.filter(user__isnull=False))
+		before = {}
+		for p in players:
+			before[p.id] = (p.units_to_place(),
+				p.unit_set.filter(placed=True, paid=False).count(),
+				p.unit_set.filter(placed=False).count())
+		benchmark.random_reinforcements(game)
+		for p in players:
+			p = machiavelli.Player.objects.get(id=p.id)
+			place, unpaid, unplaced = before[p.id]
+			self.assertTrue(p.done)
+			if place < 0:
+				self.assertEqual(p.unit_set.filter(placed=True, paid=False).count() - unpaid, -place)
+			else:
+				self.assertTrue(p.unit_set.filter(placed=False).count() - unplaced <= place)
+
+	@override_settings(ASYNC_MAP_RENDERING=True)
+	def test_run(self):
+		game = benchmark.build_game(self.scenario, players=2, density=0.2)
+		start = (game.year, game.season, game.phase)
+		recorder = benchmark.run(game, 4)
+		self.assertNotEqual((game.year, game.season, game.phase), start)
+		turns = [r for r in recorder.results if r['step'] == 'process_turn']
+		self.assertTrue(0 < len(turns) <= 4)
+		for r in recorder.results:
+			self.assertTrue(r['seconds'] >= 0)
+			self.assertTrue(r['queries'] >= 0)
+		self.assertEqual(recorder.stack, [])
+		## the maps are not drawn nor queued
+		self.assertFalse(machiavelli.RenderJob.objects.filter(game=game).exists())
+		summary = recorder.summary()
+		self.assertTrue(any(s['step'] == 'process_turn' for s in summary))
+
+class SignalRecorder(object):
+	""" Records the signals sent while it is active, as tuples (name, sender
+	class, sender id) """
+
+	def __init__(self, *names):
+		self.names = names
+		self.sent = []
+
+	def __enter__(self):
+		self.receivers = []
+		for name in self.names:
+			receiver = self.make_receiver(name)
+			getattr(signals, name).connect(receiver, weak=False)
+			self.receivers.append((name, receiver))
+		return self
+
+	def __exit__(self, *args):
+		for name, receiver in self.receivers:
+			getattr(signals, name).disconnect(receiver)
+		return False
+
+	def make_receiver(self, name):
+		def receiver(sender, **kwargs):
+			self.sent.append((name, sender.__class__.__name__, getattr(sender, 'pk', None)))
+		return receiver
+
+	def count(self, name):
+		return len([s for s in self.sent if s[0] == name])
+
+def new_unit(game, player, type='A', **kwargs):
+	""" Places a unit of ``player`` in an empty area that can hold it. The
+	area can be filtered with ``kwargs`` """
+	if type == 'A':
+		kwargs.update({'board_area__is_sea': False, 'board_area__mixed': False})
+	elif type == 'F':
+		kwargs.update({'board_area__is_sea': True})
+	else:
+		kwargs.update({'board_area__is_fortified': True})
+	area = game.gamearea_set.filter(unit__isnull=True, **kwargs).order_by('id').first()
+	assert area is not None, "There is no empty area for the unit"
+	unit = machiavelli.Unit(type=type, area=area, player=player)
+	unit.save()
+	return unit
+
+def scramble(game):
+	""" Gives the game famines, rebellions, garrisons in foreign cities,
+	sieges and a conquered player, so that every income rule counts """
+	areas = list(game.gamearea_set.select_related('board_area').order_by('id'))
+	players = list(game.player_set.filter(user__isnull=False).order_by('id'))
+	for a in areas:
+		if a.board_area.is_sea:
+			continue
+		r = random.random()
+		if r < 0.15:
+			a.famine = True
+			a.save()
+		elif r < 0.3 and a.player_id:
+			machiavelli.Rebellion(area=a).save()
+	for a in areas:
+		if a.board_area.is_fortified and random.random() < 0.4 and \
+			not a.unit_set.filter(type='G').exists():
+			machiavelli.Unit(type='G', area=a, player=random.choice(players)).save()
+	for u in machiavelli.Unit.objects.filter(player__game=game, type__in=('A', 'F'),
+		area__board_area__is_fortified=True):
+		if random.random() < 0.5:
+			u.besieging = True
+			u.save()
+	if len(players) > 2:
+		players[-1].conqueror = players[0]
+		players[-1].eliminated = True
+		players[-1].save()
+
+##------------------------
+## strengths
+##------------------------
+
+def baseline_strength(game, unit):
+	""" ``UnitManager.get_with_strength`` before the StrengthMap """
+	qry = Q(unit__player__game=game, code__exact='S', subunit=unit)
+	u_order = unit.get_order()
+	if not u_order:
+		qry &= Q(subcode__exact='H')
+	else:
+		if u_order.code in ('', 'H', 'S', 'C', 'B'): #unit is holding
+			qry &= Q(subcode__exact='H')
+		elif u_order.code == '=':
+			qry &= Q(subcode__exact='=', subtype=u_order.type)
+		elif u_order.code == '-':
+			qry &= Q(subcode__exact='-', subdestination=u_order.destination)
+	support_sum = machiavelli.Order.objects.filter(qry).aggregate(Sum('unit__power'))
+	if support_sum['unit__power__sum'] is None:
+		support = 0
+	else:
+		support = int(support_sum['unit__power__sum'])
+	if game.configuration.finances:
+		if not u_order is None and u_order.code == '-':
+			if u_order.destination.has_rebellion(unit.player, same=False):
+				support += 1
+	return unit.power + support
+
+def match_supports(game):
+	""" Makes half of the support orders match the order of the supported
+	unit, so that advances and conversions are supported too """
+	for o in machiavelli.Order.objects.filter(unit__player__game=game, code='S'):
+		order = o.subunit.get_order()
+		if order is None or random.random() < 0.5:
+			continue
+		o.subcode = order.code
+		o.subtype = order.type
+		o.subdestination = order.destination
+		o.save()
+
+class StrengthMapTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(StrengthMapTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.6, rules=('finances',))
+		scramble(self.game)
+		benchmark.random_orders(self.game)
+		match_supports(self.game)
+
+	def assertStrengths(self, strengths=None):
+		units = machiavelli.Unit.objects.list_with_strength(self.game, strengths)
+		self.assertEqual(len(units), machiavelli.Unit.objects.filter(player__game=self.game).count())
+		for u in units:
+			self.assertEqual(u.strength, baseline_strength(self.game, u), u)
+
+	def test_list_with_strength(self):
+		self.assertStrengths()
+
+	def test_get_with_strength(self):
+		for u in machiavelli.Unit.objects.filter(player__game=self.game):
+			unit = machiavelli.Unit.objects.get_with_strength(self.game, id=u.id)
+			self.assertEqual(unit.strength, baseline_strength(self.game, u), u)
+
+	def test_remove(self):
+		strengths = machiavelli.StrengthMap(self.game)
+		for o in machiavelli.Order.objects.filter(unit__player__game=self.game, code='S'):
+			if random.random() < 0.5:
+				strengths.remove_order(o.unit_id)
+				o.delete()
+		for r in machiavelli.Rebellion.objects.filter(area__game=self.game):
+			if random.random() < 0.5:
+				strengths.remove_rebellion(r.area_id)
+				r.delete()
+		self.assertStrengths(strengths)
+
+##------------------------
+## adjacency
+##------------------------
+
+class AdjacencyTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(AdjacencyTestCase, self).setUp()
+		adjacency.clear_cache()
+		self.setting = self.scenario.setting
+		self.index = adjacency.get_index(self.setting.id)
+		self.areas = list(Area.objects.filter(setting=self.setting).order_by('id'))
+
+	def test_borders(self):
+		for a in self.areas:
+			borders = list(a.borders.filter(setting=self.setting))
+			self.assertEqual(self.index.borders(a.id), set([b.id for b in borders]))
+			fleet = [b.id for b in borders if a.is_adjacent(b, fleet=True)]
+			self.assertEqual(self.index.borders(a.id, fleet=True), set(fleet))
+
+	def test_is_adjacent(self):
+		for a in self.areas:
+			others = random.sample(self.areas, min(10, len(self.areas)))
+			others += list(a.borders.filter(setting=self.setting))
+			for b in others:
+				if b == a:
+					continue
+				for fleet in (False, True):
+					self.assertEqual(self.index.is_adjacent(a.id, b.id, fleet=fleet),
+						a.is_adjacent(b, fleet=fleet), (a, b, fleet))
+
+	def test_flags(self):
+		for a in self.areas:
+			for flag in adjacency.FLAGS:
+				self.assertEqual(self.index.has_flag(a.id, flag), bool(getattr(a, flag)), (a, flag))
+
+	def test_neighbours(self):
+		for i in range(0, 10):
+			ids = [a.id for a in random.sample(self.areas, min(5, len(self.areas)))]
+			expected = set(Area.objects.filter(setting=self.setting,
+				borders__id__in=ids).values_list('id', flat=True))
+			self.assertEqual(self.index.neighbours(ids), expected)
+			self.assertEqual(self.index.area_ids(self.index.mask(ids)), sorted(ids))
+
+	def test_shared(self):
+		game = benchmark.build_game(self.scenario, players=2)
+		self.assertIs(game.get_adjacency(), self.index)
+		self.assertIs(adjacency.for_area(self.areas[0]), self.index)
+		adjacency.clear_cache()
+		self.assertIsNot(adjacency.get_index(self.setting.id), self.index)
+
+##------------------------
+## convoys
+##------------------------
+
+def baseline_convoy_line(unit, destination):
+	""" ``Order.find_convoy_line`` before the ConvoyResolver """
+	game = unit.player.game
+	closed = []
+	pending = [unit.area, ]
+	convoy_areas = machiavelli.GameArea.objects.filter(
+		(Q(game=game) &
+		(Q(board_area__is_sea=True) | Q(board_area__mixed=True)) &
+		Q(unit__order__code__exact='C') &
+		Q(unit__order__subunit=unit) &
+		Q(unit__order__subdestination=destination)) |
+		Q(id=destination.id))
+	if len(convoy_areas) <= 1:
+		return False
+	while len(pending) > 0:
+		for area in pending:
+			if area in closed:
+				continue
+			borders = list(convoy_areas.filter(game=game, board_area__borders=area.board_area))
+			if destination in borders:
+				return True
+			closed.append(area)
+			pending.remove(area)
+			for b in borders:
+				if not b in closed and not b in pending:
+					pending.append(b)
+			break
+	return False
+
+def random_convoys(game, armies=3):
+	""" Gives convoy orders to the fleets that can convoy. Each fleet convoys
+	one of a few armies to a coast next to the fleet, so that some convoy
+	lines are complete and some are not """
+	adj = game.get_adjacency()
+	units = machiavelli.Unit.objects.filter(player__game=game)
+	fleets = list(units.filter(Q(area__board_area__is_sea=True) | Q(area__board_area__mixed=True),
+		type='F').select_related('area'))
+	fleet_areas = set([f.area.board_area_id for f in fleets])
+	candidates = [a for a in units.filter(type='A').select_related('area')
+		if adj.borders(a.area.board_area_id) & fleet_areas]
+	if len(candidates) == 0:
+		return
+	candidates = random.sample(candidates, min(armies, len(candidates)))
+	coasts = dict(game.gamearea_set.filter(board_area__is_coast=True,
+		board_area__is_sea=False).values_list('board_area', 'id'))
+	for f in fleets:
+		destinations = [coasts[b] for b in adj.borders(f.area.board_area_id) if b in coasts]
+		if len(destinations) == 0:
+			continue
+		machiavelli.Order.objects.filter(unit=f).delete()
+		machiavelli.Order(unit=f, code='C', subunit=random.choice(candidates), subcode='-',
+			subdestination_id=random.choice(destinations), player=f.player,
+			confirmed=True).save()
+
+class ConvoyResolverTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(ConvoyResolverTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.6)
+		random_convoys(self.game)
+		self.orders = list(machiavelli.Order.objects.filter(unit__player__game=self.game,
+			code='C').select_related('subunit', 'subdestination'))
+		if len(self.orders) == 0:
+			self.skipTest("There are no convoy orders")
+
+	def get_lines(self):
+		""" The convoy lines of every convoyed army and destination, as the
+		old query did """
+		lines = {}
+		for o in self.orders:
+			key = (o.subunit_id, o.subdestination_id)
+			if not key in lines:
+				lines[key] = baseline_convoy_line(o.subunit, o.subdestination)
+		return lines
+
+	def test_resolve(self):
+		resolver = convoys.ConvoyResolver.for_game(self.game)
+		for (unit_id, dest_id), line in self.get_lines().items():
+			self.assertEqual(resolver.has_line(unit_id, dest_id), line, (unit_id, dest_id))
+			order = machiavelli.Order(unit_id=unit_id, code='-', destination_id=dest_id)
+			self.assertEqual(order.find_convoy_line(resolver), line)
+
+	def test_destinations(self):
+		resolver = convoys.ConvoyResolver.for_game(self.game)
+		lines = self.get_lines()
+		for unit_id in set([u for u, d in lines.keys()]):
+			expected = set([d for (u, d), line in lines.items() if u == unit_id and line])
+			self.assertEqual(resolver.destinations(unit_id), expected)
+
+	def test_remove_order(self):
+		resolver = convoys.ConvoyResolver.for_game(self.game)
+		for o in random.sample(self.orders, (len(self.orders) + 1) // 2):
+			resolver.remove_order(o.id)
+			o.delete()
+			self.orders.remove(o)
+		for (unit_id, dest_id), line in self.get_lines().items():
+			self.assertEqual(resolver.has_line(unit_id, dest_id), line, (unit_id, dest_id))
+
+##------------------------
+## strategic movements
+##------------------------
+
+def baseline_strategic_areas(unit):
+	""" ``Unit.valid_strategic_areas`` before the adjacency index """
+	game_areas = machiavelli.GameArea.objects.filter(game=unit.area.game)
+	occupied_ids = game_areas.filter(unit__type__in=['A','F']).values_list('id', flat=True)
+	land_filter = Q(player=unit.player) & ~Q(id__in=occupied_ids)
+	if unit.type == "A":
+		sea_filter = (Q(board_area__is_sea=True) | Q(board_area__mixed=True)) & Q(unit__type='F') & Q(unit__player=unit.player)
+	elif unit.type == "F":
+		land_filter = land_filter & Q(board_area__is_coast=True)
+		sea_filter = Q(board_area__is_sea=True) & Q(unit__isnull=True) & Q(board_area__borders__gamearea__player=unit.player)
+	return game_areas.filter(land_filter | sea_filter).distinct()
+
+def baseline_strategic_movement(unit, destination):
+	""" ``Unit.check_strategic_movement`` before the StrategicMap """
+	if unit.type == "G" or unit.besieging:
+		return False
+	if unit.type == "A" and (not unit.area.player or unit.area.player != unit.player):
+		return False
+	if unit.type == "A" and (destination.board_area.is_sea or destination.board_area.mixed):
+		return False
+	if unit.type == "F" and not (destination.board_area.is_coast or destination.board_area.is_sea):
+		return False
+	valid_areas = baseline_strategic_areas(unit)
+	if not destination in valid_areas:
+		return False
+	closed = []
+	pending = [unit.area, ]
+	while len(pending) > 0:
+		for area in pending:
+			if area in closed:
+				continue
+			borders = list(valid_areas.filter(board_area__borders=area.board_area))
+			if destination in borders:
+				return True
+			closed.append(area)
+			pending.remove(area)
+			for b in borders:
+				if not b in closed and not b in pending:
+					pending.append(b)
+			break
+	return False
+
+def baseline_strategic_destinations(unit):
+	""" The ids of the areas where the old rules let the unit move. Only the
+	valid strategic areas can be destinations """
+	if unit.type == "G":
+		return set()
+	return set([a.id for a in baseline_strategic_areas(unit)
+		if baseline_strategic_movement(unit, a)])
+
+class StrategicMapTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(StrategicMapTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.5, rules=('strategic',))
+		scramble(self.game)
+		self.game.phase = machiavelli.PHSTRATEGIC
+		self.game.save()
+		self.players = list(self.game.player_set.filter(user__isnull=False))
+
+	def test_destinations(self):
+		for p in self.players:
+			strategic_map = strategic.StrategicMap(p)
+			for u in p.unit_set.select_related('area__board_area', 'area__player'):
+				self.assertEqual(set(strategic_map.destinations.get(u.id, ())),
+					baseline_strategic_destinations(u), u)
+
+	def test_check_strategic_movement(self):
+		areas = list(self.game.gamearea_set.select_related('board_area'))
+		for p in self.players:
+			for u in p.unit_set.all():
+				for a in random.sample(areas, min(5, len(areas))):
+					self.assertEqual(u.check_strategic_movement(a),
+						baseline_strategic_movement(u, a), (u, a))
+
+	@override_settings(CACHES={'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+	def test_cache(self):
+		player = self.players[0]
+		strategic_map = strategic.get_strategic_map(player)
+		with self.assertNumQueries(0):
+			self.assertEqual(strategic.get_strategic_map(player).destinations,
+				strategic_map.destinations)
+		## a new phase gets a new map
+		player.game.phase = machiavelli.PHORDERS
+		self.assertEqual(strategic.get_strategic_map(player).turn,
+			(self.game.year, self.game.season, machiavelli.PHORDERS))
+
+##------------------------
+## retreats
+##------------------------
+
+def baseline_retreats(unit):
+	""" ``Unit.get_possible_retreats`` before the adjacency index """
+	cond = Q(game=unit.player.game)
+	cond = cond & Q(standoff=False)
+	cond = cond & Q(board_area__borders=unit.area.board_area)
+	cond = cond & ~Q(board_area__code__exact=unit.must_retreat)
+	cond = cond & ~Q(unit__type__in=['A','F'])
+	if unit.type == 'A':
+		cond = cond & Q(board_area__is_sea=False)
+		cond = cond & ~Q(board_area__mixed=True)
+	elif unit.type == 'F':
+		exclude = []
+		for area in unit.area.board_area.borders.all():
+			if not area.is_adjacent(unit.area.board_area, fleet=True):
+				exclude.append(area.id)
+		cond = cond & ~Q(board_area__id__in=exclude)
+		cond = cond & ~Q(board_area__is_sea=False, board_area__is_coast=False)
+	if unit.area.board_area.is_fortified:
+		if unit.type == 'A' or (unit.type == 'F' and unit.area.board_area.has_port):
+			if unit.must_retreat != unit.area.board_area.code:
+				if not machiavelli.Unit.objects.filter(area=unit.area, type='G').exists() and \
+					not machiavelli.Rebellion.objects.filter(area=unit.area, garrisoned=True).exists():
+					cond = cond | Q(id__exact=unit.area.id)
+	return machiavelli.GameArea.objects.filter(cond).distinct()
+
+def random_retreats(game):
+	""" Marks some areas as standoffs and forces some units to retreat,
+	with the attacker in the same area half of the times """
+	adj = game.get_adjacency()
+	codes = dict(Area.objects.filter(setting=game.scenario.setting).values_list('id', 'code'))
+	players = list(game.player_set.filter(user__isnull=False))
+	for a in game.gamearea_set.all():
+		if random.random() < 0.15:
+			a.standoff = True
+			a.save()
+	for u in machiavelli.Unit.objects.filter(player__game=game, type__in=('A', 'F')).select_related('area'):
+		if random.random() >= 0.4:
+			continue
+		origins = list(adj.borders(u.area.board_area_id)) + [u.area.board_area_id, ]
+		u.must_retreat = codes[random.choice(origins)]
+		u.save()
+		if random.random() < 0.5:
+			machiavelli.Unit(type=u.type, area=u.area, player=random.choice(players)).save()
+
+class RetreatPlanTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(RetreatPlanTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.6, rules=('finances',))
+		scramble(self.game)
+		random_retreats(self.game)
+
+	def get_retreating(self):
+		return machiavelli.Unit.objects.filter(player__game=self.game).exclude(must_retreat__exact='').select_related('area__board_area', 'player__game').order_by('id')
+
+	def test_load_plan(self):
+		if not self.get_retreating().exists():
+			self.skipTest("There are no retreating units")
+		options, disbanded = retreats.load_plan(self.game)
+		## the units without retreats are disbanded one by one, as
+		## announce_retreats did
+		expected = []
+		for u in self.get_retreating():
+			if not baseline_retreats(u).exists():
+				expected.append(u.id)
+				machiavelli.Unit.objects.filter(id=u.id).delete()
+		self.assertEqual(disbanded, expected)
+		expected = {}
+		for u in self.get_retreating():
+			expected[u.id] = sorted(baseline_retreats(u).values_list('id', flat=True))
+			self.assertEqual(sorted(u.get_possible_retreats().values_list('id', flat=True)),
+				expected[u.id], u)
+		self.assertEqual(options, expected)
+
+	@override_settings(CACHES={'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+	def test_announce_retreats(self):
+		options, disbanded = retreats.load_plan(self.game)
+		self.game.announce_retreats()
+		self.assertFalse(machiavelli.Unit.objects.filter(id__in=disbanded).exists())
+		self.game.phase = machiavelli.PHRETREATS
+		with mock.patch('machiavelli.retreats.load_plan') as load_plan:
+			self.assertEqual(retreats.get_retreat_options(self.game), options)
+		self.assertFalse(load_plan.called)
+
+##------------------------
+## adjudication
+##------------------------
+
+## the names of all the signals of the game, except the timings of the steps
+SIGNAL_NAMES = sorted([n for n in dir(signals) if isinstance(getattr(signals, n), Signal)
+	and n != 'turn_step_measured'])
+
+def give_order(unit, **kwargs):
+	""" Replaces the order of the unit, if the new order is possible """
+	order = machiavelli.Order(unit=unit, player=unit.player, confirmed=True, **kwargs)
+	if not order.is_possible():
+		return False
+	machiavelli.Order.objects.filter(unit=unit).delete()
+	order.save()
+	return True
+
+def convoyed_moves(game):
+	""" Orders the convoyed armies to advance to the destination of the
+	convoy. Some of these advances are not reachable """
+	for o in machiavelli.Order.objects.filter(unit__player__game=game, code='C').select_related('subunit__player'):
+		machiavelli.Order.objects.filter(unit=o.subunit).delete()
+		machiavelli.Order(unit=o.subunit, code='-', destination=o.subdestination,
+			player=o.subunit.player, confirmed=True).save()
+
+def stage_conflicts(game):
+	""" Gives orders to some units so that the turn has a bounce in an
+	empty area, a supported attack that forces a unit to retreat, and an
+	attack that cuts the support of another supported attack, if the board
+	allows them """
+	adj = game.get_adjacency()
+	areas = dict([(a.board_area_id, a) for a in game.gamearea_set.select_related('board_area')])
+	units = list(machiavelli.Unit.objects.filter(player__game=game,
+		type__in=('A', 'F')).select_related('area__board_area', 'player'))
+	random.shuffle(units)
+	occupied = set([u.area.board_area_id for u in units])
+	used = set()
+	def neighbours(u):
+		borders = adj.borders(u.area.board_area_id)
+		return [v for v in units if v.area.board_area_id in borders and not v.id in used]
+	## a bounce
+	for u in units:
+		for v in neighbours(u):
+			if v.player_id == u.player_id or u.id in used:
+				continue
+			common = adj.borders(u.area.board_area_id) & adj.borders(v.area.board_area_id)
+			for b in common - occupied:
+				if not b in areas:
+					continue
+				if give_order(u, code='-', destination=areas[b]):
+					if give_order(v, code='-', destination=areas[b]):
+						used.update([u.id, v.id])
+						break
+	## two supported attacks, the second one with its support cut
+	supports = []
+	for d in units:
+		if d.id in used or len(supports) == 2:
+			continue
+		attackers = [a for a in neighbours(d) if a.player_id != d.player_id]
+		for a in attackers:
+			helpers = [h for h in attackers if h != a]
+			if len(helpers) == 0:
+				continue
+			h = helpers[0]
+			if give_order(a, code='-', destination=d.area) and \
+				give_order(h, code='S', subunit=a, subcode='-', subdestination=d.area):
+				give_order(d, code='H')
+				used.update([a.id, h.id, d.id])
+				supports.append(h)
+				break
+	if len(supports) == 2:
+		h = supports[1]
+		for c in neighbours(h):
+			if c.player_id != h.player_id and give_order(c, code='-', destination=h.area):
+				used.add(c.id)
+				break
+
+class AdjudicationTestCase(ScenarioTestCase):
+	""" The orders of each game are processed with the adjudicator and with
+	the old step methods, and both must leave the same game """
+
+	def build(self, seed):
+		random.seed(seed)
+		game = benchmark.build_game(self.scenario, density=0.7, rules=('finances',))
+		scramble(game)
+		benchmark.random_orders(game)
+		match_supports(game)
+		random_convoys(game)
+		convoyed_moves(game)
+		stage_conflicts(game)
+		return game
+
+	def get_state(self, game):
+		return {
+			'units': list(machiavelli.Unit.objects.filter(player__game=game).order_by('id').values()),
+			'areas': list(game.gamearea_set.order_by('id').values()),
+			'orders': list(machiavelli.Order.objects.filter(unit__player__game=game).order_by('id').values()),
+			'rebellions': list(machiavelli.Rebellion.objects.filter(area__game=game).order_by('id').values()),
+			'log': list(game.turnlog_set.order_by('id').values_list('log', flat=True)),
+		}
+
+	def process(self, game, memory):
+		""" Processes the orders of the game and returns its state and the
+		signals sent. The changes are rolled back """
+		random.seed(0)
+		cache.clear()
+		game = machiavelli.Game.objects.get(pk=game.pk)
+		sid = transaction.savepoint()
+		try:
+			with override_settings(MEMORY_ADJUDICATION=memory):
+				with SignalRecorder(*SIGNAL_NAMES) as recorder:
+					game.process_orders()
+			return self.get_state(game), recorder.sent
+		finally:
+			transaction.savepoint_rollback(sid)
+
+	def assertSameTurn(self, game):
+		legacy, legacy_signals = self.process(game, False)
+		memory, memory_signals = self.process(game, True)
+		self.assertEqual(memory['log'], legacy['log'])
+		self.assertEqual(memory_signals, legacy_signals)
+		for key in ('units', 'areas', 'orders', 'rebellions'):
+			self.assertEqual(memory[key], legacy[key], key)
+		return legacy, legacy_signals
+
+	def test_random_turns(self):
+		features = set()
+		for seed in range(0, 4):
+			game = self.build(seed)
+			if machiavelli.Order.objects.filter(unit__player__game=game, code='C').exists():
+				features.add('convoy')
+			state, sent = self.assertSameTurn(game)
+			names = set([s[0] for s in sent])
+			if any(a['standoff'] for a in state['areas']):
+				features.add('bounce')
+			if any(u['must_retreat'] for u in state['units']):
+				features.add('retreat')
+			if 'support_broken' in names:
+				features.add('cut support')
+			if any(u['besieging'] for u in state['units']):
+				features.add('siege')
+			if len(state['rebellions']) > 0:
+				features.add('rebellion')
+		for feature in ('bounce', 'retreat', 'siege', 'rebellion'):
+			self.assertTrue(feature in features, feature)
+
+	def test_without_finances(self):
+		random.seed(10)
+		game = benchmark.build_game(self.scenario, density=0.7)
+		benchmark.random_orders(game)
+		match_supports(game)
+		stage_conflicts(game)
+		self.assertSameTurn(game)
+
+	def test_empty_turn(self):
+		game = benchmark.build_game(self.scenario, players=2)
+		self.assertSameTurn(game)
+
+##------------------------
+## incomes
+##------------------------
+
+def baseline_income(player, die, majors_ids):
+	""" ``Player.get_income`` before the income engine """
+	rebellion_ids = machiavelli.Rebellion.objects.filter(player=player).values_list('area', flat=True)
+	i = player.get_control_income(die, majors_ids, rebellion_ids)
+	i += player.get_occupation_income()
+	i += player.get_garrisons_income(die, majors_ids, rebellion_ids)
+	i += player.get_variable_income(die)
+	if player.game.scenario.setting.configuration.trade_routes:
+		i += baseline_trade_income(player)
+	return i
+
+class IncomeTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(IncomeTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.4,
+			rules=('finances', 'famine', 'conquering'))
+		scramble(self.game)
+		self.majors_ids = list(self.scenario.major_cities.values_list('city', flat=True))
+		self.players = list(self.game.player_set.filter(user__isnull=False,
+			eliminated=False).order_by('id'))
+
+	def get_breakdowns(self):
+		""" Yields (die, player, breakdown) for every face of the die """
+		for die in income.DIE_FACES:
+			breakdowns = income.get_breakdowns(self.game, die, self.majors_ids)
+			self.assertEqual(list(breakdowns.keys()), [p.id for p in self.players])
+			for p in self.players:
+				yield die, p, breakdowns[p.id]
+
+	def get_rebellion_ids(self, player):
+		return machiavelli.Rebellion.objects.filter(player=player).values_list('area', flat=True)
+
+	def test_control(self):
+		for die, p, b in self.get_breakdowns():
+			self.assertEqual(b.control, p.get_control_income(die, self.majors_ids,
+				self.get_rebellion_ids(p)), (die, p))
+
+	def test_occupation(self):
+		for die, p, b in self.get_breakdowns():
+			self.assertEqual(b.occupation, p.get_occupation_income(), (die, p))
+
+	def test_garrisons(self):
+		for die, p, b in self.get_breakdowns():
+			self.assertEqual(b.garrisons, p.get_garrisons_income(die, self.majors_ids,
+				self.get_rebellion_ids(p)), (die, p))
+
+	def test_variable(self):
+		for die, p, b in self.get_breakdowns():
+			self.assertEqual(b.variable, p.get_variable_income(die), (die, p))
+
+	def test_trade(self):
+		trade_routes = self.scenario.setting.configuration.trade_routes
+		for die, p, b in self.get_breakdowns():
+			if trade_routes:
+				self.assertEqual(b.trade, baseline_trade_income(p), (die, p))
+			else:
+				self.assertEqual(b.trade, 0)
+
+	def test_lenders(self):
+		## the debts are paid apart, they never reduce the income
+		self.game.configuration.lenders = True
+		self.game.configuration.save()
+		p = self.players[0]
+		machiavelli.Credit(player=p, principal=10, debt=12, season=self.game.season,
+			year=self.game.year + 1).save()
+		for die in income.DIE_FACES:
+			b = income.get_breakdowns(self.game, die, self.majors_ids)[p.id]
+			self.assertEqual(b.total, baseline_income(p, die, self.majors_ids))
+
+	def test_totals(self):
+		players = list(self.game.player_set.order_by('id'))
+		for die in income.DIE_FACES:
+			breakdowns = income.get_breakdowns(self.game, die, self.majors_ids)
+			for p in players:
+				if p.id in breakdowns:
+					self.assertEqual(breakdowns[p.id].total,
+						baseline_income(p, die, self.majors_ids), (die, p))
+				else:
+					## autonomous and eliminated players get no income
+					self.assertTrue(p.user is None or p.eliminated)
+
+	def test_assign_incomes(self):
+		before = dict(self.game.player_set.values_list('id', 'ducats'))
+		expected = dict([(p.id, baseline_income(p, 4, self.majors_ids)) for p in self.players])
+		with mock.patch('machiavelli.dice.roll_1d6', return_value=4):
+			with SignalRecorder('income_raised') as recorder:
+				self.game.assign_incomes()
+		after = dict(self.game.player_set.values_list('id', 'ducats'))
+		for player_id, ducats in before.items():
+			self.assertEqual(after[player_id], ducats + expected.get(player_id, 0))
+		raised = [s[2] for s in recorder.sent]
+		self.assertEqual(sorted(raised), sorted([i for i, v in expected.items() if v > 0]))
+
+##------------------------
+## expenses
+##------------------------
+
+class ExpensesTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(ExpensesTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, players=2, rules=('finances',))
+		self.players = list(self.game.player_set.filter(user__isnull=False).order_by('id'))
+		self.game.player_set.update(ducats=100)
+		self.p1, self.p2 = self.players[0], self.players[1]
+
+	def expense(self, player, type, ducats, unit=None, area=None, confirmed=True):
+		e = machiavelli.Expense(player=player, type=type, ducats=ducats, unit=unit,
+			area=area, confirmed=confirmed)
+		e.save()
+		return e
+
+	def get_area(self, **kwargs):
+		return self.game.gamearea_set.filter(board_area__is_sea=False,
+			board_area__mixed=False, **kwargs).order_by('id').first()
+
+	def get_ducats(self, player):
+		return machiavelli.Player.objects.get(id=player.id).ducats
+
+	def test_undo(self):
+		u = new_unit(self.game, self.p2)
+		## the order given to the unit that p1 was going to buy
+		machiavelli.Order(unit=u, code='H', player=self.p1).save()
+		self.expense(self.p1, 6, 12, unit=u, confirmed=False)
+		self.expense(self.p1, 0, 3, area=self.get_area(), confirmed=False)
+		kept = self.expense(self.p2, 4, 5, unit=u)
+		with SignalRecorder('expense_paid') as recorder:
+			self.game.process_expenses()
+		self.assertEqual(self.get_ducats(self.p1), 115)
+		self.assertEqual(self.get_ducats(self.p2), 100)
+		self.assertFalse(machiavelli.Order.objects.filter(unit=u, player=self.p1).exists())
+		self.assertFalse(machiavelli.Expense.objects.filter(player__game=self.game).exists())
+		self.assertEqual(recorder.sent, [('expense_paid', 'Expense', kept.pk)])
+
+	def test_counter_bribe_threshold(self):
+		## the bribe succeeds if it pays the cost plus the counter-bribes
+		u = new_unit(self.game, self.p2)
+		cost = machiavelli.get_expense_cost(5, u)
+		self.expense(self.p1, 5, cost + 3, unit=u)
+		self.expense(self.p2, 4, 2, unit=u)
+		self.expense(self.p2, 4, 1, unit=u)
+		self.game.process_expenses()
+		self.assertFalse(machiavelli.Unit.objects.filter(id=u.id).exists())
+
+	def test_countered_bribe(self):
+		u = new_unit(self.game, self.p2)
+		cost = machiavelli.get_expense_cost(5, u)
+		self.expense(self.p1, 5, cost + 3, unit=u)
+		self.expense(self.p2, 4, 2, unit=u)
+		self.expense(self.p2, 4, 2, unit=u)
+		with SignalRecorder('expense_paid', 'unit_disbanded') as recorder:
+			self.game.process_expenses()
+		self.assertTrue(machiavelli.Unit.objects.filter(id=u.id).exists())
+		self.assertEqual(recorder.count('expense_paid'), 3)
+		self.assertEqual(recorder.count('unit_disbanded'), 0)
+
+	def test_famine_relief(self):
+		area = self.get_area()
+		area.famine = True
+		area.save()
+		self.expense(self.p1, 0, 3, area=area)
+		self.game.process_expenses()
+		self.assertFalse(machiavelli.GameArea.objects.get(id=area.id).famine)
+
+	def test_rebellions(self):
+		pacified = self.get_area(player=self.p2, board_area__is_fortified=False)
+		promoted = self.get_area(player=self.p2, rebellion__isnull=True,
+			id__gt=pacified.id)
+		machiavelli.Rebellion(area=pacified).save()
+		## two rebellions promoted in the same area start only one
+		self.expense(self.p1, 2, 9, area=promoted)
+		self.expense(self.p1, 3, 15, area=promoted)
+		self.expense(self.p2, 1, 12, area=pacified)
+		with SignalRecorder('rebellion_started') as recorder:
+			self.game.process_expenses()
+		self.assertEqual(machiavelli.Rebellion.objects.filter(area=promoted).count(), 1)
+		self.assertFalse(machiavelli.Rebellion.objects.filter(area=pacified).exists())
+		self.assertEqual(recorder.sent, [('rebellion_started', 'GameArea', promoted.pk)])
+
+	def test_diplomats(self):
+		area = self.get_area()
+		other = self.get_area(id__gt=area.id)
+		machiavelli.Diplomat(player=self.p1, area=other).save()
+		self.expense(self.p1, 10, 1, area=area)
+		self.expense(self.p1, 11, 3, area=area)
+		self.expense(self.p1, 10, 1, area=other)
+		sea = self.game.gamearea_set.filter(board_area__is_sea=True).first()
+		if sea is not None:
+			self.expense(self.p1, 10, 1, area=sea)
+		with SignalRecorder('expense_paid') as recorder:
+			self.game.process_expenses()
+		diplomats = machiavelli.Diplomat.objects.filter(player=self.p1)
+		self.assertEqual(sorted(diplomats.values_list('area', flat=True)), sorted([area.id, other.id]))
+		## the diplomats are not logged
+		self.assertEqual(recorder.sent, [])
+
+	def tie(self, face):
+		""" Two bribes of the same value on a unit, the die showing ``face`` """
+		u = new_unit(self.game, self.p2)
+		ducats = max(machiavelli.get_expense_cost(5, u), machiavelli.get_expense_cost(6, u)) + 1
+		self.expense(self.p1, 5, ducats, unit=u)
+		self.expense(self.p1, 6, ducats, unit=u)
+		with mock.patch('machiavelli.dice.randint', return_value=face) as randint:
+			self.game.process_expenses()
+		randint.assert_called_once_with(1, 2)
+		return u
+
+	def test_tie_first(self):
+		u = self.tie(1)
+		self.assertFalse(machiavelli.Unit.objects.filter(id=u.id).exists())
+
+	def test_tie_second(self):
+		u = self.tie(2)
+		self.assertEqual(machiavelli.Unit.objects.get(id=u.id).player_id, self.p1.id)
+
+	def test_best_bribe(self):
+		u = new_unit(self.game, self.p2)
+		cost = machiavelli.get_expense_cost(6, u)
+		self.expense(self.p1, 5, cost + 1, unit=u)
+		self.expense(self.p1, 6, cost + 2, unit=u)
+		self.game.process_expenses()
+		self.assertEqual(machiavelli.Unit.objects.get(id=u.id).player_id, self.p1.id)
+
+	def test_bribe_signals(self):
+		disbanded = new_unit(self.game, self.p2)
+		bought = new_unit(self.game, self.p2)
+		garrison = new_unit(self.game, self.p2, 'G')
+		expenses = []
+		for type, unit in ((5, disbanded), (6, bought), (7, garrison)):
+			ducats = machiavelli.get_expense_cost(type, unit)
+			expenses.append(self.expense(self.p1, type, ducats, unit=unit))
+		names = ('expense_paid', 'unit_disbanded', 'unit_changed_country', 'unit_to_autonomous')
+		with SignalRecorder(*names) as recorder:
+			self.game.process_expenses()
+		self.assertEqual(sorted([s[2] for s in recorder.sent if s[0] == 'expense_paid']),
+			sorted([e.pk for e in expenses]))
+		self.assertEqual([s for s in recorder.sent if s[0] != 'expense_paid'], [
+			('unit_disbanded', 'Unit', disbanded.pk),
+			('unit_changed_country', 'Unit', bought.pk),
+			('unit_to_autonomous', 'Unit', garrison.pk),
+		])
+		autonomous = self.game.player_set.get(user__isnull=True)
+		self.assertEqual(machiavelli.Unit.objects.get(id=garrison.id).player_id, autonomous.id)
+
+##------------------------
+## natural disasters
+##------------------------
+
+class DisastersTestCase(ScenarioTestCase):
+	def setUp(self):
+		super(DisastersTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, players=2,
+			rules=('famine', 'plague', 'storms'))
+		self.player = self.game.player_set.filter(user__isnull=False).order_by('id').first()
+
+	def get_value(self, kind):
+		""" Returns a value of the 2d6 whose row and column hit some areas of
+		the game in the ``kind`` table """
+		board_areas = list(self.game.gamearea_set.values_list('board_area', flat=True))
+		for value in range(3, 13):
+			cells = disasters.CELLS[kind].objects.roll(self.scenario.setting, value - 2, value - 2)
+			if cells.filter(area__in=board_areas).exists():
+				return value
+		self.skipTest("There are no %s cells in the setting" % kind)
+
+	def rolling(self, value):
+		""" Patches the dice, so that the year is very bad and both the row
+		and the column are ``value`` - 2 """
+		return mock.patch.multiple('machiavelli.dice', roll_1d6=lambda: 6,
+			roll_2d6=lambda: value)
+
+	def get_areas(self, kind, value):
+		""" The areas hit by ``value``, as the old query by area code """
+		codes = disasters.CELLS[kind].objects.roll(self.scenario.setting,
+			value - 2, value - 2).values_list('area__code', flat=True)
+		return list(self.game.gamearea_set.filter(board_area__code__in=list(codes)).order_by('id'))
+
+	def occupy(self, areas):
+		""" Places a unit in each empty area """
+		for a in areas:
+			if not a.unit_set.exists():
+				type = a.board_area.is_sea and 'F' or 'A'
+				machiavelli.Unit(type=type, area=a, player=self.player).save()
+
+	def get_units(self):
+		return set(machiavelli.Unit.objects.filter(player__game=self.game).values_list('id', flat=True))
+
+	@override_settings(CACHES={'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+	def test_roll_areas(self):
+		for kind in disasters.CELLS.keys():
+			value = self.get_value(kind)
+			expected = self.get_areas(kind, value)
+			with self.rolling(value):
+				self.assertEqual(disasters.roll_areas(self.game, kind), expected)
+				## the cells are read from the cache
+				with self.assertNumQueries(1):
+					self.assertEqual(disasters.roll_areas(self.game, kind), expected)
+
+	def test_famine(self):
+		value = self.get_value('famine')
+		areas = self.get_areas('famine', value)
+		with self.rolling(value), SignalRecorder('famine_marker_placed') as recorder:
+			self.game.mark_famine_areas()
+		marked = self.game.gamearea_set.filter(famine=True).order_by('id')
+		self.assertEqual(list(marked), areas)
+		self.assertEqual(recorder.sent, [('famine_marker_placed', 'GameArea', a.pk) for a in areas])
+		self.occupy(areas)
+		starving = set(machiavelli.Unit.objects.filter(area__in=areas).values_list('id', flat=True))
+		survivors = self.get_units() - starving
+		with SignalRecorder('unit_disbanded') as recorder:
+			disasters.delete_units(machiavelli.Unit.objects.filter(player__game=self.game,
+				area__famine=True))
+		self.assertEqual(self.get_units(), survivors)
+		self.assertEqual(sorted([s[2] for s in recorder.sent]), sorted(starving))
+
+	def test_plague(self):
+		value = self.get_value('plague')
+		areas = self.get_areas('plague', value)
+		self.occupy(areas)
+		## each plague is logged before the units that it kills
+		expected = []
+		for a in areas:
+			expected.append(('plague_placed', 'GameArea', a.pk))
+			for u in a.unit_set.order_by('id'):
+				expected.append(('unit_disbanded', 'Unit', u.pk))
+		survivors = self.get_units() - set([s[2] for s in expected if s[0] == 'unit_disbanded'])
+		with self.rolling(value), SignalRecorder('plague_placed', 'unit_disbanded') as recorder:
+			self.game.kill_plague_units()
+		self.assertEqual(recorder.sent, expected)
+		self.assertEqual(self.get_units(), survivors)
+
+	def test_storm(self):
+		value = self.get_value('storm')
+		areas = self.get_areas('storm', value)
+		with self.rolling(value), SignalRecorder('storm_marker_placed') as recorder:
+			self.game.mark_storm_areas()
+		marked = self.game.gamearea_set.filter(storm=True).order_by('id')
+		self.assertEqual(list(marked), areas)
+		self.assertEqual(recorder.sent, [('storm_marker_placed', 'GameArea', a.pk) for a in areas])
+		self.occupy(areas)
+		sunk = set(machiavelli.Unit.objects.filter(area__in=areas).values_list('id', flat=True))
+		survivors = self.get_units() - sunk
+		with SignalRecorder('unit_disbanded') as recorder:
+			disasters.delete_units(machiavelli.Unit.objects.filter(player__game=self.game,
+				area__storm=True))
+		self.assertEqual(self.get_units(), survivors)
+		self.assertEqual(sorted([s[2] for s in recorder.sent]), sorted(sunk))
+
+	def test_disabled(self):
+		value = self.get_value('famine')
+		self.game.configuration.famine = False
+		self.game.configuration.save()
+		with self.rolling(value):
+			self.game.mark_famine_areas()
+		self.assertFalse(self.game.gamearea_set.filter(famine=True).exists())
+
+##------------------------
+## trade routes
+##------------------------
+
+def baseline_trade_income(player):
+	""" ``Player.get_trade_income`` before the RouteEvaluator """
+	i = 0
+	for r in player.game.gameroute_set.filter(safe=True):
+		for t in r.traders:
+			if t == player:
+				i += 1
+	return i
+
+class RouteEvaluatorTestCase(ScenarioTestCase):
+	def accepts(self, scenario):
+		return scenario.setting.configuration.trade_routes
+
+	def setUp(self):
+		super(RouteEvaluatorTestCase, self).setUp()
+		self.game = benchmark.build_game(self.scenario, density=0.4)
+		self.assertTrue(self.game.gameroute_set.exists())
+
+	def test_evaluate(self):
+		evaluator = routes.RouteEvaluator(self.game)
+		evaluator.evaluate()
+		for r in self.game.gameroute_set.all():
+			r.update_status()
+			self.assertEqual(evaluator.safe[r.id], r.safe, r)
+
+	def test_update(self):
+		## all the routes are marked as unsafe, so that the safe ones change
+		self.game.gameroute_set.update(safe=False)
+		evaluator = routes.RouteEvaluator(self.game)
+		changed = evaluator.update()
+		saved = dict(self.game.gameroute_set.values_list('id', 'safe'))
+		self.assertEqual(changed, len([v for v in saved.values() if v]))
+		for r in self.game.gameroute_set.all():
+			r.update_status()
+			self.assertEqual(saved[r.id], r.safe, r)
+
+	def test_trade_income(self):
+		evaluator = routes.RouteEvaluator(self.game)
+		evaluator.update()
+		income = evaluator.get_trade_income()
+		for p in self.game.player_set.all():
+			self.assertEqual(income.get(p.id, 0), baseline_trade_income(p), p)
+			self.assertEqual(p.get_trade_income(), baseline_trade_income(p), p)
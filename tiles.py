@@ -0,0 +1,121 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the tile pyramid of the maps.
+
+When MAP_TILES is True, each raster map is also cut in tiles of MAP_TILE_SIZE
+pixels, at several zoom levels. Level 0 fits in one tile, and each level
+doubles the size of the previous one, up to the full size of the map. Each
+tile is saved with the hash of its pixels as name, so that the tiles that
+have not changed since the previous phase are not encoded again, and their
+urls never change. The tiles of a map are listed in a JSON index saved next
+to the map in the map store.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+
+from PIL import Image
+
+from django.conf import settings
+
+import machiavelli.mapstore as mapstore
+
+TILES_DIR = "tiles"
+
+def is_enabled():
+	return getattr(settings, 'MAP_TILES', False)
+
+def get_tiles_dir(game):
+	return os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, game.slug, TILES_DIR)
+
+def get_levels(size, tile_size):
+	""" Returns the number of zoom levels of a map of ``size`` """
+	levels = 1
+	largest = max(size)
+	while largest > tile_size:
+		largest = (largest + 1) // 2
+		levels += 1
+	return levels
+
+def scale(image, factor):
+	if factor == 1:
+		return image
+	if hasattr(image, 'reduce'):
+		return image.reduce(factor)
+	return image.resize((max(1, image.size[0] // factor), max(1, image.size[1] // factor)),
+		Image.BILINEAR)
+
+def save_tile(path, tile):
+	tmp = "%s.%s.tmp" % (path, os.getpid())
+	tile.save(tmp, "JPEG", quality=getattr(settings, 'MAP_JPEG_QUALITY', 85))
+	os.replace(tmp, path)
+
+def make_tiles(game, image, key):
+	""" Cuts ``image``, the map saved as ``key`` in the map store, in tiles
+	and saves its index. Returns the number of tiles that were encoded """
+	tile_size = getattr(settings, 'MAP_TILE_SIZE', 256)
+	tiles_dir = get_tiles_dir(game)
+	if not os.path.exists(tiles_dir):
+		os.makedirs(tiles_dir)
+	image = image.convert("RGB")
+	levels = get_levels(image.size, tile_size)
+	index = {'size': image.size, 'tile_size': tile_size, 'url': get_tiles_url(game),
+		'levels': []}
+	encoded = 0
+	for level in range(0, levels):
+		scaled = scale(image, 2 ** (levels - 1 - level))
+		width, height = scaled.size
+		rows = []
+		for top in range(0, height, tile_size):
+			row = []
+			for left in range(0, width, tile_size):
+				tile = scaled.crop((left, top, min(left + tile_size, width),
+					min(top + tile_size, height)))
+				name = hashlib.sha1(tile.tobytes()).hexdigest()
+				path = os.path.join(tiles_dir, "%s.jpg" % name)
+				if not os.path.exists(path):
+					save_tile(path, tile)
+					encoded += 1
+				row.append(name)
+			rows.append(row)
+		index['levels'].append({'size': scaled.size, 'tiles': rows})
+	path = mapstore.get_path(game, key, "tiles.json")
+	tmp = "%s.%s.tmp" % (path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump(index, f)
+	os.replace(tmp, path)
+	return encoded
+
+def get_index_url(game, player=None):
+	""" Returns the url of the tile index of the current map, or of the
+	latest map if it is still being made. Returns None if the map has no
+	tiles """
+	path = game.get_current_map_path(player)
+	if path is None:
+		return None
+	key = mapstore.get_key(path)
+	if key is None or not mapstore.exists(game, key, "tiles.json"):
+		return None
+	return mapstore.get_store_url(game, key, "tiles.json")
+
+def get_tiles_url(game):
+	""" Returns the url of the directory of the tiles """
+	return os.path.join(settings.MEDIA_URL, settings.MAPS_ROOT, game.slug, TILES_DIR)
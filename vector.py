@@ -0,0 +1,184 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines the vector maps.
+
+A vector map is a small SVG document that places the board image and the
+tokens at the same coordinates used by the raster maps, so that the browser
+draws the map. The tokens are taken from a sprite sheet, an SVG document with
+a symbol for each PNG in the tokens directory, which is shared by all the
+games.
+"""
+
+import base64
+import glob
+import hashlib
+import os
+import os.path
+import threading
+from xml.sax.saxutils import quoteattr
+
+from PIL import Image
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import graphics
+from machiavelli.exceptions import GraphicsError
+import machiavelli.sprites as sprites
+from machiavelli.sprites import get_sprite
+import machiavelli.mapstore as mapstore
+
+SPRITES_DIR = "sprites"
+
+_sheet_lock = threading.Lock()
+
+def get_sprite_names():
+	""" Returns a sorted list of tuples (name, path, mtime) for each token """
+	names = []
+	for path in glob.glob(os.path.join(sprites.TOKENS_DIR, "*.png")):
+		name = os.path.splitext(os.path.basename(path))[0]
+		names.append((name, path, os.path.getmtime(path)))
+	names.sort()
+	return names
+
+def get_sprite_sheet():
+	""" Returns the url of the sprite sheet, making it if the tokens have
+	changed """
+	names = get_sprite_names()
+	key = hashlib.sha1(repr([(n[0], n[2]) for n in names]).encode('utf-8')).hexdigest()[:12]
+	filename = "tokens-%s.svg" % key
+	path = os.path.join(settings.MEDIA_ROOT, settings.MAPS_ROOT, SPRITES_DIR, filename)
+	with _sheet_lock:
+		if not os.path.exists(path):
+			symbols = []
+			for name, token_path, mtime in names:
+				width, height = Image.open(token_path).size
+				with open(token_path, 'rb') as f:
+					data = base64.b64encode(f.read()).decode('ascii')
+				symbols.append('<symbol id=%s viewBox="0 0 %s %s"><image width="%s" height="%s" xlink:href="data:image/png;base64,%s"/></symbol>' % (quoteattr(name), width, height, width, height, data))
+			graphics.ensure_dir(path)
+			tmp = "%s.%s.tmp" % (path, os.getpid())
+			with open(tmp, 'w') as f:
+				f.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">')
+				f.write("".join(symbols))
+				f.write('</svg>')
+			os.replace(tmp, path)
+	return os.path.join(settings.MEDIA_URL, settings.MAPS_ROOT, SPRITES_DIR, filename)
+
+class Document(object):
+	""" An SVG document with the board and the tokens placed on it """
+
+	def __init__(self, board_url, size, sheet_url):
+		self.sheet_url = sheet_url
+		self.elements = ['<image x="0" y="0" width="%s" height="%s" xlink:href=%s/>' % (size[0], size[1], quoteattr(board_url))]
+		self.size = size
+
+	def copy(self):
+		document = Document.__new__(Document)
+		document.sheet_url = self.sheet_url
+		document.elements = list(self.elements)
+		document.size = self.size
+		return document
+
+	def place(self, name, coords):
+		""" Places the token ``name`` at ``coords`` """
+		try:
+			width, height = get_sprite(name).size
+		except IOError:
+			logger.error("Token %s not found" % name)
+			raise GraphicsError
+		self.elements.append('<use xlink:href=%s x="%s" y="%s" width="%s" height="%s"/>' % (quoteattr("%s#%s" % (self.sheet_url, name)), coords[0], coords[1], width, height))
+
+	def render(self):
+		## without width and height, the map fills the element that shows it
+		return '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 %s %s">%s</svg>' % (self.size[0], self.size[1], "".join(self.elements))
+
+def place_units(document, units, visible=None, diplomats=()):
+	""" Places the units that are in the ``visible`` areas (all of them if
+	``visible`` is None) and the diplomats, as ``graphics.draw_units`` """
+	names = {'A': 'army', 'F': 'fleet', 'G': 'garrison'}
+	for player_id, board_id, token, coords, marks in units:
+		if visible is not None and not board_id in visible:
+			continue
+		document.place("%s-%s" % (token[1], token[0]), coords)
+		for m in marks:
+			kind, unit_type = m.split("_")
+			document.place("%s-%s" % (kind.lower(), names[unit_type]), coords)
+	for board_id, coords in diplomats:
+		document.place("diplomat-icon", coords)
+
+def make_map(game, fow=False):
+	""" Makes the vector maps of the game, as ``graphics.make_map``. The
+	thumbnail is a raster image, because an SVG shown as an image cannot
+	use the tokens in the sprite sheet """
+	if game.finished:
+		fow = False
+	data = graphics.RenderData(game)
+	board = game.scenario.setting.board
+	try:
+		size = Image.open(board.path).size
+	except (IOError, OSError, ValueError):
+		logger.error("Base map not found for scenario %s" % game.scenario.slug)
+		raise GraphicsError
+	base = Document(board.url, size, get_sprite_sheet())
+	for coords in data.disabled:
+		base.place("disabled", coords)
+	for coords in data.chests:
+		base.place("chest", coords)
+	for static_name, control_coords, flag_coords in data.controls:
+		for coords in control_coords:
+			base.place("control-%s" % static_name, coords)
+		for coords in flag_coords:
+			base.place("flag-%s" % static_name, coords)
+	for name, coords in data.markers:
+		base.place(name, coords)
+	if fow:
+		visible = data.get_visible_areas()
+		for player in game.player_set.filter(user__isnull=False):
+			document = base.copy()
+			place_units(document, data.units, visible.get(player.id, set()),
+				data.diplomats.get(player.id, []))
+			store(game, document, game.get_map_path(player), mapstore.get_latest_path(game, player, "svg"))
+	else:
+		place_units(base, data.units)
+		key = store(game, base, game.get_map_path(), mapstore.get_latest_path(game, None, "svg"))
+		thumb = "%s-thumb" % key
+		if not mapstore.exists(game, thumb):
+			graphics.make_game_thumb(game, 187, 267, mapstore.get_path(game, thumb),
+				graphics.draw_map(game, data))
+		mapstore.link(game, thumb, game.thumbnail_path)
+	return True
+
+def store(game, document, *filenames):
+	""" Saves the document in the map store, if it is not there, and links it
+	to ``filenames``. Returns the key of the document in the store """
+	content = document.render()
+	key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+	if not mapstore.exists(game, key, "svg"):
+		path = mapstore.get_path(game, key, "svg")
+		graphics.ensure_dir(path)
+		tmp = "%s.%s.tmp" % (path, os.getpid())
+		with open(tmp, 'w') as f:
+			f.write(content)
+		os.replace(tmp, path)
+	for filename in filenames:
+		mapstore.link(game, key, filename, "svg")
+	return key
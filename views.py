@@ -54,6 +54,7 @@ else:
 ## machiavelli
 import machiavelli.models as machiavelli
 import machiavelli.forms as forms
+import machiavelli.retreats as retreats
 from machiavelli.signals import player_joined, overthrow_attempted
 from machiavelli.context_processors import activity, latest_gossip
 from machiavelli.listappend import ListAppendView
@@ -645,7 +646,10 @@ class ExpenseCreateView(GamePlayView, FormMixin):
         if not self.player:
             raise Http404
         ctx = super(ExpenseCreateView, self).get_context_data(**kwargs)
-        ctx.update({'current_expenses': self.player.expense_set.all()})
+        ctx.update({
+            'current_expenses': self.player.expense_set.all(),
+            'income_forecast': self.player.get_income_forecast(),
+        })
         return ctx
 
 class ExpenseDeleteView(GamePlayView):
@@ -968,6 +972,7 @@ class PlayFinanceReinforcements(GamePlayView):
                 ctx.update({'special_units': True})
             if self.player.step == 1:
                 ctx.update({'max_units': self.get_max_units(),})
+            ctx.update({'income_forecast': self.player.get_income_forecast()})
         return ctx
 
 class PlayOrders(GamePlayView):
@@ -1090,8 +1095,9 @@ class PlayRetreats(GamePlayView, FormMixin):
         if self.player and not self.player.done:
             retreat_forms = []
             units = self.get_units()
+            options = retreats.get_retreat_options(self.game)
             for u in units:
-                RetreatForm = forms.make_retreat_form(u)
+                RetreatForm = forms.make_retreat_form(u, options)
                 retreat_forms.append(RetreatForm(prefix=u.id))
             if len(retreat_forms) > 0:
                 return self.render_to_response(
@@ -1104,12 +1110,13 @@ class PlayRetreats(GamePlayView, FormMixin):
             raise Http404
         retreat_forms = []
         units = self.get_units()
+        options = retreats.get_retreat_options(self.game)
         data = request.POST
         for u in units:
             unitid_key = "%s-unitid" % u.id
             area_key = "%s-area" % u.id
             unit_data = {unitid_key: data[unitid_key], area_key: data[area_key]}
-            RetreatForm = forms.make_retreat_form(u)
+            RetreatForm = forms.make_retreat_form(u, options)
             retreat_forms.append(RetreatForm(data, prefix=u.id))
         for f in retreat_forms:
             if f.is_valid():
@@ -1151,7 +1158,7 @@ class PlayInactiveGame(GamePlayView, FormMixin):
             if not scores:
                 scores = self.game.score_set.filter(user__isnull=False).order_by('-points')
                 cache.set(cache_key, scores)
-            ctx.update({'players': scores,})
+            ctx.update({'players': scores, 'map': self.game.get_map_url()})
             ## get the logs, if they still exist
             log = self.game.baseevent_set.all()
             if log.count() > 0:
@@ -1307,6 +1314,7 @@ class UndoActionsView(GamePlayView):
             if self.game.check_bonus_time():
                 self.request.user.profile.adjust_karma( -1 )
             self.player.save()
+            self.game.update_deadline()
         return redirect(self.game)
 
 class WhisperCreateView(GamePlayView, FormMixin):
@@ -1367,6 +1375,8 @@ def get_game_context(request, game, player):
         'player_list': game.player_set.by_cities(),
         'teams': game.team_set.all(),
         'map': game.get_map_url(player),
+        'map_webp': game.get_map_webp_url(player),
+        'map_tiles': game.get_map_tiles_url(player),
     }
     if player:
         if game.configuration.lenders:
@@ -1828,7 +1838,8 @@ class TurnLogListView(LoginRequiredMixin, ListView):
         self.game = get_game_or_404(slug=self.kwargs['slug'])
         if self.game.configuration.fow:
             return machiavelli.TurnLog.objects.none()
-        return self.game.turnlog_set.all()
+        ## the logs of the phases without orders only keep their profile
+        return self.game.turnlog_set.exclude(log='')
 
     def get_context_data(self, **kwargs):
         context = super(TurnLogListView, self).get_context_data(**kwargs)